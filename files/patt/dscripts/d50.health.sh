@@ -95,6 +95,8 @@ configure () {
     wsgi_file4=${10:-"df_monitor.wsgi"}
     pe_file=${11:-"cluster_health.te"}
     cluster_config=${12:-"cluster_config.yaml"}
+    wsgi_file5=${13:-"df_cluster.wsgi"}
+    wsgi_file6=${14:-"metrics.wsgi"}
     wsgi_user=${cluster_health_user}
 
     test "$(getent passwd  ${wsgi_user} | cut -d: -f1)" == "${wsgi_user}" || {
@@ -198,7 +200,7 @@ configure () {
                 --touch /var/tmp/$(basename $0 .sh)-httpd.reload
     done
 
-    for wsgi_files in  ${wsgi_file1} ${wsgi_file2} ${wsgi_file3} ${wsgi_file4}
+    for wsgi_files in  ${wsgi_file1} ${wsgi_file2} ${wsgi_file3} ${wsgi_file4} ${wsgi_file5} ${wsgi_file6}
     do
         python3 ${srcdir}/${comd} -t ${srcdir}/${wsgi_files} \
                 -o /usr/local/share/patt/monitoring/wsgi/${wsgi_files} \
@@ -6,6 +6,11 @@ from datetime import datetime, timezone
 from datetime import timedelta
 from contextlib import nullcontext
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(os.path.basename(__file__))
 # logger.setLevel(logging.DEBUG)
 logger.setLevel(logging.INFO)
@@ -21,9 +26,112 @@ logger.setLevel(logging.INFO)
   plot the data stored by the recorder for a specified mount point
 """
 
+"""
+per mount (database, name): (min begin_stamp, monotonic time)
+"""
+_stamp_range_cache = {}
+stamp_range_ttl = 60
+
+"""
+compact storage of the archived rows
+
+the old rows of each mount are packed in blocks of up to block_rows rows stored
+as BLOB in stat_vfs_block. each row is encoded as the zigzag varint deltas of
+(id, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp)
+from the previous row of the block, an idle or slowly moving fs cost a few
+bytes per row instead of a full row.
+"""
+def varint_encode (values):
+    out = bytearray()
+    for v in values:
+        v = (v << 1) ^ (v >> 63)  # zigzag
+        while True:
+            b = v & 0x7f
+            v >>= 7
+            if v:
+                out.append(b | 0x80)
+            else:
+                out.append(b)
+                break
+    return bytes(out)
+
+def varint_decode (data):
+    result = []
+    v = 0
+    shift = 0
+    for b in data:
+        v |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        result.append((v >> 1) ^ -(v & 1))
+        v = 0
+        shift = 0
+    return result
+
+"""
+rows: [(id, name, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp)]
+"""
+def block_encode (rows):
+    prev = [0] * 7
+    deltas = []
+    for r in rows:
+        cur = [int(r[0])] + [int(i) for i in r[2:8]]
+        deltas += [c - p for c, p in zip(cur, prev)]
+        prev = cur
+    return varint_encode(deltas)
+
+def block_decode (data, name):
+    values = varint_decode(data)
+    prev = [0] * 7
+    rows = []
+    for i in range(0, len(values) - 6, 7):
+        prev = [p + d for p, d in zip(prev, values[i:i + 7])]
+        rows.append((prev[0], name) + tuple(prev[1:]))
+    return rows
+
+"""
+retention without full file rewrite: with auto_vacuum=INCREMENTAL the pages freed
+by the deletes are given back to the file system in small steps, each step is a
+short write transaction and WAL readers (wsgi handlers) are never blocked.
+switching an existing db need a one time VACUUM (done by db_create on upgrade).
+"""
+def db_incremental_vacuum_setup (db3):
+    mode = db3.execute("PRAGMA auto_vacuum;").fetchone()[0]
+    if mode == 2: return
+    isolation_level = db3.isolation_level
+    try:
+        db3.isolation_level = None
+        db3.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        db3.execute("VACUUM;")
+        logger.info ("auto_vacuum: {} -> {}".format(
+            mode, db3.execute("PRAGMA auto_vacuum;").fetchone()[0]))
+    finally:
+        db3.isolation_level = isolation_level
+
+def db_incremental_vacuum (db3, step_pages=256, max_pages=None):
+    released = 0
+    isolation_level = db3.isolation_level
+    try:
+        db3.isolation_level = None
+        while max_pages is None or released < max_pages:
+            free = db3.execute("PRAGMA freelist_count;").fetchone()[0]
+            if free == 0: break
+            # executescript step the pragma until done (one page per step)
+            db3.executescript("PRAGMA incremental_vacuum({});".format(int(min(free, step_pages))))
+            n = free - db3.execute("PRAGMA freelist_count;").fetchone()[0]
+            if n <= 0: break
+            released += n
+        if released:
+            db3.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchall()
+            logger.info ("incremental_vacuum: {} pages released".format(released))
+    finally:
+        db3.isolation_level = isolation_level
+    return released
+
 class PersistenceSQL3(object):
-    def __init__(self, database):
-        self.sql3 = sqlite3.connect(database=database)
+    def __init__(self, database, timeout=5.0):
+        self.sql3 = sqlite3.connect(database=database, timeout=timeout)
     def __enter__(self):
         return self.sql3
     def __exit__(self, type, value, traceback):
@@ -58,6 +166,11 @@ class SystemService(object):
         self.stamp = time.mktime(time.gmtime())
 
 
+    """
+    rollup tiers in seconds and how long they are kept
+    """
+    rollup_tiers = {60: 2 * 86400, 900: 62 * 86400}
+
     """
     PRAGMA journal_mode=WAL;
     PRAGMA schema.journal_size_limit=6815744; (6.5MB)
@@ -65,7 +178,7 @@ class SystemService(object):
     update stat_vfs_schema_version using ie `date +%s` on schema change
     """
     def db_create (self):
-        stat_vfs_schema_version = '1631441163';
+        stat_vfs_schema_version = '1792370000';
         with PersistenceSQL3(database=self.database) as db3:
             db3.row_factory = sqlite3.Row
             try:
@@ -88,6 +201,7 @@ class SystemService(object):
                     logger.debug("skip remaining db_update: {} == {}".format(r[0], stat_vfs_schema_version))
                     return
                 # skip the remaining process
+                db_incremental_vacuum_setup(db3)
                 cur.execute("""create table if not exists stat_vfs
                 (
                  id integer primary key,
@@ -102,6 +216,53 @@ class SystemService(object):
 
                 """)
                 cur.execute("create index if not exists stat_vfs_name_idx on stat_vfs(name);")
+                cur.execute("""create index if not exists stat_vfs_name_stamp_idx
+                on stat_vfs(name, begin_stamp, renew_stamp);""")
+                cur.execute("""create table if not exists stat_vfs_block
+                (
+                 id integer primary key,
+                 name text,
+                 first_id integer,
+                 last_id integer,
+                 begin_stamp integer,
+                 renew_stamp integer,
+                 count integer,
+                 data blob
+                );
+                """)
+                cur.execute("""create index if not exists stat_vfs_block_name_stamp_idx
+                on stat_vfs_block(name, begin_stamp);""")
+                cur.execute("""create table if not exists stat_vfs_rollup
+                (
+                 name text,
+                 tier integer,
+                 bucket integer,
+                 fs_total integer,
+                 fs_avail_min integer,
+                 fs_avail_max integer,
+                 fs_avail_avg real,
+                 inode_total integer,
+                 inode_avail_min integer,
+                 inode_avail_max integer,
+                 inode_avail_avg real,
+                 samples integer,
+                 primary key (name, tier, bucket)
+                ) without rowid;
+                """)
+                cur.execute("""create table if not exists stat_vfs_forecast
+                (
+                 name text primary key,
+                 stamp integer,
+                 fs_total integer,
+                 fs_level real,
+                 fs_trend real,
+                 fs_full_stamp integer,
+                 inode_total integer,
+                 inode_level real,
+                 inode_trend real,
+                 inode_full_stamp integer
+                );
+                """)
                 try:
                     sqlite3_maj = int(sqlite3.sqlite_version.split('.')[0])
                     sqlite3_min = int(sqlite3.sqlite_version.split('.')[1])
@@ -155,6 +316,10 @@ class SystemService(object):
     def __init__(self, database="{}".format(f"{_default_db_path()}"), exclude_path=[], mode='recorder'):
         self.database=database
         self.last_db_cleanup = datetime.now(timezone.utc)
+        self.last_rows = None
+        self.last_renew = 0
+        self.rollup = {}
+        self.forecast = None
         if mode == 'recorder':
             self.local_mounts = SystemService.local_mounts(exclude_path=exclude_path)
             self.statvfs()
@@ -164,67 +329,344 @@ class SystemService(object):
 
     """
     param:
-    max_keep_sample = 15000, numer of row to keep should not be too high or max_db_size may have no effect.
-    max_db_size=1024, when dbsize > max_db_size in KB, cleanup (delete + vacuum) each hour
+    max_keep_sample = 15000, numer of raw row to keep should not be too high or max_db_size may have no effect.
+    max_db_size=1024, when dbsize > max_db_size in KB, cleanup (delete + incremental vacuum) each hour,
+    the oldest archived blocks are dropped to keep them under half of max_db_size.
+    keep_raw=1000, raw rows kept per mount, the older ones are archived in blocks each hour.
     """
-    def db_cleanup (self, max_keep_sample=15000, max_db_size=1024, cleanup_interval=timedelta(hours=1)):
+    def db_cleanup (self, max_keep_sample=15000, max_db_size=1024, cleanup_interval=timedelta(hours=1),
+                    keep_raw=1000):
         if datetime.now(timezone.utc) - self.last_db_cleanup < cleanup_interval: return
+
+        with PersistenceSQL3(database=self.database, timeout=120) as db3:
+            try:
+                self.statvfs_archive(db3.cursor(), keep_raw=keep_raw)
+                self.statvfs_rollup_expire(db3.cursor())
+            except:
+                db3.rollback()
+                raise
+            else:
+                db3.commit()
+        self.last_db_cleanup = datetime.now(timezone.utc)
+
         if os.path.exists(self.database):
             db_size = os.stat(os.path.abspath(self.database)).st_size
             if int(db_size / 1024) < int(max_db_size): return
 
-        with PersistenceSQL3(database=self.database) as db3:
+        with PersistenceSQL3(database=self.database, timeout=120) as db3:
             # db3.set_trace_callback(logger.debug)
             db3.row_factory = sqlite3.Row
             try:
                 logger.debug ("db_cleanup")
                 cur = db3.cursor()
                 cur.execute("""
+                DELETE from stat_vfs_block where id in
+                (SELECT id from
+                (SELECT id, sum (length (data)) OVER (ORDER BY renew_stamp DESC, id DESC) as used
+                from stat_vfs_block) where used > ?);
+                """, [int(max_db_size) * 1024 // 2])
+                if cur.rowcount > 0:
+                    logger.info ("db_cleanup: {} archived blocks dropped".format(cur.rowcount))
+                cur.execute("""
                 SELECT name, count (*) as cnt from stat_vfs
                 GROUP BY name
                 HAVING cnt >= ?
                 ORDER BY cnt DESC;""",
                             [max_keep_sample])
                 r = cur.fetchall()
-                if not r:
-                    self.last_db_cleanup = datetime.now(timezone.utc)
-                    return
                 for e in r:
                     logger.info ("db_cleanup: {}".format([i for i in e]))
                     cur.execute("""
                     DELETE from stat_vfs where id in
-                    (SELECT id from stat_vfs where name = ? order by id DESC LIMIT
+                    (SELECT id from stat_vfs where name = ? order by id ASC LIMIT
                     (SELECT (SELECT count (*) from stat_vfs where name = ?) - ?)
                     );
                     """,
                                 (e["name"], e["name"], max_keep_sample))
             except:
+                db3.rollback()
                 raise
             else:
-                retry = 1200
-                count = 0
-                for i in range(retry):
-                    count += 1
-                    try:
-                        db3.commit()
-                    except sqlite3.OperationalError:
-                        if count % 10 == 0: logger.debug("retry: {}/{}".format(count, retry))
-                        if count == retry: raise
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        break
+                db3.commit()
                 self.last_db_cleanup = datetime.now(timezone.utc)
 
+        with PersistenceSQL3(database=self.database, timeout=120) as db3:
+            db_incremental_vacuum(db3)
+
+    """
+    pack the raw rows of each mount older than the keep_raw newest ones
+    in blocks of block_rows rows (only full blocks are written)
+    """
+    def statvfs_archive (self, cur, keep_raw=1000, block_rows=512):
+        cur.execute("""
+        SELECT name, count (*) as cnt from stat_vfs GROUP BY name HAVING cnt >= ?;
+        """, (keep_raw + block_rows,))
+        for name, cnt in cur.fetchall():
+            archive = (cnt - keep_raw) // block_rows * block_rows
+            cur.execute("""
+            select id, name, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp
+            from stat_vfs where name = ? order by id limit ?;
+            """, (name, archive))
+            rows = cur.fetchall()
+            for i in range(0, len(rows), block_rows):
+                b = rows[i:i + block_rows]
+                cur.execute("""insert into stat_vfs_block
+                (name, first_id, last_id, begin_stamp, renew_stamp, count, data)
+                values (?, ?, ?, ?, ?, ?, ?);
+                """, (name, b[0][0], b[-1][0], b[0][6], max([r[7] for r in b]), len(b), block_encode(b)))
+            cur.execute("delete from stat_vfs where name = ? and id <= ?;", (name, rows[-1][0]))
+            logger.info ("statvfs_archive: {} {} rows archived".format(name, len(rows)))
+
+    """
+    accumulate one sample per mount in the current bucket of each tier,
+    return the rows of the buckets closed by this sample
+    """
+    def statvfs_rollup_add (self, name, values):
+        closed = []
+        f_total, f_avail, inode_total, inode_avail = values
+        for tier in self.rollup_tiers:
+            bucket = self.stamp - self.stamp % tier
+            r = self.rollup.get((name, tier))
+            if r and r['bucket'] != bucket:
+                closed.append(self.statvfs_rollup_row(name, tier, r))
+                r = None
+            if r is None:
+                r = {'bucket': bucket, 'fs_total': f_total, 'fs_min': f_avail, 'fs_max': f_avail, 'fs_sum': 0,
+                     'inode_total': inode_total, 'inode_min': inode_avail, 'inode_max': inode_avail,
+                     'inode_sum': 0, 'samples': 0}
+                self.rollup[(name, tier)] = r
+            r['fs_total'] = f_total
+            r['fs_min'] = min(r['fs_min'], f_avail)
+            r['fs_max'] = max(r['fs_max'], f_avail)
+            r['fs_sum'] += f_avail
+            r['inode_total'] = inode_total
+            r['inode_min'] = min(r['inode_min'], inode_avail)
+            r['inode_max'] = max(r['inode_max'], inode_avail)
+            r['inode_sum'] += inode_avail
+            r['samples'] += 1
+        return closed
+
+    def statvfs_rollup_row (self, name, tier, r):
+        return (name, tier, r['bucket'], r['fs_total'], r['fs_min'], r['fs_max'], r['fs_sum'] / r['samples'],
+                r['inode_total'], r['inode_min'], r['inode_max'], r['inode_sum'] / r['samples'], r['samples'])
+
+    """
+    merge the closed buckets, a bucket already stored (ie: recorder restart) is combined
+    """
+    def statvfs_rollup_store (self, cur, rows):
+        cur.executemany("""
+        insert into stat_vfs_rollup
+        (name, tier, bucket, fs_total, fs_avail_min, fs_avail_max, fs_avail_avg,
+         inode_total, inode_avail_min, inode_avail_max, inode_avail_avg, samples)
+        values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        on conflict (name, tier, bucket) do update set
+        fs_total = excluded.fs_total,
+        fs_avail_min = min (fs_avail_min, excluded.fs_avail_min),
+        fs_avail_max = max (fs_avail_max, excluded.fs_avail_max),
+        fs_avail_avg = (fs_avail_avg * samples + excluded.fs_avail_avg * excluded.samples) /
+                       (samples + excluded.samples),
+        inode_total = excluded.inode_total,
+        inode_avail_min = min (inode_avail_min, excluded.inode_avail_min),
+        inode_avail_max = max (inode_avail_max, excluded.inode_avail_max),
+        inode_avail_avg = (inode_avail_avg * samples + excluded.inode_avail_avg * excluded.samples) /
+                          (samples + excluded.samples),
+        samples = samples + excluded.samples;
+        """, rows)
+
+    def statvfs_rollup_expire (self, cur):
+        for tier, keep in self.rollup_tiers.items():
+            cur.execute("""
+            delete from stat_vfs_rollup where tier = ? and
+            bucket < (select max (bucket) from stat_vfs_rollup where tier = ?) - ?;
+            """, (tier, tier, keep))
+
+    """
+    return the coarsest tier not larger than step covering the start of [stamp_start, stamp_stop]
+    or None when the raw rows must be used.
+    the bucket in progress is not stored, cf statvfs_rollup_tail for the end of the window
+    """
+    def statvfs_rollup_tier (self, cur, name, stamp_start, stamp_stop, step):
+        for tier in sorted([t for t in self.rollup_tiers if t <= step], reverse=True):
+            cur.execute("""
+            select min (bucket) from stat_vfs_rollup where name = ? and tier = ?;
+            """, (name, tier))
+            first = cur.fetchone()[0]
+            if first is None: continue
+            begin = self.statvfs_stamp_range(cur, name)[0]
+            if first <= max(stamp_start, begin if begin else stamp_start) + tier:
+                return tier
+        return None
+
+    """
+    first stamp of the series stamp_start + k * step not covered by the stored buckets of tier
+    (the bucket in progress and the tail not yet rolled up), None when the tier cover stamp_stop
+    """
+    def statvfs_rollup_tail (self, cur, name, tier, stamp_start, step, stamp_stop):
+        cur.execute("""
+        select max (bucket) from stat_vfs_rollup where name = ? and tier = ?;
+        """, (name, tier))
+        last = cur.fetchone()[0]
+        if last is None: return stamp_start
+        # a stamp use the bucket in ]stamp - tier, stamp]
+        k = max(0, -(-(last + tier - stamp_start) // step))
+        tail = stamp_start + k * step
+        return tail if tail <= stamp_stop else None
+
+    """
+    disk full forecast: Holt linear smoothing of fs_avail and inode_avail per mount fed
+    with the closed 1 minute buckets (no history scan), level in bytes or inodes,
+    trend per second. *_full_stamp is when the level reach 0 at the current trend.
+    """
+    forecast_alpha = 0.3
+    forecast_beta = 0.05
+
+    def statvfs_forecast_load (self, cur):
+        cur.execute("""
+        select name, stamp, fs_level, fs_trend, inode_level, inode_trend from stat_vfs_forecast;
+        """)
+        return {r[0]: {'stamp': r[1], 'fs_level': r[2], 'fs_trend': r[3],
+                       'inode_level': r[4], 'inode_trend': r[5]} for r in cur.fetchall()}
+
+    def statvfs_forecast_update (self, cur, rows):
+        alpha = self.forecast_alpha
+        beta = self.forecast_beta
+        update = []
+        for (name, tier, bucket, fs_total, fs_min, fs_max, fs_avg,
+             inode_total, inode_min, inode_max, inode_avg, samples) in rows:
+            if tier != 60: continue
+            f = self.forecast.get(name)
+            if f is None:
+                f = {'stamp': bucket, 'fs_level': fs_avg, 'fs_trend': 0.0,
+                     'inode_level': inode_avg, 'inode_trend': 0.0}
+                self.forecast[name] = f
+            else:
+                dt = bucket - f['stamp']
+                if dt <= 0: continue
+                for k, v in (('fs', fs_avg), ('inode', inode_avg)):
+                    level = f[k + '_level']
+                    trend = f[k + '_trend']
+                    f[k + '_level'] = alpha * v + (1 - alpha) * (level + trend * dt)
+                    f[k + '_trend'] = beta * (f[k + '_level'] - level) / dt + (1 - beta) * trend
+                f['stamp'] = bucket
+            full = {}
+            for k in ('fs', 'inode'):
+                full[k] = None
+                if f[k + '_trend'] < 0:
+                    full[k] = int(bucket + max(f[k + '_level'], 0) / -f[k + '_trend'])
+            update.append((name, bucket, fs_total, f['fs_level'], f['fs_trend'], full['fs'],
+                           inode_total, f['inode_level'], f['inode_trend'], full['inode']))
+        cur.executemany("""
+        insert or replace into stat_vfs_forecast
+        (name, stamp, fs_total, fs_level, fs_trend, fs_full_stamp,
+         inode_total, inode_level, inode_trend, inode_full_stamp)
+        values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """, update)
+
+    """
+    return [{'path', 'stamp', 'space_full_in', 'inodes_full_in', 'space_rate', 'inodes_rate'}]
+    *_full_in in seconds from now (None when not filling), *_rate consumed per second
+    """
+    def statvfs_forecast_get (self, name=None):
+        result = []
+        now = time.mktime(time.gmtime())
         with PersistenceSQL3(database=self.database) as db3:
             try:
-                db3.isolation_level = None
-                db3.execute('VACUUM')
-                db3.isolation_level = ''
-            except:
-                raise
+                cur = db3.cursor()
+                cur.execute("""
+                select name, stamp, fs_trend, fs_full_stamp, inode_trend, inode_full_stamp
+                from stat_vfs_forecast where ? is null or name = ? order by length(name), name;
+                """, (name, name))
+            except sqlite3.OperationalError as e:
+                logger.warning (e)
+                return result
+            for r in cur.fetchall():
+                result.append({'path': r[0], 'stamp': r[1],
+                               'space_full_in': None if r[3] is None else max(r[3] - now, 0),
+                               'inodes_full_in': None if r[5] is None else max(r[5] - now, 0),
+                               'space_rate': 0 - r[2], 'inodes_rate': 0 - r[4]})
+        return result
+
+    """
+    return (min begin_stamp, max renew_stamp) of name over the raw and archived rows
+    the min only move on cleanup and is cached for stamp_range_ttl seconds,
+    the max is the renew_stamp of the last row (index lookup)
+    """
+    def statvfs_stamp_range (self, cur, name):
+        key = (self.database, name)
+        cached = _stamp_range_cache.get(key)
+        if cached and time.monotonic() - cached[1] < stamp_range_ttl:
+            stamp_min = cached[0]
+        else:
+            cur.execute("""
+            select min (b) from
+            (select min (begin_stamp) as b from stat_vfs where name = ?
+            union all
+            select min (begin_stamp) from stat_vfs_block where name = ?);
+            """, (name, name))
+            stamp_min = cur.fetchone()[0]
+            if stamp_min is not None:
+                _stamp_range_cache[key] = (stamp_min, time.monotonic())
+        cur.execute("""
+        select coalesce (
+        (select renew_stamp from stat_vfs where id = (select max (id) from stat_vfs where name = ?)),
+        (select max (renew_stamp) from stat_vfs_block where name = ?));
+        """, (name, name))
+        return (stamp_min, cur.fetchone()[0])
+
+    """
+    return the table holding the rows of name overlapping [stamp_start, stamp_stop]:
+    main.stat_vfs or, when archived blocks overlap, temp.stat_vfs_archive filled with
+    the decoded rows and the raw rows of the window
+    """
+    def statvfs_source (self, db3, name, stamp_start, stamp_stop):
+        cur = db3.cursor()
+        cur.execute("""
+        create temp table if not exists stat_vfs_archive as select * from stat_vfs where 0;
+        """)
+        cur.execute("delete from temp.stat_vfs_archive;")
+        cur.execute("""
+        select data from stat_vfs_block where name = ? and
+        begin_stamp <= ? and renew_stamp >= ? order by first_id;
+        """, (name, stamp_stop, stamp_start))
+        blocks = cur.fetchall()
+        if not blocks:
+            return "main.stat_vfs"
+        for b in blocks:
+            cur.executemany("""
+            insert into temp.stat_vfs_archive
+            (id, name, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp)
+            values (?, ?, ?, ?, ?, ?, ?, ?);
+            """, block_decode(b[0], name))
+        # the raw rows of the window follow the archived ones
+        cur.execute("""
+        insert into temp.stat_vfs_archive select * from main.stat_vfs where name = ? and
+        begin_stamp <= ? and renew_stamp >= ?;
+        """, (name, stamp_stop, stamp_start))
+        cur.execute("""
+        create index if not exists temp.stat_vfs_archive_name_stamp_idx
+        on stat_vfs_archive(name, begin_stamp, renew_stamp);
+        """)
+        return "temp.stat_vfs_archive"
 
-    def statvfs_upsert (self, db_connection=None):
+    """
+    return {name: {'values': (fs_total, fs_avail, inode_total, inode_avail),
+                   'renew': renew_stamp, 'flushed': renew_stamp}}
+    for the last row of each mount point
+    """
+    def statvfs_last_rows (self, cur):
+        cur.execute("""
+        select name, fs_total, fs_avail, inode_total, inode_avail, renew_stamp from stat_vfs
+        where id in (select max(id) from stat_vfs group by name);
+        """)
+        return {r[0]: {'values': tuple(r[1:5]), 'renew': r[5], 'flushed': r[5]} for r in cur.fetchall()}
+
+    """
+    the last row of each mount point is kept in memory and sqlite is only
+    touched when a value changed (new row) or every renew_interval seconds
+    (renew_stamp of the last rows), with one transaction per call.
+    db_connection should be opened with a busy timeout (cf: PersistenceSQL3)
+    """
+    def statvfs_upsert (self, db_connection=None, renew_interval=5):
         if db_connection is None:
             cm = PersistenceSQL3(database=self.database)
         else:
@@ -236,8 +678,15 @@ class SystemService(object):
             self.db_cleanup()
             try:
                 cur = db3.cursor()
+                if self.last_rows is None:
+                    self.last_rows = self.statvfs_last_rows(cur)
+                if self.forecast is None:
+                    self.forecast = self.statvfs_forecast_load(cur)
                 self.statvfs ()
                 m_div = 1024 / 1024
+                renew = {}
+                insert = []
+                rollup = []
                 for i in self.fs:
                     f_bsize = i.statvfs.f_bsize
                     name = i.path
@@ -245,41 +694,46 @@ class SystemService(object):
                     f_avail = i.statvfs.f_bavail * f_bsize / m_div
                     inode_total = i.statvfs.f_files
                     inode_avail = i.statvfs.f_favail
-                    begin_stamp = self.stamp
-                    renew_stamp = self.stamp
-                    cur.execute("""
-                    update stat_vfs set renew_stamp = ? where
-                    id = (select id from stat_vfs where
-                    name = ? and
-                    fs_total = ? and
-                    fs_avail = ? and
-                    inode_total = ? and
-                    inode_avail = ?
-                    order by id desc limit 1) and
-                    id = (select id from stat_vfs where name = ? order by id desc limit 1);
-                    """,(renew_stamp, name, f_total, f_avail, inode_total, inode_avail, name))
-
-                    cur.execute("""insert into stat_vfs
-                    (name, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp)
-                    select ?, ?, ?, ?, ?, ?, ? where (select Changes() = 0);
-                    """, (name, f_total, f_avail, inode_total, inode_avail, begin_stamp, renew_stamp))
+                    values = (f_total, f_avail, inode_total, inode_avail)
+                    rollup += self.statvfs_rollup_add(name, values)
+                    last = self.last_rows.get(name)
+                    if last and last['values'] == values:
+                        last['renew'] = self.stamp
+                        continue
+                    if last and last['renew'] != last['flushed']:
+                        # close the previous row before the new one
+                        renew[name] = last['renew']
+                    insert.append((name,) + values + (self.stamp, self.stamp))
+                    self.last_rows[name] = {'values': values, 'renew': self.stamp, 'flushed': self.stamp}
+                if self.stamp - self.last_renew >= renew_interval:
+                    self.last_renew = self.stamp
+                    for name, last in self.last_rows.items():
+                        if last['renew'] != last['flushed'] and name not in renew:
+                            renew[name] = last['renew']
+                if not renew and not insert and not rollup:
+                    return
+                # renew before insert: max(id) is still the previous row
+                cur.executemany("""
+                update stat_vfs set renew_stamp = ? where
+                id = (select max(id) from stat_vfs where name = ?);
+                """, [(v, k) for k, v in renew.items()])
+                cur.executemany("""insert into stat_vfs
+                (name, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp)
+                values (?, ?, ?, ?, ?, ?, ?);
+                """, insert)
+                self.statvfs_rollup_store(cur, rollup)
+                self.statvfs_forecast_update(cur, rollup)
             except Exception as e:
                 logger.error (e)
+                db3.rollback()
+                self.last_rows = None
+                self.forecast = None
                 raise
             else:
-                retry = 1200
-                count = 0
-                for i in range(retry):
-                    count += 1
-                    try:
-                        db3.commit()
-                    except sqlite3.OperationalError:
-                        if count % 10 == 0: logger.debug("retry: {}/{}".format(count, retry))
-                        if count == retry: raise
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        break
+                db3.commit()
+                for name, stamp in renew.items():
+                    if name in self.last_rows and self.last_rows[name]['renew'] == stamp:
+                        self.last_rows[name]['flushed'] = stamp
 
     def statvfs_list_mnt (self):
         with PersistenceSQL3(database=self.database) as db3:
@@ -299,9 +753,18 @@ class SystemService(object):
 
 
     """
+    epoch seconds from a number or a %Y-%m-%dT%H:%M:%S%Z date (the data, min_fs and numpy paths)
     """
-    def statvfs_get_data (self, name, stamp_start=None, step=None, stamp_stop=None, smooth=False):
+    def statvfs_stamp_parse (self, stamp):
         dt_format = "%Y-%m-%dT%H:%M:%S%Z"
+        try:
+            return int(float(stamp))
+        except ValueError:
+            return time.mktime(time.strptime(stamp, dt_format))
+
+    """
+    """
+    def statvfs_get_data (self, name, stamp_start=None, step=None, stamp_stop=None, smooth=False):
         #assert name in [n.path for n in self.fs]
         with PersistenceSQL3(database=self.database) as db3:
             db3.row_factory = sqlite3.Row
@@ -312,58 +775,46 @@ class SystemService(object):
 
             if not stamp_start:
                 try:
-                    cur = db3.cursor()
-                    cur.execute("""
-                    select min (begin_stamp) from stat_vfs where stat_vfs.name = ?;
-                    """, (name,))
+                    stamp_start = self.statvfs_stamp_range(db3.cursor(), name)[0]
                 except Exception as e:
                     logger.error (e)
                     raise
                 else:
-                    stamp_start = [c for c in cur][0][0]
                     logger.debug ("statvfs_get_data min_stamp = {}".format(stamp_start))
                     assert int(stamp_start)
             else:
-                try:
-                    stamp_start = int(float(stamp_start))
-                except ValueError:
-                    stamp_start = time.mktime(time.strptime(stamp_start, dt_format))
+                stamp_start = self.statvfs_stamp_parse(stamp_start)
                 assert int(float(stamp_start))
 
             if not stamp_stop:
                 try:
-                    cur = db3.cursor()
-                    cur.execute("""
-                    select max (renew_stamp) from stat_vfs where stat_vfs.name = ?;
-                    """, (name,))
+                    stamp_stop = self.statvfs_stamp_range(db3.cursor(), name)[1]
                 except Exception as e:
                     logger.error (e)
                     raise
                 else:
-                    stamp_stop = [c for c in cur][0][0]
                     logger.debug ("statvfs_get_data max_stamp = {}".format(stamp_stop))
                     assert int(stamp_stop)
             else:
-                try:
-                    stamp_stop = int(float(stamp_stop))
-                except ValueError:
-                    stamp_stop = time.mktime(time.strptime(stamp_stop, dt_format))
+                stamp_stop = self.statvfs_stamp_parse(stamp_stop)
                 assert int(float(stamp_stop))
 
             if stamp_start < 0:
                 stamp_start = stamp_stop + stamp_start
 
             assert stamp_start < stamp_stop
+            src = None
 
             if not step:
                 try:
+                    src = self.statvfs_source(db3, name, stamp_start, stamp_stop)
                     cur = db3.cursor()
                     cur.execute("""
-                    SELECT MIN (renew_stamp - begin_stamp) from stat_vfs where name = ? and
+                    SELECT MIN (renew_stamp - begin_stamp) from {} as stat_vfs where name = ? and
                     renew_stamp <> begin_stamp and
                     ? <= stat_vfs.begin_stamp and
                     ? >= stat_vfs.renew_stamp;
-                    """, (name, stamp_start, stamp_stop))
+                    """.format(src), (name, stamp_start, stamp_stop))
                 except Exception as e:
                     logger.error (e)
                     raise
@@ -371,8 +822,46 @@ class SystemService(object):
                     step = [c for c in cur][0][0]
                     logger.debug ("statvfs_get_data min_step = {}".format(step))
                     step = step if step else 3
+            tier = self.statvfs_rollup_tier(db3.cursor(), name, stamp_start, stamp_stop, step)
+            logger.debug ("statvfs_get_data tier = {}".format(tier))
+            tail = None
+            if tier:
+                # the stamps past the last stored bucket are read from the raw rows
+                tail = self.statvfs_rollup_tail(db3.cursor(), name, tier, stamp_start, step, stamp_stop)
+                if tail is not None and tail - step < stamp_start:
+                    tier = None
+                    tail = None
+                logger.debug ("statvfs_get_data tail = {}".format(tail))
             try:
                 cur = db3.cursor()
+                # rollup, bucket avg
+                if tier:
+                    cur.execute("""
+                    select bucket, stamp, fs_total,
+                    avg (fs_avail_avg) OVER (order by bucket ROWS BETWEEN ? PRECEDING AND CURRENT ROW),
+                    inode_total,
+                    avg (inode_avail_avg) OVER (order by bucket ROWS BETWEEN ? PRECEDING AND CURRENT ROW)
+                    from stat_vfs_rollup,
+                    (with recursive stamps(stamp) as (
+                    values(?)
+                    union all
+                    select stamp + ?
+                    from stamps
+                    where stamp < ?
+                    )
+                    select stamp from stamps
+                    ) where stat_vfs_rollup.name = ? and stat_vfs_rollup.tier = ? and
+                    bucket between stamp - ? + 1 and stamp;
+                    """, (int(smooth), int(smooth), stamp_start, step,
+                          tail - step if tail is not None else stamp_stop, name, tier, tier))
+                    for c in cur:
+                        yield [r for r in c]
+                    if tail is None:
+                        return
+                    stamp_start = tail
+                    src = None
+                if src is None:
+                    src = self.statvfs_source(db3, name, stamp_start, stamp_stop)
                 # moving avg
                 if smooth:
                     cur.execute("""
@@ -380,7 +869,7 @@ class SystemService(object):
                     avg (fs_avail) OVER (order by id ROWS BETWEEN ? PRECEDING AND CURRENT ROW),
                     inode_total,
                     avg (inode_avail) OVER (order by id ROWS BETWEEN ? PRECEDING AND CURRENT ROW)
-                    from stat_vfs,
+                    from
                     (with recursive stamps(stamp) as (
                     values(?)
                     union all
@@ -389,14 +878,16 @@ class SystemService(object):
                     where stamp < ?
                     )
                     select stamp from stamps
-                    ) where stat_vfs.name = ? and
-                    stamp >= stat_vfs.begin_stamp and
-                    stamp <= stat_vfs.renew_stamp;
-                    """, (smooth, smooth, stamp_start, step, stamp_stop, name))
+                    ) as stamps
+                    join {0} as stat_vfs on stat_vfs.id =
+                    (select id from {0} where name = ? and begin_stamp <= stamp
+                     order by begin_stamp desc limit 1)
+                    where stamp <= stat_vfs.renew_stamp order by stamp;
+                    """.format(src), (smooth, smooth, stamp_start, step, stamp_stop, name))
                 # raw
                 else:
                     cur.execute("""
-                    select id, stamp, fs_total, fs_avail, inode_total, inode_avail from stat_vfs,
+                    select id, stamp, fs_total, fs_avail, inode_total, inode_avail from
                     (with recursive stamps(stamp) as (
                     values(?)
                     union all
@@ -405,10 +896,12 @@ class SystemService(object):
                     where stamp < ?
                     )
                     select stamp from stamps
-                    ) where stat_vfs.name = ? and
-                    stamp >= stat_vfs.begin_stamp and
-                    stamp <= stat_vfs.renew_stamp;
-                    """, (stamp_start, step, stamp_stop, name))
+                    ) as stamps
+                    join {0} as stat_vfs on stat_vfs.id =
+                    (select id from {0} where name = ? and begin_stamp <= stamp
+                     order by begin_stamp desc limit 1)
+                    where stamp <= stat_vfs.renew_stamp order by stamp;
+                    """.format(src), (stamp_start, step, stamp_stop, name))
             except Exception as e:
                 logger.error (e)
                 raise
@@ -418,7 +911,6 @@ class SystemService(object):
     """
     """
     def statvfs_get_min_fs(self, name=None, stamp_start=None, stamp_stop=None, limit=None):
-        dt_format = "%Y-%m-%dT%H:%M:%S%Z"
         limit = 10 if limit is None else limit
         assert limit > 0 and limit < 30
 
@@ -427,42 +919,28 @@ class SystemService(object):
             # db3.set_trace_callback(logger.debug)
             if not stamp_start:
                 try:
-                    cur = db3.cursor()
-                    cur.execute("""
-                    select min (begin_stamp) from stat_vfs where stat_vfs.name = ?;
-                    """, (name,))
+                    stamp_start = self.statvfs_stamp_range(db3.cursor(), name)[0]
                 except Exception as e:
                     logger.error (e)
                     raise
                 else:
-                    stamp_start = [c for c in cur][0][0]
                     logger.debug ("statvfs_get_data min_stamp = {}".format(stamp_start))
                     assert int(stamp_start)
             else:
-                try:
-                    stamp_start = int(float(stamp_start))
-                except ValueError:
-                    stamp_start = time.mktime(time.strptime(stamp_start, dt_format))
+                stamp_start = self.statvfs_stamp_parse(stamp_start)
                 assert int(float(stamp_start))
 
             if not stamp_stop:
                 try:
-                    cur = db3.cursor()
-                    cur.execute("""
-                    select max (renew_stamp) from stat_vfs where stat_vfs.name = ?;
-                    """, (name,))
+                    stamp_stop = self.statvfs_stamp_range(db3.cursor(), name)[1]
                 except Exception as e:
                     logger.error (e)
                     raise
                 else:
-                    stamp_stop = [c for c in cur][0][0]
                     logger.debug ("statvfs_get_data max_stamp = {}".format(stamp_stop))
                     assert int(stamp_stop)
             else:
-                try:
-                    stamp_stop = int(float(stamp_stop))
-                except ValueError:
-                    stamp_stop = time.mktime(time.strptime(stamp_stop, dt_format))
+                stamp_stop = self.statvfs_stamp_parse(stamp_stop)
                 assert int(float(stamp_stop))
 
             if stamp_start < 0:
@@ -479,15 +957,47 @@ class SystemService(object):
                 db3.set_trace_callback(logger.debug)
             try:
                 cur = db3.cursor()
+                tier = self.statvfs_rollup_tier(cur, name, stamp_start, stamp_stop,
+                                                (stamp_stop - stamp_start) // 1000)
+                tail = None
+                if tier:
+                    tail = self.statvfs_rollup_tail(cur, name, tier, stamp_start, 1, stamp_stop)
+                    if tail == stamp_start:
+                        tier = None
+                        tail = None
+                    elif tail == stamp_stop:
+                        tail = None
+                if tier:
+                    cur.execute("""
+                    select bucket, bucket, fs_total, cast ((m / 1024 / 1024) as int),
+                    (fs_total - m) / fs_total * 100.0,  row_number() OVER(ORDER BY bucket) as rn  from
+                    (select bucket, fs_total, cast (fs_avail_min as float) as m
+                    from stat_vfs_rollup where name = ? and tier = ? and
+                    bucket between ? and ?
+                    order by fs_avail_min ASC limit ?) order by bucket;
+                    """, (name, tier, stamp_start - tier + 1, stamp_stop, limit))
+                    result = [[r for r in c] for c in cur]
+                    if tail is not None:
+                        # the bucket in progress come from the raw rows
+                        result += [r for r in self.statvfs_get_min_fs(
+                            name=name, stamp_start=tail, stamp_stop=stamp_stop, limit=limit)]
+                        result = sorted(sorted(result, key=lambda r: -r[4])[:limit], key=lambda r: r[1])
+                        for rn, r in enumerate(result):
+                            r[5] = rn + 1
+                    for r in result:
+                        yield r
+                    return
+                src = self.statvfs_source(db3, name, stamp_start, stamp_stop)
                 cur.execute("""
                 select id, begin_stamp, fs_total, cast ((m / 1024 / 1024) as int),
                 (fs_total - m) / fs_total * 100.0,  row_number() OVER(ORDER BY id) as rn  from
                 (select id, begin_stamp, fs_total, cast (min(fs_avail) as float) as m
-                from stat_vfs where name = ?  and
-                ((stat_vfs.begin_stamp between ? and ?) or
-                 stat_vfs.renew_stamp between ? and ?)
+                from {0} as stat_vfs where name = ?  and
+                begin_stamp between coalesce (
+                (select max (begin_stamp) from {0} where name = ? and begin_stamp < ?), ?) and ? and
+                renew_stamp >= ?
                 group by id order by min(fs_avail) ASC limit ?) order by id;
-                """, (name, stamp_start, stamp_stop, stamp_start, stamp_stop, limit))
+                """.format(src), (name, name, stamp_start, stamp_start, stamp_stop, stamp_start, limit))
             except Exception as e:
                 logger.error (e)
                 raise
@@ -495,6 +1005,324 @@ class SystemService(object):
                 for c in cur:
                     yield [r for r in c]
 
+    """
+    columnar fetch (numpy required): return the rows of name overlapping [stamp_start, stamp_stop]
+    as numpy arrays {'id', 'begin_stamp', 'renew_stamp', 'fs_total', 'fs_avail', 'inode_total',
+    'inode_avail'} ordered by begin_stamp. raw and archived rows only, no rollup tier.
+    the fetch cost the same as the sql path, the gain come from working on the
+    arrays afterwards: one fetch for the data and the min points, vectorised
+    smoothing and no per row python list.
+    """
+    def statvfs_get_columns (self, name, stamp_start, stamp_stop):
+        columns = ('id', 'begin_stamp', 'renew_stamp', 'fs_total', 'fs_avail', 'inode_total', 'inode_avail')
+        with PersistenceSQL3(database=self.database) as db3:
+            src = self.statvfs_source(db3, name, stamp_start, stamp_stop)
+            cur = db3.cursor()
+            cur.execute("""
+            select id, begin_stamp, renew_stamp, fs_total, fs_avail, inode_total, inode_avail
+            from {0} where name = ? and
+            begin_stamp between coalesce (
+            (select max (begin_stamp) from {0} where name = ? and begin_stamp < ?), ?) and ? and
+            renew_stamp >= ? order by begin_stamp;
+            """.format(src), (name, name, stamp_start, stamp_start, stamp_stop, stamp_start))
+            a = numpy.array(cur.fetchall(), dtype=numpy.float64).reshape(-1, len(columns))
+        result = {k: a[:, i] for i, k in enumerate(columns)}
+        for k in ('id', 'begin_stamp', 'renew_stamp'):
+            result[k] = result[k].astype(numpy.int64)
+        return result
+
+    """
+    numpy version of statvfs_get_data: same rows returned as a 2d array
+    (id, stamp, fs_total, fs_avail, inode_total, inode_avail), the resampling on the
+    step series, the moving average (smooth) and the default step are vectorised.
+    columns: statvfs_get_columns result to reuse, must cover the last stamp of the series
+    """
+    def statvfs_get_data_np (self, name, stamp_start=None, step=None, stamp_stop=None, smooth=False,
+                             columns=None):
+        assert numpy is not None
+        if not stamp_start or not stamp_stop:
+            with PersistenceSQL3(database=self.database) as db3:
+                stamp_range = self.statvfs_stamp_range(db3.cursor(), name)
+            stamp_start = stamp_start if stamp_start else stamp_range[0]
+            stamp_stop = stamp_stop if stamp_stop else stamp_range[1]
+        stamp_start = int(self.statvfs_stamp_parse(stamp_start))
+        stamp_stop = int(self.statvfs_stamp_parse(stamp_stop))
+        if stamp_start < 0:
+            stamp_start = stamp_stop + stamp_start
+        assert stamp_start < stamp_stop
+        c = columns
+        if c is None:
+            c = self.statvfs_get_columns(name, stamp_start, stamp_stop + (step if step else 0))
+        if not step:
+            d = c['renew_stamp'] - c['begin_stamp']
+            d = d[(d != 0) & (c['begin_stamp'] >= stamp_start) & (c['renew_stamp'] <= stamp_stop)]
+            step = int(d.min()) if d.size else 3
+        # same series as the recursive cte: start, start + step, ... first value >= stop
+        stamps = numpy.arange(stamp_start, stamp_stop + step, step, dtype=numpy.int64)
+        if columns is None and stamps[-1] > stamp_stop and c['begin_stamp'].size:
+            # row covering the last stamp (default step only)
+            e = self.statvfs_get_columns(name, int(stamps[-1]), int(stamps[-1]))
+            keep = e['begin_stamp'] > c['begin_stamp'][-1]
+            c = {k: numpy.concatenate((c[k], e[k][keep])) for k in c}
+        i = numpy.searchsorted(c['begin_stamp'], stamps, side='right') - 1
+        ok = i >= 0
+        ok[ok] = stamps[ok] <= c['renew_stamp'][i[ok]]
+        i = i[ok]
+        fs_avail = c['fs_avail'][i]
+        inode_avail = c['inode_avail'][i]
+        if smooth:
+            fs_avail = statvfs_np_trailing_avg(fs_avail, smooth)
+            inode_avail = statvfs_np_trailing_avg(inode_avail, smooth)
+        return numpy.column_stack((c['id'][i], stamps[ok], c['fs_total'][i], fs_avail,
+                                   c['inode_total'][i], inode_avail))
+
+    """
+    numpy version of statvfs_get_min_fs, same columns
+    (id, begin_stamp, fs_total, mb_free, pc_use, row_num)
+    """
+    def statvfs_get_min_fs_np (self, name, stamp_start, stamp_stop, limit=10, columns=None):
+        assert numpy is not None
+        stamp_start = int(self.statvfs_stamp_parse(stamp_start))
+        stamp_stop = int(self.statvfs_stamp_parse(stamp_stop))
+        c = columns if columns is not None else self.statvfs_get_columns(name, stamp_start, stamp_stop)
+        w = numpy.nonzero((c['begin_stamp'] <= stamp_stop) & (c['renew_stamp'] >= stamp_start))[0]
+        n = min(limit, w.size)
+        if n == 0:
+            return numpy.empty((0, 6))
+        sel = w[numpy.argsort(c['fs_avail'][w], kind='stable')[:n]]
+        sel = sel[numpy.argsort(c['id'][sel])]
+        m = c['fs_avail'][sel]
+        fs_total = c['fs_total'][sel]
+        return numpy.column_stack((c['id'][sel], c['begin_stamp'][sel], fs_total,
+                                   (m / 1024 / 1024).astype(numpy.int64),
+                                   (fs_total - m) / fs_total * 100.0, numpy.arange(1, n + 1)))
+
+    def statvfs_bench_np_plot (self, name, stamp_start, stamp_stop):
+        c = self.statvfs_get_columns(name, stamp_start, stamp_stop + 1)
+        return (list(self.statvfs_get_data_np(name, stamp_start, 1, stamp_stop, smooth=7, columns=c)) +
+                list(self.statvfs_get_min_fs_np(name, stamp_start, stamp_stop, columns=c)))
+
+    """
+    fill the db with a synthetic history (rows split over mounts, one row per sample_interval
+    seconds) if it has less than rows rows, then time the range queries and print their plan
+    """
+    def statvfs_bench (self, rows=2000000, mounts=4, window=3600, sample_interval=10):
+        import random
+        self.db_create()
+        names = ["/bench{}".format(i) for i in range(mounts)]
+        t0 = 1600000000
+        per_mount = rows // mounts
+        with PersistenceSQL3(database=self.database, timeout=120) as db3:
+            cur = db3.cursor()
+            cur.execute("select count (*) from stat_vfs;")
+            if cur.fetchone()[0] < rows:
+                start = time.monotonic()
+                for name in names:
+                    avail = [10 ** 12]
+                    def gen():
+                        for i in range(per_mount):
+                            avail[0] -= random.randint(0, 1 << 20)
+                            begin = t0 + int(i * sample_interval)
+                            renew = max(begin, t0 + int((i + 1) * sample_interval) - 1)
+                            yield (name, 2 * 10 ** 12, avail[0], 10 ** 7, 5 * 10 ** 6, begin, renew)
+                    cur.executemany("""insert into stat_vfs
+                    (name, fs_total, fs_avail, inode_total, inode_avail, begin_stamp, renew_stamp)
+                    values (?, ?, ?, ?, ?, ?, ?);
+                    """, gen())
+                db3.commit()
+                print ("{} rows generated in {:.1f}s".format(rows, time.monotonic() - start))
+            cur.execute("analyze;")
+            for q, a in [
+                    ("""select id from stat_vfs where name = ? and begin_stamp <= ?
+                    order by begin_stamp desc limit 1""", (names[0], t0)),
+                    ("""select min (renew_stamp - begin_stamp) from stat_vfs where name = ? and
+                    renew_stamp <> begin_stamp and ? <= begin_stamp and ? >= renew_stamp""", (names[0], t0, t0)),
+                    ("""select renew_stamp from stat_vfs where id =
+                    (select max (id) from stat_vfs where name = ?)""", (names[0],))]:
+                print (" ".join(q.split()))
+                for r in cur.execute("explain query plan " + q, a):
+                    print ("  {}".format(r[-1]))
+
+        stamp_stop = t0 + int(per_mount * sample_interval)
+        middle = t0 + int(per_mount * sample_interval / 2)
+        middle = min(middle, stamp_stop - window)
+        tests = [
+                ("stamp_range", lambda: self.statvfs_stamp_range(
+                    sqlite3.connect(self.database).cursor(), names[-1])),
+                ("get_data last {}s step 1".format(window), lambda: list(self.statvfs_get_data(
+                    names[-1], stamp_start=stamp_stop - window, stamp_stop=stamp_stop, step=1))),
+                ("get_data middle {}s step 1".format(window), lambda: list(self.statvfs_get_data(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window, step=1))),
+                ("get_data middle {}s auto step".format(window), lambda: list(self.statvfs_get_data(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window))),
+                ("get_data middle {}s step 1 smooth 7".format(window), lambda: list(self.statvfs_get_data(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window, step=1, smooth=7))),
+                ("get_min_fs middle {}s".format(window), lambda: list(self.statvfs_get_min_fs(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window)))]
+        if numpy is not None:
+            tests += [
+                ("numpy get_data middle {}s step 1".format(window), lambda: self.statvfs_get_data_np(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window, step=1)),
+                ("numpy get_data middle {}s step 1 smooth 7".format(window), lambda: self.statvfs_get_data_np(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window, step=1, smooth=7)),
+                ("numpy get_min_fs middle {}s".format(window), lambda: self.statvfs_get_min_fs_np(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window)),
+                ("sql plot data smooth 7 + min_fs", lambda: list(self.statvfs_get_data(
+                    names[-1], stamp_start=middle, stamp_stop=middle + window, step=1, smooth=7)) +
+                 list(self.statvfs_get_min_fs(names[-1], stamp_start=middle, stamp_stop=middle + window))),
+                ("numpy plot data smooth 7 + min_fs", lambda: self.statvfs_bench_np_plot(
+                    names[-1], middle, middle + window))]
+        for label, fn in tests:
+            start = time.monotonic()
+            r = fn()
+            print ("{:<44} {:>8.4f}s {:>6} rows".format(label, time.monotonic() - start, len(r)))
+
+"""
+inotify watch (ctypes, linux only) on a few directories and their sub directories
+up to depth, read() return the number of events received since the last call.
+directories not readable by the recorder user are skipped.
+"""
+class Inotify(object):
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, paths=[], depth=1, max_watch=1024):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError (e, os.strerror(e))
+        mask = (Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO |
+                Inotify.IN_CREATE | Inotify.IN_DELETE)
+        self.watch = 0
+        todo = [(p, 0) for p in paths]
+        while todo and self.watch < max_watch:
+            path, level = todo.pop(0)
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+                logger.warning ("inotify {}: {}".format(path, os.strerror(ctypes.get_errno())))
+                continue
+            self.watch += 1
+            if level >= depth: continue
+            try:
+                todo += [(e.path, level + 1) for e in os.scandir(path)
+                         if e.is_dir(follow_symlinks=False)]
+            except OSError as e:
+                logger.warning ("inotify {}".format(e))
+        logger.info ("inotify: {} directories watched".format(self.watch))
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        count = 0
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not data: break
+            # struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+            i = 0
+            while i + 16 <= len(data):
+                i += 16 + int.from_bytes(data[i + 12:i + 16], byteorder='little')
+                count += 1
+        return count
+
+    def close(self):
+        os.close(self.fd)
+
+"""
+adaptive recorder wake up: the interval double on each idle sample up to max_interval
+and fall back to min_interval when
+ - the fill rate of a mount grow (derivative above its moving avg),
+ - a mount would be full in less than full_horizon seconds at the current rate,
+ - the inotify watch report at least heavy_events events while waiting.
+"""
+class AdaptiveSampler(object):
+    def __init__(self, min_interval=0.3, max_interval=10, watch=[], heavy_events=64,
+                 full_horizon=3600, rate_floor=1024 * 1024):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.heavy_events = heavy_events
+        self.full_horizon = full_horizon
+        self.rate_floor = rate_floor
+        self.interval = min_interval
+        self.last = {}
+        self.rate = {}
+        self.wakeup = 0
+        self.inotify = None
+        if watch:
+            try:
+                self.inotify = Inotify(watch)
+            except (OSError, AttributeError) as e:
+                logger.warning ("inotify unavailable: {}".format(e))
+
+    """
+    fs: SystemService.fs, return the interval until the next sample
+    """
+    def next_interval (self, fs):
+        now = time.monotonic()
+        burst = False
+        for i in fs:
+            avail = i.statvfs.f_bavail * i.statvfs.f_bsize
+            last = self.last.get(i.path)
+            self.last[i.path] = (now, avail)
+            if last is None or now <= last[0]: continue
+            if avail == last[1]: continue
+            rate = (last[1] - avail) / (now - last[0])  # bytes/s consumed
+            avg = self.rate.get(i.path, 0.0)
+            self.rate[i.path] = avg * 0.8 + rate * 0.2
+            if rate > self.rate_floor and rate > 1.5 * avg:
+                burst = True
+            if rate > 0 and avail / rate < self.full_horizon:
+                burst = True
+        if burst:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
+
+    """
+    sleep until the next sample, return early on heavy write activity
+    """
+    def wait (self, fs):
+        interval = self.next_interval(fs)
+        self.wakeup += 1
+        if self.inotify is None:
+            time.sleep(interval)
+            return
+        import select
+        deadline = time.monotonic() + interval
+        events = 0
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: break
+            r, w, x = select.select([self.inotify], [], [], timeout)
+            if not r: break
+            events += self.inotify.read()
+            if events >= self.heavy_events:
+                self.interval = self.min_interval
+                break
+            # coalesce the events of a light activity
+            time.sleep(min(self.min_interval, max(deadline - time.monotonic(), 0)))
+
+"""
+avg of the n preceding values and the current one (partial window at the start),
+as avg () OVER (ROWS BETWEEN n PRECEDING AND CURRENT ROW)
+"""
+def statvfs_np_trailing_avg (values, n):
+    c = numpy.cumsum(numpy.concatenate(([0.0], values)))
+    i = numpy.arange(1, values.size + 1)
+    lo = numpy.maximum(i - n - 1, 0)
+    return (c[i] - c[lo]) / (i - lo)
+
 class GnuPlot(object):
     def __init__(self, gnuplot="/usr/bin/gnuplot"):
         from subprocess import Popen, PIPE
@@ -534,6 +1362,13 @@ if __name__ == "__main__":
                           required=False, default=[])
     recorder.add_argument('-i', '--interval', help='min time between event recording',
                           required=False, type=float)
+    recorder.add_argument('-r', '--renew_interval', help='max time between renew stamp recording',
+                          required=False, type=float, default=5)
+    recorder.add_argument('-I', '--max_interval',
+                          help='adaptive sampling, the interval grow up to max_interval when idle',
+                          required=False, type=float)
+    recorder.add_argument('-w', '--watch', help='directory to watch (inotify) to sample faster on writes',
+                          action='append', required=False, default=[])
 
     player = subparsers.add_parser('player')
     player.add_argument('-f', '--file', help='use specified db file', required=False)
@@ -551,6 +1386,16 @@ if __name__ == "__main__":
 
     player.add_argument('-p', '--plot', help='plot', required=False, action='store_true', default=None)
 
+    bench = subparsers.add_parser('bench')
+    bench.add_argument('-f', '--file', help='synthetic db file, filled if needed',
+                       required=False, default='/tmp/patt_monitoring-fs-bench.sql3')
+    bench.add_argument('-r', '--rows', help='number of rows', required=False, type=int, default=2000000)
+    bench.add_argument('-m', '--mounts', help='number of mount point', required=False, type=int, default=4)
+    bench.add_argument('-w', '--window', help='query window (seconds)', required=False, type=int,
+                       default=3600)
+    bench.add_argument('-s', '--sample_interval', help='seconds between synthetic rows',
+                       required=False, type=float, default=10)
+
     args = parser.parse_args()
 
     try:
@@ -563,10 +1408,21 @@ if __name__ == "__main__":
         interval = args.interval if args.interval else 0.3
         assert float(interval)
 
-        with PersistenceSQL3(database=ss.database) as db3:
+        sampler = None
+        if args.max_interval:
+            sampler = AdaptiveSampler(min_interval=interval, max_interval=args.max_interval, watch=args.watch)
+
+        with PersistenceSQL3(database=ss.database, timeout=120) as db3:
             while True:
-                ss.statvfs_upsert(db3)
-                time.sleep(interval)
+                ss.statvfs_upsert(db3, renew_interval=args.renew_interval)
+                if sampler:
+                    sampler.wait(ss.fs)
+                else:
+                    time.sleep(interval)
+    elif args.mode == 'bench':
+        ssb = SystemService(database=args.file, mode='player')
+        ssb.statvfs_bench(rows=args.rows, mounts=args.mounts, window=args.window,
+                          sample_interval=args.sample_interval)
     elif args.mode == 'player':
         name =  args.name
         if args.file:
@@ -604,9 +1460,14 @@ if __name__ == "__main__":
                         p.send (["set xdata time",
                                  'set timefmt "%s"',
                                  'set format x "%Y-%m-%dT%H:%M:%SUTC"'])
-                        [print (str(i)[1:-1], file=data_file) for i in ssp.statvfs_get_data(
-                        args.name, stamp_start=stamp_start, step=step, stamp_stop=stamp_stop,
-                            smooth=smooth)]
+                        if numpy is not None:
+                            numpy.savetxt(data_file, ssp.statvfs_get_data_np(
+                                args.name, stamp_start=stamp_start, step=step, stamp_stop=stamp_stop,
+                                smooth=smooth), fmt='%.15g', delimiter=', ')
+                        else:
+                            [print (str(i)[1:-1], file=data_file) for i in ssp.statvfs_get_data(
+                            args.name, stamp_start=stamp_start, step=step, stamp_stop=stamp_stop,
+                                smooth=smooth)]
                         data_file.flush()
                         if os.stat(data_file.name).st_size == 0:
                             p.close()
@@ -4,9 +4,13 @@ import yaml
 import requests
 import ipaddress
 import time
+from datetime import datetime
 from pprint import pformat
 import sqlite3
 import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 from sys import exit as sys_exit
 from sys import stderr
 
@@ -43,6 +47,14 @@ class ClusterService:
     cluster_keys = ['cluster_name', 'dcs_peers', 'dcs_type', 'postgres_peers', 'sftpd_peers']
     # subset of class Config(object) from patt_cli
 
+    # keep-alive connections and fetch threads, shared by all the services of a (wsgi) process
+    session = None
+    pool = None
+    max_workers = 16
+    _shared_lock = threading.Lock()
+    # seconds allowed to each check (get, fetch_first), a dead peer cost at most that
+    check_deadline = 0.9
+
     def load_cluster_config(self):
         with open(self.cluster_config, 'r') as f:
             try:
@@ -67,34 +79,85 @@ class ClusterService:
         self.dcs_type = Gconfig.dcs_type if hasattr(Gconfig, 'dcs_type') else None
         self.postgres_peers = Gconfig.postgres_peers if hasattr(Gconfig, 'postgres_peers') else []
         self.sftpd_peers = Gconfig.sftpd_peers if hasattr(Gconfig, 'sftpd_peers') else []
+        # http requests issued by fetch_first, none issued over max_requests (if set)
+        self.requests = 0
+        self.max_requests = None
+
+    def _session (self):
+        with ClusterService._shared_lock:
+            if ClusterService.session is None:
+                s = requests.Session()
+                a = requests.adapters.HTTPAdapter(pool_connections=ClusterService.max_workers,
+                                                  pool_maxsize=ClusterService.max_workers)
+                s.mount('http://', a)
+                s.mount('https://', a)
+                ClusterService.session = s
+            return ClusterService.session
+
+    def _pool (self):
+        with ClusterService._shared_lock:
+            if ClusterService.pool is None:
+                ClusterService.pool = ThreadPoolExecutor(max_workers=ClusterService.max_workers,
+                                                         thread_name_prefix='patt_monitoring')
+            return ClusterService.pool
+
+    def _fetch (self, url, query, start, element, timeout):
+        r = self._session().get("{}/{}".format(url, query), timeout=timeout) # (connect, read)
+        rj = r.json()
+        if start and start in rj:
+            result = None
+            if element:
+                result = [c[element] for c in rj[start] if element in c]
+                assert isinstance(result, list)
+            return result
+        return rj
 
-    def get (self, query=None, start=None, element=None, urls=[]):
-        for url in urls:
-            try:
-                result=None
+    """
+    query all the urls of all the groups at once, the first reply of each group wins
+    (a group being the http:// and https:// variants of a peer, or several peers serving the
+    same data). return one result per group, '' for the groups without reply within
+    deadline seconds (default check_deadline) or not queried because of max_requests
+    """
+    def fetch_first (self, groups, query=None, start=None, element=None, deadline=None):
+        deadline = self.check_deadline if deadline is None else deadline
+        stop = time.monotonic() + deadline
+        timeout = (min(9.0, deadline), min(10.0, deadline)) # (connect, read)
+        pool = self._pool()
+        futures = {}
+        capped = 0
+        for i, urls in enumerate(groups):
+            for url in urls:
+                if self.max_requests is not None and self.requests >= self.max_requests:
+                    capped += 1
+                    continue
+                self.requests += 1
+                futures[pool.submit(self._fetch, url, query, start, element, timeout)] = i
+        if capped:
+            print ("fetch {}: {} requests skipped, max_requests {} reached".format(
+                query, capped, self.max_requests), file=stderr)
+        result = [''] * len(groups)
+        done = set()
+        try:
+            for f in as_completed(futures, timeout=max(stop - time.monotonic(), 0)):
+                i = futures[f]
+                if i in done: continue
                 try:
-                    r = requests.get("{}/{}".format(url, query), timeout=(9.0, 10.0)) # (connect, read)
-                    rj = r.json()
-                except requests.exceptions.ConnectionError:
+                    result[i] = f.result()
+                except (requests.exceptions.RequestException, AssertionError):
                     continue
-                except:
-                    raise
-                else:
-                    if start and start in rj:
-                        if element:
-                            result = [c[element] for c in rj[start] if element in c]
-                            assert isinstance(result, list)
-                    else:
-                        result = rj
-            except (requests.exceptions.ReadTimeout, requests.exceptions.Timeout) as te:
-                continue
-            except AssertionError as e:
-                continue
-            except:
-                raise
-            else:
-                return result
-        return ''
+                except Exception as e:
+                    print ("fetch {}: {}".format(query, str(e)), file=stderr)
+                    continue
+                done.add(i)
+                if len(done) == len(groups): break
+        except FutureTimeoutError:
+            pass
+        finally:
+            for f in futures: f.cancel()
+        return result
+
+    def get (self, query=None, start=None, element=None, urls=[]):
+        return self.fetch_first ([urls], query, start, element)[0]
 
     def http_normalize_url(self, service_port, peers=[]):
         result=[]
@@ -124,28 +187,18 @@ class EtcdService(ClusterService):
     def get_client_urls (self):
         return [n[0] for n in self.get ('v2/members', 'members', 'clientURLs', self.init_urls)]
 
+    def _health (self, rj):
+        return isinstance(rj, dict) and rj.get('health') == "true"
+
     def node_health (self, client_urls=[]):
-        for c in client_urls:
-            result=False
-            try:
-                r = requests.get("{}/health".format(c), timeout=(9.0, 10.0)) # (connect, read)
-                rj = r.json()
-            except (requests.exceptions.ReadTimeout, requests.exceptions.Timeout) as te:
-                continue
-            except requests.exceptions.ConnectionError:
-                continue
-            except:
-                raise
-            else:
-                if 'health' in rj:
-                    result = rj['health'] == "true"
-            return result
+        return self._health (self.get ('health', urls=client_urls))
 
     def cluster_health(self):
         cluster_client_urls = self.get_client_urls()
         if self.dcs_type not in ('etcd', 'etcd3'): return [('unneeded', True)]
         if cluster_client_urls:
-            return [(c, self.node_health ([c])) for c in cluster_client_urls]
+            return [(c, self._health (rj)) for c, rj in zip(
+                cluster_client_urls, self.fetch_first ([[c] for c in cluster_client_urls], 'health'))]
         return ([(c, False) for c in self.dcs_peers])
     # return cluster_config.yaml dcs_peers list set to False if all down or if dcs is not etcd
 
@@ -154,17 +207,21 @@ class EtcdService(ClusterService):
         if clth:
             return all([c[1] for c in clth]) and len (clth) > 0
 
-class PatroniService(ClusterService):
+"""
+one patroni member as reported by its rest api (GET /patroni)
+"""
+PatroniMember = namedtuple('PatroniMember', [
+    'api_url', 'role', 'state', 'timeline',
+    'location', 'received_location', 'replayed_location', 'replayed_timestamp'])
 
-    class Info(object):
-        pass
+"""
+the patroni cluster state after one fetch:
+stamp (time.monotonic), members (sorted by role), listed (number of members listed by the dcs,
+reachable or not), requests (http requests spent on the fetch), dump (pretty printed replies)
+"""
+PatroniSnapshot = namedtuple('PatroniSnapshot', ['stamp', 'members', 'listed', 'requests', 'dump'])
 
-    def _to_attr (self, e = {}):
-        info = PatroniService.Info()
-        if e in (None, ''): return
-        for k in e.keys():
-            setattr(info, k, e[k])
-        return info
+class PatroniService(ClusterService):
 
     def _default_db_path():
         p = "{}/.cache".format(os.path.expanduser("~"))
@@ -172,196 +229,356 @@ class PatroniService(ClusterService):
             return "{}/patt_monitoring.sql3".format (p)
         return "/var/tmp/patt_monitoring-{}.sql3".format(os.getuid())
 
+    """
+    max_age: seconds a snapshot is used by the predicates before being fetched again
+    max_requests: http requests allowed per fetch, default 3 per peer
+    (http and https variants of the cluster query + the member query)
+    """
     def __init__(self,
                  max_time_elapsed_since_replayed=3600,
-                 database="{}".format(f"{_default_db_path()}")):
+                 database="{}".format(f"{_default_db_path()}"),
+                 max_age=5.0,
+                 max_requests=None):
         super().__init__()
         self.database=database
+        self.init_urls = []
         if self.postgres_peers:
             self.init_urls = self.postgres_peers
         self.init_urls = self.http_normalize_url (8008, self.init_urls)
         self.max_time_elapsed_since_replayed = max_time_elapsed_since_replayed
+        self.max_age = max_age
+        self.max_requests = max_requests if max_requests else 3 * max(len(self.postgres_peers), 1)
+        self.state = None
+        # (snapshot, params, result) of the last replication_lag
+        self.lag = None
 
     def _get_api_url(self):
         return self.get ('cluster', 'members', 'api_url', self.init_urls)
 
     def _get_info(self, url):
-        return [self.get ('', None, None, [n]) for n in url]
+        return self.fetch_first ([[n] for n in url], '')
+
+    def _member (self, api_url, e):
+        xlog = e.get('xlog') if isinstance(e.get('xlog'), dict) else {}
+        return PatroniMember(api_url=api_url,
+                             role=e.get('role'),
+                             state=e.get('state'),
+                             timeline=e.get('timeline'),
+                             location=xlog.get('location'),
+                             received_location=xlog.get('received_location'),
+                             replayed_location=xlog.get('replayed_location'),
+                             replayed_timestamp=xlog.get('replayed_timestamp'))
+
+    """
+    fetch the cluster state (one cluster query raced on the peers, then one query per member)
+    """
+    def refresh(self):
+        self.requests = 0
+        api_url = self._get_api_url()
+        api_url = api_url if api_url else []
+        replies = self._get_info(api_url)
+        members = [self._member(u, e) for u, e in zip(api_url, replies) if isinstance(e, dict)]
+        dump = "\n\n".join([pp_string(dict(e, api_url=u)) for u, e in zip(api_url, replies)
+                             if isinstance(e, dict)])
+        self.state = PatroniSnapshot(stamp=time.monotonic(),
+                                     members=tuple(sorted(members, key=lambda m: m.role or '')),
+                                     listed=len(api_url),
+                                     requests=self.requests,
+                                     dump=dump)
+        return self.state
+
+    """
+    the current snapshot, fetched again when older than max_age
+    """
+    def snapshot(self):
+        if self.state is None or time.monotonic() - self.state.stamp > self.max_age:
+            return self.refresh()
+        return self.state
+
+    @property
+    def info(self):
+        return list(self.snapshot().members)
 
     def get_info(self):
-        self.info = ([self._to_attr(i) for i in self._get_info(self._get_api_url())])
-        try:
-            self.info = sorted(self.info, key=lambda peer: peer.role)
-        except AttributeError:
-            pass
-        return self.info
+        return list(self.refresh().members)
 
     def has_master(self):
-        if not self.info:
-            self.get_info
-        return any([n.role == "master" and n.state == "running"
-                    for n in self.info if hasattr(n, 'role')])
+        return any([n.role == "master" and n.state == "running" for n in self.snapshot().members])
 
     def has_replica(self):
-        if not self.info:
-            self.get_info
-        return any([n.role == "replica" and n.state == "running" for n in self.info if hasattr(n, 'role')])
+        return any([n.role == "replica" and n.state == "running" for n in self.snapshot().members])
 
     def match_config(self):
-        if not self.info:
-            self.get_info
-        return len (self.postgres_peers) == len(self.info)
+        return len (self.postgres_peers) == self.snapshot().listed
 
+    """
+    xlog location of the master, None without master (or master location) in the snapshot
+    """
     def master_xlog_location(self):
-        if not self.info:
-            self.get_info
-        if self.info:
-            return [n.xlog['location'] for n in self.info
-                    if hasattr(n, 'role') and n.role == 'master' and 'location' in n.xlog][0]
+        locations = [n.location for n in self.snapshot().members if n.role == 'master' and n.location is not None]
+        return locations[0] if locations else None
 
+    """
+    [(received_location, replayed_location, replayed_timestamp, api_url)] of the replicas
+    """
     def replica_received_replayed (self):
-        if not self.info:
-            self.get_info
-        return [(n.xlog['received_location'], n.xlog['replayed_location'], n.xlog['replayed_timestamp'])
-                for n in self.info if
-                hasattr(n, 'xlog') and n.role == 'replica' and
-                'received_location' and 'replayed_location' in n.xlog]
+        return [(n.received_location, n.replayed_location, n.replayed_timestamp, n.api_url)
+                for n in self.snapshot().members if
+                n.role == 'replica' and n.received_location is not None and n.replayed_location is not None]
 
+    """
+    epoch seconds of a patroni replayed_timestamp (0 if not set), the offset it carry is
+    honoured (time.mktime would read it as local time)
+    """
+    def replayed_epoch(self, stamp):
+        if stamp:
+            return datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S.%f%z").timestamp()
+        return 0
+
+    """
+    [(received_delta, replayed_delta, seconds_since_replayed, api_url)] of the replicas,
+    the deltas are None without master location
+    """
     def replica_received_replayed_delta(self):
         mxlog = self.master_xlog_location()
-        now = time.gmtime()
-        tn=time.mktime(now)
-        t0=time.mktime(time.gmtime(0))
-        def time_or_zero(stamp):
-            if stamp:
-                return time.mktime(time.strptime(stamp, "%Y-%m-%d %H:%M:%S.%f%z"))
-            return t0
-
-        return [(mxlog - n[0],
-                 (mxlog - n[1]),
-                 tn - time_or_zero(n[2]))
+        tn = time.time()
+        return [(None if mxlog is None else mxlog - n[0],
+                 None if mxlog is None else mxlog - n[1],
+                 tn - self.replayed_epoch(n[2]),
+                 n[3])
                 for n in self.replica_received_replayed()]
 
     def replica_received_replayed_delta_ok(self):
         rdlt = self.replica_received_replayed_delta()
-        result = [n[1] == 0 or (n[0] == 0 or n[2] < self.max_time_elapsed_since_replayed) for n in rdlt]
+        result = [n[1] is not None and
+                  (n[1] == 0 or (n[0] == 0 or n[2] < self.max_time_elapsed_since_replayed)) for n in rdlt]
         return all(result) and bool(result)
 
     def timeline_match(self):
-        if not self.info:
-            self.get_info
-        return all([n.timeline == self.info[0].timeline for n in self.info if
-                hasattr(self.info[0], 'timeline') and hasattr(n, 'timeline')])
+        members = self.snapshot().members
+        return all([n.timeline == members[0].timeline for n in members if
+                    members[0].timeline is not None and n.timeline is not None])
 
     def dump(self):
-        result=[pp_string(vars(i)) for i in self.info if hasattr(i, '__dict__')]
-        return "\n\n".join(result)
+        return self.snapshot().dump
 
-    """
-    take a reply list and return the first values found/
-    """
-    def to_tuple (self, l):
-        for n in l:
-            if n: return n
+    # raw lag samples kept (seconds), {rollup tier (seconds): seconds kept}
+    lag_raw_ttl = 3600
+    lag_rollup_tiers = {60: 2 * 86400, 900: 31 * 86400}
+    # last db_cleanup of the process
+    last_db_cleanup = 0
 
     """
+    replication_lag: one row per replica and sample, replayed/received lsn and the lags
+    byte_lag: master xlog location - replayed location
+    time_lag: seconds since the replayed transaction timestamp while byte_lag > 0, 0 otherwise
+    replication_lag_rollup: min/max/avg byte lag, max time lag and replayed range per tier bucket
     """
     def db_create (self):
         with PersistenceSQL3(database=self.database) as db3:
             db3.row_factory = sqlite3.Row
             try:
+                self.db_incremental_vacuum_setup(db3)
                 cur = db3.cursor()
-                cur.execute("""create table if not exists replication_log (
-                id integer primary key, received integer, replayed integer, rstamp integer);
+                # replaced by replication_lag
+                cur.execute("drop table if exists replication_log;")
+                cur.execute("""create table if not exists replication_lag (
+                replica text not null, stamp integer not null, received integer, replayed integer,
+                byte_lag integer, time_lag real,
+                primary key (replica, stamp)) without rowid;
+                """)
+                cur.execute("""create table if not exists replication_lag_rollup (
+                replica text not null, tier integer not null, bucket integer not null,
+                byte_lag_min integer, byte_lag_max integer, byte_lag_avg real, time_lag_max real,
+                replayed_min integer, replayed_max integer, samples integer,
+                primary key (replica, tier, bucket)) without rowid;
                 """)
-                cur.execute(
-                    "select count (id) from replication_log;")
-                r = cur.fetchone()
-                if r[0] < 3:  # initialize with 2 dummy rows
-                    for i in [1, 2]:
-                        cur.execute(
-                            "insert into replication_log(received, replayed, rstamp ) values (0,0,0);"
-                        )
             except:
                 raise
             else:
                 db3.commit()
 
     """
-    param:
-    max_keep_sample = 1000, numer of row to keep should not be too high or max_db_size may have no effect.
-    max_db_size=64, when dbsize > max_db_size in KB, cleanup (delete + vacuum)
+    expire the raw samples and the rollups, at most every cleanup_interval seconds per process
+    max_db_size=1024, when dbsize > max_db_size in KB, give the freed pages back (incremental vacuum)
     """
-    def db_cleanup (self, max_keep_sample=3000, max_db_size=64):
-        if os.path.exists(self.database):
-            db_size = os.stat(os.path.abspath(self.database)).st_size
-            if int(db_size / 1024) < int(max_db_size): return
-
+    def db_cleanup (self, max_db_size=1024, cleanup_interval=300):
+        now = int(time.time())
+        if now - PatroniService.last_db_cleanup < cleanup_interval: return
+        PatroniService.last_db_cleanup = now
         with PersistenceSQL3(database=self.database) as db3:
-            db3.row_factory = sqlite3.Row
             try:
                 cur = db3.cursor()
-                cur.execute("""select (SELECT count (*) from replication_log) > ? as cleanup;""",
-                            [max_keep_sample])
-                r = cur.fetchone()
-                if r and not bool(r["cleanup"]): return
-                cur.execute("""delete from replication_log where id in
-                (select id from replication_log where
-                id < (select id from replication_log order by id desc limit 1)
-                order by id asc limit (select (select count (*) from replication_log) - ?));""",
-                            [max_keep_sample])
+                cur.execute("delete from replication_lag where stamp < ?;", (now - self.lag_raw_ttl,))
+                for tier, keep in self.lag_rollup_tiers.items():
+                    cur.execute("delete from replication_lag_rollup where tier = ? and bucket < ?;",
+                                (tier, now - keep))
             except:
                 raise
             else:
                 db3.commit()
 
+        if os.path.exists(self.database):
+            db_size = os.stat(os.path.abspath(self.database)).st_size
+            if int(db_size / 1024) < int(max_db_size): return
         with PersistenceSQL3(database=self.database) as db3:
-            try:
-                db3.isolation_level = None
-                db3.execute('VACUUM')
-                db3.isolation_level = ''
-            except:
-                raise
+            self.db_incremental_vacuum(db3)
 
+    """
+    auto_vacuum=INCREMENTAL let db_cleanup give the freed pages back without
+    rewriting the whole file, an existing db is converted once with a VACUUM
+    """
+    def db_incremental_vacuum_setup (self, db3):
+        if db3.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2: return
+        isolation_level = db3.isolation_level
+        try:
+            db3.isolation_level = None
+            db3.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            db3.execute("VACUUM;")
+        finally:
+            db3.isolation_level = isolation_level
+
+    def db_incremental_vacuum (self, db3, step_pages=64):
+        isolation_level = db3.isolation_level
+        try:
+            db3.isolation_level = None
+            free = db3.execute("PRAGMA freelist_count;").fetchone()[0]
+            while free > 0:
+                db3.executescript("PRAGMA incremental_vacuum({});".format(int(step_pages)))
+                left = db3.execute("PRAGMA freelist_count;").fetchone()[0]
+                if left >= free: break
+                free = left
+        finally:
+            db3.isolation_level = isolation_level
 
-    def replication_health(self, avg_win=7, sample_limit=21, result_limit=3):
+
+    """
+    store one lag sample per replica of the current snapshot (and its rollups)
+    """
+    def replication_lag_record (self, cur, stamp):
         mxlog = self.master_xlog_location()
-        rdlt = self.to_tuple(self.replica_received_replayed())
-        if rdlt is None: return False
-        assert result_limit < sample_limit
+        if mxlog is None: return
+        rows = []
+        for received, replayed, replayed_timestamp, replica in self.replica_received_replayed():
+            byte_lag = mxlog - replayed
+            time_lag = 0
+            if byte_lag > 0 and replayed_timestamp:
+                time_lag = max(stamp - self.replayed_epoch(replayed_timestamp), 0)
+            elif byte_lag > 0:
+                time_lag = None
+            rows.append((replica, stamp, received, replayed, byte_lag, time_lag))
+        cur.executemany("""
+        insert or replace into replication_lag (replica, stamp, received, replayed, byte_lag, time_lag)
+        values (?, ?, ?, ?, ?, ?);
+        """, rows)
+        cur.executemany("""
+        insert into replication_lag_rollup
+        (replica, tier, bucket, byte_lag_min, byte_lag_max, byte_lag_avg, time_lag_max,
+         replayed_min, replayed_max, samples)
+        values (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+        on conflict (replica, tier, bucket) do update set
+        byte_lag_min = min (byte_lag_min, excluded.byte_lag_min),
+        byte_lag_max = max (byte_lag_max, excluded.byte_lag_max),
+        byte_lag_avg = (byte_lag_avg * samples + excluded.byte_lag_avg) / (samples + 1),
+        time_lag_max = max (coalesce (time_lag_max, 0), coalesce (excluded.time_lag_max, 0)),
+        replayed_min = min (replayed_min, excluded.replayed_min),
+        replayed_max = max (replayed_max, excluded.replayed_max),
+        samples = samples + 1;
+        """, [(r[0], tier, stamp - stamp % tier, r[4], r[4], r[4], r[5], r[3], r[3])
+              for r in rows for tier in self.lag_rollup_tiers])
+
+    """
+    lag trend of replica over the last window seconds:
+    growth_rate: byte lag slope (bytes/s, least squares), > 0 the replica fall behind
+    apply_rate: replayed bytes/s
+    catch_up_in: seconds to replay the current lag at the current apply rate (None: stalled)
+    healthy: no lag, or the lag projected max_catch_up seconds ahead at the current growth rate
+    can be replayed within max_catch_up seconds at the current apply rate.
+    None (unknown) with a lag and less than 3 samples
+    """
+    def replication_lag_trend (self, cur, replica, stamp, window=300, max_catch_up=600):
+        cur.execute("""
+        select stamp, replayed, byte_lag, time_lag from replication_lag
+        where replica = ? and stamp > ? order by stamp;
+        """, (replica, stamp - window))
+        rows = cur.fetchall()
+        last = rows[-1]
+        result = {'replica': replica, 'stamp': last[0], 'byte_lag': last[2], 'time_lag': last[3],
+                  'growth_rate': None, 'apply_rate': None, 'catch_up_in': 0 if last[2] == 0 else None,
+                  'samples': len(rows), 'healthy': True if last[2] == 0 else None}
+        if len(rows) < 3 or rows[-1][0] == rows[0][0]: return result
+        n = len(rows)
+        t_avg = sum([r[0] for r in rows]) / n
+        l_avg = sum([r[2] for r in rows]) / n
+        var = sum([(r[0] - t_avg) ** 2 for r in rows])
+        growth = sum([(r[0] - t_avg) * (r[2] - l_avg) for r in rows]) / var
+        apply = (rows[-1][1] - rows[0][1]) / (rows[-1][0] - rows[0][0])
+        result['growth_rate'] = growth
+        result['apply_rate'] = apply
+        if last[2] == 0: return result
+        result['catch_up_in'] = last[2] / apply if apply > 0 else None
+        projected = last[2] + max(growth, 0) * max_catch_up
+        result['healthy'] = apply > 0 and projected / apply <= max_catch_up
+        return result
+
+    """
+    record a lag sample and return the trend of each replica (cf: replication_lag_trend),
+    computed once per snapshot
+    """
+    def replication_lag(self, window=300, max_catch_up=600):
+        state = self.snapshot()
+        if self.lag and self.lag[0] is state and self.lag[1] == (window, max_catch_up):
+            return self.lag[2]
+        result = []
+        if self.replica_received_replayed() and self.master_xlog_location() is None:
+            # no master location to measure the lag against, the replicas are not healthy
+            result = [{'replica': r[3], 'stamp': int(time.time()), 'byte_lag': None, 'time_lag': None,
+                       'growth_rate': None, 'apply_rate': None, 'catch_up_in': None, 'samples': 0,
+                       'healthy': False} for r in self.replica_received_replayed()]
+        elif self.replica_received_replayed():
+            self.db_create()
+            self.db_cleanup()
+            stamp = int(time.time())
+            with PersistenceSQL3(database=self.database) as db3:
+                try:
+                    cur = db3.cursor()
+                    self.replication_lag_record (cur, stamp)
+                    for r in self.replica_received_replayed():
+                        result.append(self.replication_lag_trend (cur, r[3], stamp, window, max_catch_up))
+                except:
+                    raise
+                else:
+                    db3.commit()
+        self.lag = (state, (window, max_catch_up), result)
+        return result
+
+    """
+    [(replica, stamp, byte_lag_min, byte_lag_max, byte_lag_avg, time_lag_max)] over the last past seconds,
+    from the raw samples or the smallest rollup tier covering past
+    """
+    def replication_lag_history(self, replica=None, past=3600):
         self.db_create()
-        self.db_cleanup()
+        since = int(time.time()) - past
         with PersistenceSQL3(database=self.database) as db3:
-            db3.row_factory = sqlite3.Row
-            try:
-                rstamp = time.mktime(time.gmtime(0))
-                if rdlt[2]:
-                    rstamp = time.mktime(time.strptime(rdlt[2], "%Y-%m-%d %H:%M:%S.%f%z"))
-                cur = db3.cursor()
-                cur.execute(
-                    "select id, received, replayed, rstamp from replication_log order by id desc limit 1;")
-                r = cur.fetchone()
-                if r and (r["received"] == mxlog or r["replayed"] == mxlog):
-                    # convergence to xlog reached
-                    pass
-                else:
-                    cur.execute(
-                        "insert into replication_log(received, replayed, rstamp ) values (?,?,?)",
-                        (rdlt[0], rdlt[1], rstamp))
+            cur = db3.cursor()
+            if past <= self.lag_raw_ttl:
                 cur.execute("""
-                SELECT id, avg (received) OVER (order by id ROWS BETWEEN ? PRECEDING AND CURRENT ROW) as
-                moving_avg from replication_log where id in
-                (select id from replication_log order by id DESC limit ?) order by id DESC limit ?;""",
-                            [avg_win, sample_limit, result_limit])
-                r = cur.fetchall()
-                health=False
-                if len (r) >= 3:
-                    health = not (all ([r[0]["moving_avg"] == x["moving_avg"] for x in r[1:]]))
-            except:
-                raise
+                select replica, stamp, byte_lag, byte_lag, byte_lag, time_lag from replication_lag
+                where (? is null or replica = ?) and stamp >= ? order by replica, stamp;
+                """, (replica, replica, since))
             else:
-                db3.commit()
-                return health
+                tiers = sorted(self.lag_rollup_tiers.items())
+                tier = ([t for t, keep in tiers if keep >= past] + [tiers[-1][0]])[0]
+                cur.execute("""
+                select replica, bucket, byte_lag_min, byte_lag_max, byte_lag_avg, time_lag_max
+                from replication_lag_rollup
+                where tier = ? and (? is null or replica = ?) and bucket >= ? order by replica, bucket;
+                """, (tier, replica, replica, since - tier))
+            return cur.fetchall()
+
+    def replication_health(self, window=300, max_catch_up=600):
+        lag = self.replication_lag(window, max_catch_up)
+        return bool(lag) and all([r['healthy'] == True for r in lag])
 
 class DiskFreeService(ClusterService):
 
@@ -381,29 +598,15 @@ class DiskFreeService(ClusterService):
     """
     return [{'node': n, 'error': False}] if all ok
     or [{'node': n, 'error': True, 'urls': l}] with l pointing to the plot to check
+    and/or 'forecast': f, the mount points expected to be full within the /dfm horizon
     """
-    def node_check (self, alias_monitor="/dfm", alias_plot="/dfp", use_ssl=False):
+    def node_check (self, alias_monitor="/dfm", alias_plot="/dfp", use_ssl=False, deadline=None):
         result=[]
-        retry_max=6
         url_prefix='https://' if use_ssl else 'http://'
-        for c in [i for i in self.urls if i.startswith(url_prefix)]:
-            retry_count=0
-            rj = None
-            for i in range(retry_max):
-                try:
-                    retry_count += 1
-                    r = requests.get("{}{}".format(c, alias_monitor), timeout=(9.0, 10.0)) # (connect, read)
-                    rj = r.json()
-                except (requests.exceptions.ReadTimeout, requests.exceptions.Timeout) as te:
-                    sleep(1)
-                    continue
-                except requests.exceptions.ConnectionError:
-                    sleep(1)
-                    continue
-                except:
-                    raise
-                else:
-                    break
+        urls = [i for i in self.urls if i.startswith(url_prefix)]
+        # all the nodes at once within deadline, a node without reply is in error
+        replies = self.fetch_first ([[c] for c in urls], alias_monitor.lstrip('/'), deadline=deadline)
+        for c, rj in zip (urls, replies):
             try:
                 p = [n for n in self.df_peers if n in c][0]
                 assert 'df' in rj
@@ -416,13 +619,59 @@ class DiskFreeService(ClusterService):
                     l = []
                     for i in rj['df']['result']:
                         l.append("{}{}?m={}&pivot={}&delta={}".format(c, alias_plot, i[0], i[1], int(i[2])))
-                    if l: result.append ({'node': p, 'error': True, 'urls': l})
+                    f = [i for i in rj['df'].get('forecast', []) if i.get('alert')]
+                    if l or f:
+                        e = {'node': p, 'error': True}
+                        if l: e['urls'] = l
+                        if f: e['forecast'] = f
+                        result.append (e)
                 except Exception as e:
                     result.append ({'node': p, 'error': True})
                 else:
-                    if l == []: result.append ({'node': p, 'error': False})
+                    if l == [] and f == []: result.append ({'node': p, 'error': False})
         return result
 
+    """
+    per mount summary of one node (/dfm?summary)
+    """
+    def node_summary (self, url, alias_monitor="/dfm", horizon=21600, timeout=(2.0, 5.0)):
+        r = self._session().get("{}{}?summary=1&horizon={}".format(url, alias_monitor, int(horizon)),
+                                timeout=timeout) # (connect, read)
+        rj = r.json()
+        assert 'df' in rj
+        assert rj['df']['error'] == False
+        assert 'summary' in rj['df']
+        return rj['df']['summary']
+
+    """
+    fetch the summary of all the nodes concurrently and merge them:
+    {'stamp': s, 'error': e, 'nodes': [{'node': n, 'error': e, 'mounts': [...],
+      'headroom_mb': lowest mount headroom, 'full_in': soonest mount exhaustion}]}
+    an unreachable node is reported {'node': n, 'error': True, 'reason': r}
+    """
+    def cluster_summary (self, alias_monitor="/dfm", use_ssl=False, horizon=21600, timeout=(2.0, 5.0)):
+        url_prefix='https://' if use_ssl else 'http://'
+        urls = [i for i in self.urls if i.startswith(url_prefix)]
+        nodes = []
+        pool = self._pool()
+        futures = [(c, pool.submit(self.node_summary, c, alias_monitor, horizon, timeout)) for c in urls]
+        for c, f in futures:
+            p = [n for n in self.df_peers if n in c][0]
+            try:
+                mounts = f.result()
+            except Exception as e:
+                nodes.append ({'node': p, 'error': True, 'reason': str(e)})
+                continue
+            headroom = [m['headroom_mb'] for m in mounts if m.get('headroom_mb') is not None]
+            full_in = [m[k] for m in mounts for k in ('space_full_in', 'inodes_full_in')
+                       if m.get(k) is not None]
+            nodes.append ({'node': p,
+                           'error': any([m.get('alert') for m in mounts]),
+                           'mounts': mounts,
+                           'headroom_mb': min(headroom) if headroom else None,
+                           'full_in': min(full_in) if full_in else None})
+        return {'stamp': time.time(), 'error': any([n['error'] for n in nodes]), 'nodes': nodes}
+
     def is_healthy(self, df=None):
         df = df if df else self.node_check()
         for i in df:
@@ -431,6 +680,134 @@ class DiskFreeService(ClusterService):
             if i['error'] == True: return False
         return True
 
+"""
+the cluster state rendered by the health pages
+"""
+ClusterState = namedtuple('ClusterState', [
+    'stamp',
+    'etcd_healthy', 'etcd_health',
+    'patroni_healthy', 'patroni_health', 'patroni_dump',
+    'patroni_members', 'patroni_replica_delta', 'patroni_requests', 'patroni_replication',
+    'df_healthy', 'df_health'])
+
+def cluster_collect ():
+    etcd=EtcdService()
+    etcd_health=etcd.cluster_health()
+    etcd_healthy=bool(etcd_health) and all([c[1] for c in etcd_health])
+
+    patroni=PatroniService()
+    state=patroni.refresh()
+    patroni_health=[
+        ("have master", patroni.has_master()),
+        ("have replica", patroni.has_replica()),
+        ("match config",patroni.match_config()),
+        ("replayed delta", patroni.replica_received_replayed_delta_ok()),
+        ("timeline match", patroni.timeline_match()),
+        ("replication health", patroni.replication_health())]
+    patroni_healthy=all([n[1] == True for n in patroni_health])
+    patroni_members=tuple([{'member': n.api_url, 'role': n.role, 'state': n.state, 'timeline': n.timeline}
+                           for n in state.members])
+    patroni_replica_delta=tuple(patroni.replica_received_replayed_delta())
+
+    df=DiskFreeService()
+    df_health=df.node_check()
+    df_healthy=df.is_healthy(df_health)
+
+    return ClusterState(stamp=time.time(),
+                        etcd_healthy=etcd_healthy, etcd_health=tuple(etcd_health),
+                        patroni_healthy=patroni_healthy, patroni_health=tuple(patroni_health),
+                        patroni_dump=patroni.dump(),
+                        patroni_members=patroni_members, patroni_replica_delta=patroni_replica_delta,
+                        patroni_requests=state.requests,
+                        patroni_replication=tuple(patroni.replication_lag()),
+                        df_healthy=df_healthy, df_health=tuple(df_health))
+
+"""
+keep the last result of collect() for the request handlers
+
+a daemon thread, started by the first get(), call collect every interval seconds and
+stop after idle seconds without get(). get() return (snapshot, age):
+ - the last snapshot as long as it is younger than max_age, even if a refresh is due
+   (stale while revalidate, the thread does the refresh)
+ - otherwise it wait up to timeout for the running refresh or do it, only one collect
+   run at a time (single flight)
+ - (None, age) when no collect succeeded within max_age (age None if none ever did),
+   a failing collect never extend the life of the last snapshot.
+   last_error hold the reason of the last failed collect (None after a success)
+"""
+class SnapshotCollector(object):
+    def __init__(self, collect, interval=5.0, max_age=60.0, idle=300.0):
+        self.collect = collect
+        self.interval = interval
+        self.max_age = max_age
+        self.idle = idle
+        self.snapshot = None
+        self.stamp = None
+        self.last_get = None
+        self.refreshing = False
+        self.thread = None
+        self.cond = threading.Condition()
+        self.collect_count = 0
+        self.error_count = 0
+        self.last_error = None
+        self.last_error_stamp = None
+
+    def _refresh (self):
+        result = None
+        error = "no result"
+        try:
+            result = self.collect()
+        except Exception as e:
+            error = "{}: {}".format(e.__class__.__name__, str(e))
+            print ("snapshot collect: {}".format(error), file=stderr)
+        finally:
+            with self.cond:
+                self.collect_count += 1
+                if result is None:
+                    self.error_count += 1
+                    self.last_error = error
+                    self.last_error_stamp = time.time()
+                else:
+                    self.snapshot = result
+                    self.stamp = time.monotonic()
+                    self.last_error = None
+                self.refreshing = False
+                self.cond.notify_all()
+
+    def _run (self):
+        while True:
+            with self.cond:
+                if time.monotonic() - self.last_get > self.idle:
+                    self.thread = None
+                    return
+                start = not self.refreshing
+                self.refreshing = True
+            if start: self._refresh()
+            time.sleep(self.interval)
+
+    def _age (self):
+        return None if self.stamp is None else time.monotonic() - self.stamp
+
+    def get (self, timeout=10.0):
+        with self.cond:
+            self.last_get = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='patt_snapshot', daemon=True)
+                self.thread.start()
+            if self.snapshot is not None and self._age() < self.max_age:
+                return (self.snapshot, self._age())
+            run = not self.refreshing
+            self.refreshing = True
+        if run: self._refresh()
+        with self.cond:
+            self.cond.wait_for(lambda: not self.refreshing, timeout)
+            if self.snapshot is None or self._age() >= self.max_age:
+                return (None, self._age())
+            return (self.snapshot, self._age())
+
+# one collector per process, shared by the health wsgi
+cluster_snapshot = SnapshotCollector(cluster_collect)
+
 
 if __name__ == "__main__":
     import argparse
@@ -439,6 +816,8 @@ if __name__ == "__main__":
     parser.add_argument('-v','--verbose', help='verbose', action='store_true', required=False)
     parser.add_argument('-vv','--verbose2', help='more verbose', action='store_true', required=False)
     parser.add_argument('-x', '--exclude',  help='exclude checks', action='append', required=False)
+    parser.add_argument('-l', '--lag_history', help='print the replication lag of the last n seconds',
+                        type=int, required=False)
     args = parser.parse_args()
     exclude=[]
     if args.exclude and 'etcd' in args.exclude:
@@ -450,6 +829,12 @@ if __name__ == "__main__":
     if args.verbose2:
         args.verbose = True
 
+    if args.lag_history:
+        # replica, stamp, byte_lag_min, byte_lag_max, byte_lag_avg, time_lag_max
+        for r in PatroniService().replication_lag_history(past=args.lag_history):
+            print (", ".join([str(i) for i in r]))
+        sys_exit(0)
+
     status=[]
 
     if 'etcd' not in exclude:
@@ -464,7 +849,6 @@ if __name__ == "__main__":
 
     if 'patroni' not in exclude:
         patroni=PatroniService()
-        patroni.get_info()
         patroni_healthy=all([n == True for n in [
             patroni.has_master(), patroni.has_replica(), patroni.match_config(),
             patroni.replica_received_replayed_delta_ok(), patroni.timeline_match(),
@@ -482,8 +866,10 @@ if __name__ == "__main__":
                     patroni.replica_received_replayed_delta()))
                 print ("timeline_ok         : {}".format (patroni.timeline_match()))
                 print ("replication_health  : {}".format (patroni.replication_health()))
+                print ("replication lag     :\n{}".format (pp_string(patroni.replication_lag())))
             if args.verbose2 or not patroni_healthy:
                 print ("patroni dump:\n {}".format (patroni.dump()))
+                print ("patroni http requests: {}/{}".format (patroni.snapshot().requests, patroni.max_requests))
 
     if 'df' not in exclude:
         df = DiskFreeService()
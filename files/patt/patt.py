@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
 import os, sys
-from multiprocessing import Pool
+import io
+import shlex
+import hashlib
+import tarfile
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+import threading
 import logging
 
 logger = logging.getLogger('patt')
@@ -24,6 +32,16 @@ except ModuleNotFoundError:
     sys.path.insert(0, os.path.dirname(os.path.abspath( __file__ )) + '/ssh')
     import ssh_client
 
+import patt_trace
+
+"""
+process wide ssh connection pool, one authenticated transport per
+(login, hostname, port, keyfile) reused by every exec and sftp call
+"""
+ssh_pool = ssh_client.ssh_pool()
+ssh_pool.on_connect = lambda hostname, start, stop: patt_trace.add (
+    'connect', start, stop, cat='ssh', host=hostname)
+
 class Resp:
     def __init__(self):
         self.hostname = None
@@ -69,7 +87,6 @@ class Node:
         self.port = None
         self.id = None
         self.ip_aliases = []
-        self.user_object = []
         # embedded user param
         (self.login, self.hostname, self.port) = ssh_client._ipv6_nri_split(ssh_uri)
         if self.login == '' and default_login:
@@ -80,13 +97,19 @@ class Node:
             self.port = default_port
         self.keyfile = default_keyfile
 
+    """
+    return the pooled ssh client for this node (connect on first use)
+    """
+    def _ssh_client (self, timeout=None):
+        return ssh_pool.get (self.hostname, login=self.login, port=self.port,
+                             keyfile=self.keyfile, timeout=timeout)
+
     """
     check connectivity and if we can run sudo command
     """
     def _check_priv (self):
-        clt = ssh_client.ssh_client (self.hostname, port=self.port, login=self.login, keyfile=self.keyfile)
         try:
-            clt.open(timeout=10)
+            clt = self._ssh_client(timeout=10)
             result = clt.exec ('sudo id -u')
             r = Resp()
             r.hostname = self.hostname
@@ -100,8 +123,6 @@ class Node:
             logger.error ("_check_priv ({})".format(self.hostname))
             logger.error (str(e))
             return None
-        finally:
-            clt.close()
 
     """
     host_id
@@ -109,9 +130,7 @@ class Node:
     """
     def _host_id (self):
         try:
-            clt = ssh_client.ssh_client (
-                self.hostname, port=self.port, login=self.login, keyfile=self.keyfile)
-            clt.open(timeout=10)
+            clt = self._ssh_client(timeout=10)
             # result = clt.exec ('hostid')
             result = clt.exec ('cat /etc/machine-id')
             if result.status == 0:
@@ -122,8 +141,6 @@ class Node:
         except Exception as e:
             logger.error ("_get_id ({})".format(self.hostname))
             logger.error (str(e))
-        finally:
-            clt.close()
 
     """
     host_ip_aliases
@@ -131,9 +148,7 @@ class Node:
     """
     def _host_ip_aliases (self):
         try:
-            clt = ssh_client.ssh_client (
-                self.hostname, port=self.port, login=self.login, keyfile=self.keyfile)
-            clt.open(timeout=10)
+            clt = self._ssh_client(timeout=10)
             result = clt.exec (
                 "/sbin/ip -br -6 a show to 2000::/3 | sed 's|[[:space:]]\+| |g' | cut -d' ' -f 3- ")
             if result.status == 0:
@@ -143,59 +158,95 @@ class Node:
         except Exception as e:
             logger.error ("_host_ip_aliases ({})".format(self.hostname))
             logger.error (str(e))
-        finally:
-            clt.close()
+
+    """
+    gather the host facts in a single exec and keep them in the run fact cache
+    """
+    def _gather_facts (self):
+        try:
+            clt = self._ssh_client(timeout=10)
+            with patt_trace.span ('facts', cat='ssh', host=self.hostname):
+                result = clt.exec (facts_cmd)
+            if result.status != 0:
+                logger.error ("_gather_facts ({}) {}".format(self.hostname, result.stderr.read().decode()))
+                return None
+            f = parse_facts (result.stdout.read().decode(), self.hostname)
+            if not f['id'] or int (f['id'], 16) == 0:
+                logger.error ("_gather_facts ({}) id == 0!".format(self.hostname))
+                return None
+            f['stamp'] = time.time()
+            facts_set (self, f)
+            return f
+        except Exception as e:
+            logger.error ("_gather_facts ({})".format(self.hostname))
+            logger.error (str(e))
+            return None
+
+    """
+    set id and ip_aliases from the fact cache, return False if the host is unknown
+    """
+    def _apply_facts (self):
+        f = facts_get (self)
+        if not f: return False
+        self.id = f['id']
+        self.ip_aliases = list(f['ip_aliases'])
+        return True
 
     """
     exec script
+    bundle: stream script and payload in one exec channel (default exec_bundle)
+    hide_stdout: the script output secrets, its stdout lines are not logged nor streamed
     """
-    def _exec_script (self):
-        src      = self.user_object[0]
-        sudo     = self.user_object[1]
-        payload  = self.user_object[2]
-        args     = self.user_object[3]
-        log_call = self.user_object[4]
+    def _exec_script (self, src, sudo=True, payload=None, args=[], log_call=True, bundle=None,
+                      hide_stdout=False):
         if log_call:
-            logger.info ("{} -> {}".format (self.hostname, self.user_object))
+            logger.info ("{} -> {}".format (self.hostname, [src, sudo, payload, args, log_call]))
+        if bundle is None:
+            bundle = exec_bundle
+        if bundle:
+            return self._exec_bundle (src, sudo, payload, args, hide_stdout)
         try:
             r = Resp()
-            clt = ssh_client.ssh_client (
-                self.hostname, port=self.port, login=self.login, keyfile=self.keyfile)
-            clt.open(timeout=None)
-            rscript = clt.mktemp_send_file (src, 0o700)
-
-            if rscript and payload:
-                remote_d = os.path.dirname (rscript)
-                sftp = clt.new_sftp()
-                if isinstance(payload, list):
-                    for p in payload:
-                        local_p = os.path.abspath (p)
-                        sftp.put (local_p, remote_d + '/' + os.path.basename (local_p))
-                else:
-                    local_p = os.path.abspath (payload)
-                    sftp.put (local_p, remote_d + '/' + os.path.basename (local_p))
+            clt = self._ssh_client()
+            with patt_trace.span ('upload', cat='ssh', host=self.hostname, script=src) as sp:
+                rscript = clt.mktemp_send_file (src, 0o700)
+                sp.args['bytes'] = os.path.getsize (src)
+
+                if rscript and payload:
+                    remote_d = os.path.dirname (rscript)
+                    sftp = clt.new_sftp()
+                    try:
+                        for p in payload if isinstance(payload, list) else [payload]:
+                            local_p = os.path.abspath (p)
+                            sftp.put (local_p, remote_d + '/' + os.path.basename (local_p))
+                            sp.args['bytes'] += os.path.getsize (local_p)
+                    finally:
+                        sftp.close()
 
             args = ' '.join (str(e) for e in args)
             if sudo:
                 sudo='sudo '
             else:
                 sudo=''
-            result = clt.exec (sudo + rscript + ' ' + args)
+            with patt_trace.span ('exec', cat='ssh', host=self.hostname, script=src) as sp:
+                result = clt.exec (sudo + rscript + ' ' + args)
+                sp.args['status'] = result.status
             r.hostname = self.hostname
             if self.id: r.id = self.id
             try:
-                if rscript:
-                    tmp_clean = clt.exec (sudo + '/usr/bin/rm -f' + ' ' + rscript)
-                if isinstance(payload, list):
-                    for p in payload:
+                with patt_trace.span ('cleanup', cat='ssh', host=self.hostname, script=src):
+                    if rscript:
+                        tmp_clean = clt.exec (sudo + '/usr/bin/rm -f' + ' ' + rscript)
+                    if isinstance(payload, list):
+                        for p in payload:
+                            tmp_clean = clt.exec (sudo + '/usr/bin/rm -f' + ' ' +
+                                                  os.path.dirname (rscript) + '/' + os.path.basename (p))
+                    elif payload:
                         tmp_clean = clt.exec (sudo + '/usr/bin/rm -f' + ' ' +
-                                              os.path.dirname (rscript) + '/' + os.path.basename (p))
-                elif payload:
-                    tmp_clean = clt.exec (sudo + '/usr/bin/rm -f' + ' ' +
-                                          os.path.dirname (rscript) + '/' + os.path.basename (payload))
-                if rscript:
-                    tmp_clean = clt.exec (sudo + '/usr/bin/rmdir --ignore-fail-on-non-empty ' +
-                                          os.path.dirname (rscript))
+                                              os.path.dirname (rscript) + '/' + os.path.basename (payload))
+                    if rscript:
+                        tmp_clean = clt.exec (sudo + '/usr/bin/rmdir --ignore-fail-on-non-empty ' +
+                                              os.path.dirname (rscript))
             except:
                 pass
             else:
@@ -211,8 +262,235 @@ class Node:
             logger.error ("stderr: {}".format (r.error))
             logger.error (str(e))
             raise
-        finally:
-            clt.close()
+
+    """
+    exec script in a single round trip:
+    script and payload are sent as a tar stream on the stdin of one exec channel,
+    unpacked into a private tmpfs dir (fallback to mktemp default), run and
+    cleaned up on exit by a trap.
+    with exec_cache, files from the patt tree already in the remote blob cache
+    are not sent but copied from the cache on the remote side.
+    """
+    def _exec_bundle (self, src, sudo=True, payload=None, args=[], hide_stdout=False):
+        try:
+            for i in range(2):
+                started = self._bundle_start (src, sudo, payload, args)
+                for hostname, stream, line in ssh_client.multiplex ([started[0]]):
+                    exec_line (hostname, stream, line, hide_stdout)
+                self._bundle_trace (src, started[0])
+                if self._bundle_done (*started):
+                    break
+            return self._bundle_resp (started[0])
+        except Exception as e:
+            logger.error ("hostname: {}".format(self.hostname))
+            logger.error (str(e))
+            raise
+
+    """
+    send the bundle and start the script without waiting for its end,
+    return (exec_stream, cached, store)
+    """
+    def _bundle_start (self, src, sudo=True, payload=None, args=[]):
+        clt = self._ssh_client()
+        with patt_trace.span ('upload', cat='ssh', host=self.hostname, script=src) as sp:
+            files = bundle_files (src, payload)
+            blobs = {}
+            if exec_cache:
+                blobs = {f[1]: file_sha256 (f[0]) for f in files if cacheable (f[0])}
+                self._cache_lookup (clt, blobs.values())
+            known = remote_blobs (self)
+            cached = {n: h for n, h in blobs.items() if h in known}
+            store = {n: h for n, h in blobs.items() if n not in cached}
+            data = bundle_tar (files, skip=cached.keys())
+            stream = clt.exec_start (bundle_cmd (os.path.basename (src), sudo, args,
+                                                 cached=cached, store=store), data)
+            sp.args.update ({'bytes': len(data), 'cached': len(cached), 'stored': len(store)})
+        return (stream, cached, store)
+
+    """
+    record the exec span of a bundle (the remote cleanup run in the same exec)
+    """
+    def _bundle_trace (self, src, stream):
+        patt_trace.add ('exec', stream.start, stream.stop if stream.stop else time.monotonic(),
+                        cat='ssh', host=self.hostname, script=src, status=stream.status,
+                        stdout_bytes=len(stream.stdout), stderr_bytes=len(stream.stderr),
+                        timed_out=stream.timed_out)
+
+    """
+    update the known remote blobs once the script is done,
+    return False on cache miss (blobs evicted since lookup, the bundle must be sent again)
+    """
+    def _bundle_done (self, stream, cached, store):
+        known = remote_blobs (self)
+        if stream.status == cache_miss_status and stream.stderr.decode().startswith(cache_miss_marker):
+            logger.warning ("{} {}".format(self.hostname, stream.stderr.decode().strip()))
+            known.difference_update (cached.values())
+            return False
+        known.update (store.values())
+        return True
+
+    def _bundle_resp (self, stream):
+        r = Resp()
+        r.hostname = self.hostname
+        if self.id: r.id = self.id
+        if stream.status == 0:
+            r.out = stream.stdout.decode().strip()
+        else:
+            r.error = stream.stderr.decode()
+        return r
+
+    """
+    query the remote blob cache in one exec for the hashes not already known
+    """
+    def _cache_lookup (self, clt, hashes):
+        known = remote_blobs (self)
+        unknown = sorted (set(hashes) - known)
+        if not unknown:
+            return
+        with patt_trace.span ('cache_lookup', cat='ssh', host=self.hostname, hashes=len(unknown)):
+            result = clt.exec ("/bin/bash -c " + shlex.quote (
+                'cd {} 2> /dev/null && ls -1 -- {} 2> /dev/null ; true'.format (
+                    cache_dir, ' '.join (unknown))))
+        if result.status == 0:
+            known.update ([h for h in result.stdout.read().decode().split() if h in unknown])
+
+"""
+remote content addressed cache, relative to the ssh login home directory.
+files from the patt tree are stored by sha256 and evicted LRU when the
+cache grow over cache_max_kb.
+"""
+exec_cache = True
+cache_dir = '.cache/patt/blobs'
+cache_max_kb = 65536
+cache_miss_status = 75
+cache_miss_marker = 'patt cache miss'
+_patt_dir = os.path.dirname (os.path.abspath (__file__))
+_remote_blobs = {}
+_local_sha256 = {}
+_cache_lock = threading.Lock()
+
+def set_exec_cache (flag, max_kb=None):
+    global exec_cache, cache_max_kb
+    exec_cache = bool(flag)
+    if max_kb:
+        cache_max_kb = int(max_kb)
+
+"""
+only the files shipped with patt are cached, never generated or secret payload
+"""
+def cacheable (path):
+    return os.path.realpath (path).startswith (_patt_dir + os.sep)
+
+def file_sha256 (path):
+    st = os.stat (path)
+    key = (os.path.realpath (path), st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        if key in _local_sha256:
+            return _local_sha256[key]
+    h = hashlib.sha256()
+    with open (path, 'rb') as f:
+        for chunk in iter (lambda: f.read(65536), b''):
+            h.update (chunk)
+    with _cache_lock:
+        _local_sha256[key] = h.hexdigest()
+    return _local_sha256[key]
+
+"""
+sha256 of the patt tree (scripts, templates and modules) as shipped,
+used to detect any change in what a run would deploy
+"""
+def tree_sha256 (top=None):
+    top = top if top else _patt_dir
+    h = hashlib.sha256()
+    for d, dirs, files in os.walk (top):
+        dirs[:] = sorted ([i for i in dirs if i != '__pycache__' and not i.startswith('.')])
+        for f in sorted (files):
+            if f.startswith('.') or f.endswith('.pyc'): continue
+            path = os.path.join (d, f)
+            if not os.path.isfile (path): continue
+            h.update (os.path.relpath (path, top).encode())
+            h.update (file_sha256 (path).encode())
+    return h.hexdigest()
+
+"""
+the set of blob hashes known to be in the remote cache of the node host
+"""
+def remote_blobs (node):
+    with _cache_lock:
+        return _remote_blobs.setdefault ((node.login, node.hostname, node.port), set())
+
+"""
+return [(local_abs_path, arcname, mode)] for the payload files followed by the script
+"""
+def bundle_files (src, payload=None):
+    if payload is None:
+        payload = []
+    elif not isinstance(payload, list):
+        payload = [payload]
+    result = [(os.path.abspath (p), os.path.basename (os.path.abspath (p)), None) for p in payload if p]
+    result.append ((os.path.abspath (src), os.path.basename (src), 0o700))
+    return result
+
+"""
+return the gzip tar stream (bytes) holding files, arcname in skip are left out
+"""
+def bundle_tar (files, skip=[]):
+    def reset_owner (ti):
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = ''
+        return ti
+
+    buf = io.BytesIO()
+    with tarfile.open (fileobj=buf, mode='w:gz') as tar:
+        for local_p, arcname, mode in files:
+            if arcname in skip:
+                continue
+            ti = reset_owner (tar.gettarinfo (local_p, arcname=arcname))
+            if mode is not None:
+                ti.mode = mode
+            with open (local_p, 'rb') as f:
+                tar.addfile (ti, f)
+    return buf.getvalue()
+
+"""
+return the remote command unpacking the bundle read from stdin and running script_name
+cached: {arcname: sha256} to copy from the remote cache
+store:  {arcname: sha256} to add into the remote cache once unpacked
+"""
+def bundle_cmd (script_name, sudo=True, args=[], cached={}, store={}):
+    sudo = 'sudo ' if sudo else ''
+    args = ' '.join (str(e) for e in args)
+    cache = ""
+    if cached or store:
+        cache = """
+c="${{HOME}}/{cache_dir}"
+test -d "${{c}}" || mkdir -p -m 700 "${{c}}"
+for i in {cached} ; do
+  test -f "${{c}}/${{i%%/*}}" || {{ echo "{marker} ${{i%%/*}}" >&2 ; exit {miss} ; }}
+  cp -f "${{c}}/${{i%%/*}}" "${{d}}/${{i#*/}}" && touch "${{c}}/${{i%%/*}}"
+done
+for i in {store} ; do
+  cp -f "${{d}}/${{i#*/}}" "${{c}}/${{i%%/*}}.$$" && mv -f "${{c}}/${{i%%/*}}.$$" "${{c}}/${{i%%/*}}"
+done
+test "$(du -sk "${{c}}" | cut -f1)" -le {max_kb} || ls -1tr "${{c}}" | while read i ; do
+  rm -f "${{c}}/${{i}}"
+  test "$(du -sk "${{c}}" | cut -f1)" -gt {max_kb} || break
+done
+chmod 700 "${{d}}"/{script}
+""".format(cache_dir=cache_dir, marker=cache_miss_marker, miss=cache_miss_status, max_kb=cache_max_kb,
+           script=shlex.quote (script_name),
+           cached=' '.join (shlex.quote (h + '/' + n) for n, h in cached.items()),
+           store=' '.join (shlex.quote (h + '/' + n) for n, h in store.items()))
+    wrapper = """
+d=""
+grep -qs '^[^ ]* /dev/shm [^ ]* [^ ]*noexec' /proc/mounts || d=$(mktemp -d -p /dev/shm 2> /dev/null) || d=""
+test -n "${{d}}" || d=$(mktemp -d) || exit 1
+trap '{sudo}/usr/bin/rm -rf "${{d}}"' EXIT
+tar -x -z -m --no-same-owner -C "${{d}}" || exit 1
+{cache}
+{sudo}"${{d}}"/{script} {args}
+""".format(sudo=sudo, script=shlex.quote (script_name), args=args, cache=cache)
+    return '/bin/bash -c ' + shlex.quote (wrapper)
 
 """
 convenient way to build a list of Node (Class Object)
@@ -221,54 +499,213 @@ def to_nodes (nodes=[], default_login=None, default_keyfile=None):
     result = [Node (n, default_login, default_keyfile) for n in nodes]
     return result
 
-def check_priv (nodes):
-    with Pool(len(nodes)) as pool:
-        try:
-            results = [pool.map_async (Node._check_priv, (n for n in nodes))]
-            for r in results:
-                return r.get(timeout=10)
-        except:
-            raise
+"""
+when True, exec_script default to the single round trip bundle mode
+otherwise the script and payload are sent via sftp and cleaned up one by one
+"""
+exec_bundle = True
 
-def _host_id_ref (n):
-    if n.id:
-        return n
-    n._host_id()
-    return n
+def set_exec_bundle (flag):
+    global exec_bundle
+    exec_bundle = bool(flag)
 
-def host_id (nodes):
-    with Pool(len(nodes)) as pool:
-        try:
-            results = [pool.map_async (_host_id_ref, nodes)]
-            for r in results:
-                for i in r.get(timeout=10):
-                    for idx, item in enumerate(nodes):
-                        if i.hostname in item.hostname:
-                            nodes[idx] = i
-            pool.close()
-            pool.join()
-        except:
-            raise
+"""
+process wide executor used to fan out the per node calls.
+threads share the ssh pool and mutate the Node objects in place.
+max_workers bound the number of nodes processed concurrently.
+"""
+max_workers = 16
+_executor = None
+_executor_lock = threading.Lock()
+
+def set_max_workers (n):
+    global max_workers, _executor
+    assert int(n) > 0
+    with _executor_lock:
+        max_workers = int(n)
+        if _executor:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+def executor ():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='patt')
+        return _executor
+
+"""
+run fn(n, *args) for each node on the shared executor and return the results
+in the nodes order. raise TimeoutError if a call is not done timeout seconds
+after it started, the time queued behind the other calls (max_workers) is not counted.
+"""
+def node_map (fn, nodes, args=(), timeout=None):
+    started = {}
+    def call (i, n):
+        started[i] = time.monotonic()
+        return fn (n, *args)
+    futures = [executor().submit (patt_trace.wrap (call), i, n) for i, n in enumerate(nodes)]
+    pending = set(futures)
+    while pending:
+        if timeout is None:
+            wait (pending)
+            break
+        now = time.monotonic()
+        running = [started[i] for i, f in enumerate(futures) if f in pending and i in started]
+        late = [s for s in running if now - s >= timeout]
+        if late:
+            for f in pending:
+                f.cancel()
+            raise FuturesTimeoutError ("{} / {} nodes not done after {}s".format(
+                len(pending), len(futures), timeout))
+        # wake up on the first call done or when the oldest running call reach its deadline
+        next_deadline = min(running) + timeout if running else now + timeout
+        done, pending = wait (pending, timeout=next_deadline - now, return_when=FIRST_COMPLETED)
+    return [f.result() for f in futures]
+
+"""
+host facts
+one command per host collect machine-id, ip aliases, sudo capability,
+os-release and the versions of the packages managed by patt.
+the facts are kept for the whole run in _facts (keyed by login, hostname, port)
+and optionally persisted in facts_file for facts_ttl seconds.
+"""
+facts_cmd = """
+echo '== id'; cat /etc/machine-id
+echo '== ip'; /sbin/ip -br -6 a show to 2000::/3 | sed 's|[[:space:]]\\+| |g' | cut -d' ' -f 3-
+echo '== sudo'; sudo -n id -u 2>/dev/null
+echo '== os'; cat /etc/os-release 2>/dev/null
+echo '== pkg'
+if [ -x /usr/bin/rpm ]; then
+ /usr/bin/rpm -qa --qf '%{NAME} %{VERSION}-%{RELEASE}\\n'
+elif [ -x /usr/bin/dpkg-query ]; then
+ /usr/bin/dpkg-query -W -f '${Package} ${Version}\\n'
+fi | grep -E '^(etcd|haproxy|nftables|patroni[^ ]*|postgresql[0-9]*(-server)?|pgbackrest|python3-psycopg2) '
+true
+"""
 
-def _host_ip_aliases_ref (n):
-    if n.ip_aliases:
-        return n
-    n._host_ip_aliases()
+facts_file = os.path.expanduser ('~/.cache/patt/facts.json')
+facts_ttl = 0
+_facts = {}
+_facts_lock = threading.Lock()
+
+def _facts_key (n):
+    return "{}@[{}]:{}".format(n.login, n.hostname, n.port)
+
+def parse_facts (out, hostname):
+    f = {'id': '', 'ip_aliases': [], 'sudo': False, 'os_release': {}, 'packages': {}}
+    section = None
+    for l in out.splitlines():
+        l = l.strip()
+        if l.startswith('== '):
+            section = l[3:]
+            continue
+        if not l: continue
+        if section == 'id':
+            f['id'] = l
+        elif section == 'ip':
+            f['ip_aliases'] += [i.split('/')[0] for i in l.split() if i.split('/')[0] not in hostname]
+        elif section == 'sudo':
+            f['sudo'] = l == '0'
+        elif section == 'os' and '=' in l:
+            k, v = l.split('=', 1)
+            f['os_release'][k] = v.strip('"')
+        elif section == 'pkg' and ' ' in l:
+            k, v = l.split(' ', 1)
+            f['packages'][k] = v
+    return f
+
+def facts_get (n):
+    with _facts_lock:
+        return _facts.get (_facts_key (n))
+
+def facts_set (n, f):
+    with _facts_lock:
+        _facts[_facts_key (n)] = f
+
+"""
+enable the on disk fact cache, ttl in seconds (0 disable)
+"""
+def set_facts_cache (ttl, filename=None):
+    global facts_ttl, facts_file
+    facts_ttl = int(ttl)
+    if filename:
+        facts_file = filename
+
+def facts_load ():
+    if not facts_ttl: return
+    try:
+        with open (facts_file, 'r') as f:
+            cached = json.load (f)
+    except (OSError, ValueError):
+        return
+    now = time.time()
+    with _facts_lock:
+        for k, v in cached.items():
+            if k not in _facts and now - v.get('stamp', 0) < facts_ttl:
+                _facts[k] = v
+
+def facts_save ():
+    if not facts_ttl: return
+    try:
+        os.makedirs (os.path.dirname (facts_file), mode=0o700, exist_ok=True)
+        with _facts_lock:
+            data = json.dumps (_facts)
+        tmp = "{}.{}".format(facts_file, os.getpid())
+        with open (tmp, 'w') as f:
+            f.write (data)
+        os.replace (tmp, facts_file)
+    except OSError as e:
+        logger.warning ("facts_save {}".format(str(e)))
+
+def _gather_facts_ref (n):
+    if not n._apply_facts():
+        if n._gather_facts():
+            n._apply_facts()
     return n
 
+"""
+gather the facts of the nodes not yet in the cache (refresh force a new pass)
+"""
+def gather_facts (nodes, refresh=False):
+    facts_load ()
+    if refresh:
+        with _facts_lock:
+            for n in nodes:
+                _facts.pop (_facts_key (n), None)
+    missing = {}
+    for n in nodes:
+        if not n._apply_facts():
+            missing.setdefault (_facts_key (n), n)
+    if missing:
+        node_map (_gather_facts_ref, list(missing.values()), timeout=10)
+        facts_save ()
+        for n in nodes:
+            n._apply_facts()
+    return [facts_get (n) for n in nodes]
+
+def check_priv (nodes):
+    result = []
+    for n, f in zip (nodes, gather_facts (nodes)):
+        r = Resp()
+        r.hostname = n.hostname
+        if f:
+            r.sudo = f['sudo']
+            r.id = f['id']
+        else:
+            r.error = "no facts for {}".format(n.hostname)
+        result.append (r)
+    return result
+
+def host_id (nodes):
+    missing = [n for n in nodes if not n.id and not n._apply_facts()]
+    if missing:
+        gather_facts (missing)
+
 def host_ip_aliases (nodes):
-    with Pool(len(nodes)) as pool:
-        try:
-            results = [pool.map_async (_host_ip_aliases_ref, nodes)]
-            for r in results:
-                for i in r.get(timeout=10):
-                    for idx, item in enumerate(nodes):
-                        if i.hostname in item.hostname:
-                            nodes[idx] = i
-            pool.close()
-            pool.join()
-        except:
-            raise
+    missing = [n for n in nodes if not n.ip_aliases and not n._apply_facts()]
+    if missing:
+        gather_facts (missing)
 
 def check_dup_id (nodes):
     id_list=[]
@@ -289,16 +726,329 @@ def check_dup_id (nodes):
         raise ValueError ("{} id not uniq".format (dupes))
 
 
-def exec_script (nodes, src, sudo=True, payload=None, args=[], log_call=True, timeout=360):
-    with Pool(len(nodes)) as pool:
+"""
+converged state
+the digest of the last successful run of each pipeline task is kept on the
+nodes in state_dir/<cluster_name>/<task> (relative to the login home)
+"""
+state_dir = '.cache/patt/state'
+
+def _state_get_ref (n, cluster_name):
+    try:
+        clt = n._ssh_client(timeout=10)
+        with patt_trace.span ('state_get', cat='ssh', host=n.hostname):
+            result = clt.exec ("/bin/bash -c " + shlex.quote (
+                'cd {} 2> /dev/null && grep -H . -- * 2> /dev/null ; true'.format (
+                    shlex.quote (state_dir + '/' + cluster_name))))
+        state = {}
+        if result.status == 0:
+            for l in result.stdout.read().decode().splitlines():
+                k, sep, v = l.partition(':')
+                if sep: state[k] = v.strip()
+        return state
+    except Exception as e:
+        logger.error ("_state_get ({})".format(n.hostname))
+        logger.error (str(e))
+        return {}
+
+"""
+return {hostname: {task: digest}} in one exec per node
+"""
+def state_get (nodes, cluster_name):
+    result = node_map (_state_get_ref, nodes, args=(cluster_name,), timeout=30)
+    return {n.hostname: r for n, r in zip (nodes, result)}
+
+def _state_set_ref (n, cluster_name, task, digest):
+    try:
+        d = shlex.quote (state_dir + '/' + cluster_name)
+        f = shlex.quote (state_dir + '/' + cluster_name + '/' + task)
+        clt = n._ssh_client(timeout=10)
+        result = clt.exec ("/bin/bash -c " + shlex.quote (
+            'mkdir -p {d} && echo {v} > {f}.tmp && mv -f {f}.tmp {f}'.format (
+                d=d, f=f, v=shlex.quote (digest))))
+        return result.status == 0
+    except Exception as e:
+        logger.error ("_state_set ({})".format(n.hostname))
+        logger.error (str(e))
+        return False
+
+"""
+record the digest of task on the nodes, an empty digest reset the state
+"""
+def state_set (nodes, cluster_name, task, digest):
+    return all (node_map (_state_set_ref, nodes, args=(cluster_name, task, digest), timeout=30))
+
+"""
+called with (hostname, stream, line) for each line output by the remote scripts
+as it arrive, stream is 'stdout' or 'stderr'.
+the stdout of the scripts run with hide_stdout is never passed nor logged.
+"""
+exec_line_hook = None
+
+def set_exec_line_hook (fn):
+    global exec_line_hook
+    exec_line_hook = fn
+
+def exec_line (hostname, stream, line, hide_stdout=False):
+    if hide_stdout and stream == 'stdout':
+        return
+    logger.debug ("{} {}: {}".format(hostname, stream, line))
+    if exec_line_hook:
         try:
-            for n in nodes:
-                n.user_object = [src, sudo, payload, args, log_call]
-            results = pool.map_async (Node._exec_script, (n for n in nodes))
-            return results.get(timeout=timeout)
+            exec_line_hook (hostname, stream, line)
         except Exception as e:
+            logger.warning ("exec_line_hook {}".format(str(e)))
+
+"""
+start the bundle on one node, a start failure (unreachable host, ssh_client.open
+exit on connect error) is returned as an error Resp
+"""
+def _bundle_start_ref (n, src, sudo, payload, args, log_call):
+    if log_call:
+        logger.info ("{} -> {}".format (n.hostname, [src, sudo, payload, args, log_call]))
+    try:
+        return n._bundle_start (src, sudo, payload, args)
+    except (Exception, SystemExit) as e:
+        error = "ssh connection failed" if isinstance(e, SystemExit) else str(e)
+        logger.error ("{} bundle start: {}".format(n.hostname, error))
+        return _start_error (n, "start failed: {}".format(error))
+
+def _start_error (n, error):
+    r = Resp()
+    r.hostname = n.hostname
+    if n.id: r.id = n.id
+    r.error = error
+    return r
+
+"""
+execution policy of exec_script and of the retry loops around it
+
+timeout:      deadline of the whole step in seconds
+host_timeout: deadline of one attempt on one host, past it the host channel is
+              closed and the host failed (and retried if allowed)
+retries:      number of extra attempts for a failed host,
+              exec_script retry only the scripts flagged idempotent
+backoff:      first retry delay in seconds, doubled on each attempt up to backoff_max
+quorum:       number of hosts to succeed (default all)
+fail_fast:    cancel the hosts still running as soon as the quorum is out of reach
+
+host_timeout, quorum and fail_fast are only enforced in bundle mode.
+"""
+class ExecPolicy:
+    def __init__(self, timeout=360, host_timeout=None, retries=0, backoff=1.0, backoff_max=30.0,
+                 idempotent=False, quorum=None, fail_fast=False):
+        self.timeout = timeout
+        self.host_timeout = host_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.idempotent = idempotent
+        self.quorum = quorum
+        self.fail_fast = fail_fast
+
+    def delay (self, attempt):
+        return min(self.backoff * (2 ** attempt), self.backoff_max)
+
+    def need (self, count):
+        return count if self.quorum is None else min(self.quorum, count)
+
+    def can_retry (self, attempt):
+        return self.idempotent and attempt < self.retries
+
+    """
+    call fn until ok(result) (default: result is true), at most retries + 1 times
+    within timeout, sleeping the backoff delay in between.
+    exceptions count as failed attempts, the last result (or None) is returned.
+    """
+    def call (self, fn, *args, ok=bool, **kwargs):
+        deadline = time.monotonic() + self.timeout
+        result = None
+        for attempt in range(self.retries + 1):
+            try:
+                result = fn (*args, **kwargs)
+                if ok (result):
+                    return result
+            except Exception as e:
+                result = None
+                logger.warning ("{} attempt {}: {}".format(getattr(fn, '__name__', fn), attempt + 1, e))
+            if attempt == self.retries or time.monotonic() + self.delay (attempt) > deadline:
+                break
+            time.sleep (self.delay (attempt))
+        return result
+
+"""
+start the bundles in parallel, return in the nodes order (exec_stream, cached, store)
+or an error Resp for the nodes which failed to start within timeout
+"""
+def _bundle_start_all (nodes, src, sudo, payload, args, log_call, timeout):
+    futures = [executor().submit (patt_trace.wrap (_bundle_start_ref), n, src, sudo, payload, args, log_call)
+               for n in nodes]
+    wait (futures, timeout=max(timeout, 0))
+    started = []
+    for n, f in zip (nodes, futures):
+        if f.done():
+            started.append (f.result())
+            continue
+        if not f.cancel():
+            # close the stream if the start complete after all
+            f.add_done_callback (lambda f: f.result()[0].close() if isinstance(f.result(), tuple) else None)
+        started.append (_start_error (n, "start not done after {:.0f}s".format(timeout)))
+    return started
+
+"""
+start the script on all the nodes then multiplex their output through one
+selector. the failed hosts are retried (after the backoff delay) as the policy
+allow it, the nodes evicted from the remote cache in between are run again.
+"""
+def exec_bundle_stream (nodes, src, sudo=True, payload=None, args=[], log_call=True, timeout=360, policy=None,
+                        hide_stdout=False):
+    if policy is None:
+        policy = ExecPolicy (timeout=timeout)
+    deadline = time.monotonic() + policy.timeout
+    need = policy.need (len(nodes))
+    result = [None] * len(nodes)
+    attempts = [0] * len(nodes)
+    lost = set()
+    pending = list(range(len(nodes)))
+    timed_out = False
+    cancelled = []
+    while pending and not timed_out:
+        started = _bundle_start_all ([nodes[i] for i in pending], src, sudo, payload, args, log_call,
+                                     deadline - time.monotonic())
+        index = {}
+        failed = []
+        for i, st in zip (pending, started):
+            if isinstance(st, Resp):
+                result[i] = st
+                if policy.can_retry (attempts[i]):
+                    failed.append (i)
+                else:
+                    lost.add (i)
+                continue
+            if policy.host_timeout:
+                st[0].deadline = time.monotonic() + policy.host_timeout
+            index[st[0]] = (i, st)
+
+        def out_of_reach ():
+            if policy.fail_fast and len(lost) > len(nodes) - need:
+                for s in [s for s in index if not s.done and s not in cancelled]:
+                    cancelled.append (s)
+                    s.close()
+
+        def on_exit (stream):
+            i = index[stream][0]
+            if stream.status == 0 or stream.stderr.decode().startswith(cache_miss_marker):
+                return
+            if policy.can_retry (attempts[i]):
+                return
+            lost.add (i)
+            out_of_reach ()
+
+        out_of_reach ()
+        streams = [s for s in index if s not in cancelled]
+        try:
+            if time.monotonic() >= deadline:
+                # the start alone used the whole step deadline
+                for s in streams:
+                    s.close()
+                raise TimeoutError ("{} start not done after {}s".format(
+                    [nodes[i].hostname for i in pending], policy.timeout))
+            if streams:
+                for hostname, stream, line in ssh_client.multiplex (streams,
+                                                                    timeout=deadline - time.monotonic(),
+                                                                    on_exit=on_exit):
+                    exec_line (hostname, stream, line, hide_stdout)
+        except TimeoutError as e:
             logger.error (str(e))
-            raise
+            timed_out = True
+
+        retry = []
+        for stream, (i, st) in index.items():
+            n = nodes[i]
+            n._bundle_trace (src, stream)
+            if stream.done and not stream.timed_out and stream not in cancelled:
+                if not n._bundle_done (*st):
+                    retry.append (i)
+                    continue
+            r = n._bundle_resp (stream)
+            if stream in cancelled:
+                r.error = "cancelled, quorum {}/{} out of reach".format(need, len(nodes))
+            elif stream.timed_out:
+                r.error = "timeout after {}s".format(policy.host_timeout)
+            elif not stream.done:
+                r.error = "timeout after {}s".format(policy.timeout)
+            result[i] = r
+            if r.error and stream.done and stream not in cancelled and policy.can_retry (attempts[i]):
+                failed.append (i)
+
+        retry_delay = max([policy.delay (attempts[i]) for i in failed] + [0])
+        if failed and time.monotonic() + retry_delay > deadline:
+            failed = []
+        for i in failed:
+            logger.warning ("{} retry {}/{} in {}s: {}".format(
+                nodes[i].hostname, attempts[i] + 1, policy.retries, retry_delay, result[i].error))
+            attempts[i] += 1
+        if failed:
+            time.sleep (retry_delay)
+        pending = retry + failed
+
+    if timed_out and len([r for r in result if r and not r.error]) < need:
+        raise FuturesTimeoutError ("{} not done after {}s".format(
+            [n.hostname for n, r in zip (nodes, result) if not r or r.error], policy.timeout))
+    return result
+
+def _exec_script_policy (n, src, sudo, payload, args, log_call, policy, hide_stdout):
+    for attempt in range(policy.retries + 1):
+        r = n._exec_script (src, sudo, payload, args, log_call, False, hide_stdout)
+        if not r.error or not policy.can_retry (attempt):
+            break
+        time.sleep (policy.delay (attempt))
+    return r
+
+def exec_script (nodes, src, sudo=True, payload=None, args=[], log_call=True, timeout=360, bundle=None,
+                 policy=None, hide_stdout=False):
+    if bundle is None:
+        bundle = exec_bundle
+    if policy is None:
+        policy = ExecPolicy (timeout=timeout)
+    try:
+        with patt_trace.span ('exec_script', cat='step', script=src, args=' '.join(str(a) for a in args),
+                              hosts=len(nodes), bundle=bundle) as sp:
+            if bundle:
+                result = exec_bundle_stream (nodes, src, sudo, payload, args, log_call, policy=policy,
+                                             hide_stdout=hide_stdout)
+            else:
+                result = node_map (_exec_script_policy, nodes,
+                                   args=(src, sudo, payload, args, log_call, policy, hide_stdout),
+                                   timeout=policy.timeout)
+            sp.args['errors'] = len([r for r in result if r is None or r.error])
+            return result
+    except Exception as e:
+        logger.error (str(e))
+        raise
+
+"""
+return the ssh pool stats as {'connect': n, 'reuse': n, 'open': n}
+"""
+def ssh_pool_stats ():
+    return ssh_pool.stats()
+
+"""
+close all the pooled ssh connections
+"""
+def ssh_pool_close ():
+    ssh_pool.close_all()
+
+"""
+release the process wide resources (executor and ssh pool) at the end of the run
+"""
+def shutdown ():
+    global _executor
+    with _executor_lock:
+        if _executor:
+            _executor.shutdown(wait=False)
+            _executor = None
+    ssh_pool_close()
 
 """
 split IPv6 NRI like login@[AA::BB::CC:...]:PORT
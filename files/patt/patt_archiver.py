@@ -51,7 +51,7 @@ class Archiver(object):
         result = patt.exec_script (nodes=nodes, src="./dscripts/d27.archiver.sh",
                                    args=['ssh_archive_keygen'] + [cluster_name] +
                                    [self.archiver_type] + [postgres_user],
-                                   sudo=True, log_call=True)
+                                   sudo=True, log_call=True, hide_stdout=True)
         log_results (result, hide_stdout=True)
         assert all(x == True for x in [bool(n.out) for n in result])
         return [n.out for n in result]
@@ -225,7 +225,7 @@ class Archiver(object):
                 result = patt.exec_script (nodes=[n], src="dscripts/d27.archiver.sh",
                                            payload=comd,
                                            args=['aws_credentials_dump'] +
-                                           [os.path.basename (comd)], sudo=True)
+                                           [os.path.basename (comd)], sudo=True, hide_stdout=True)
             except:
                 continue
             else:
@@ -6,10 +6,14 @@ from logging.handlers import TimedRotatingFileHandler
 import secrets
 import string
 import argparse
+import hashlib
+import json
 import yaml
 import time
 import sys
 import os
+import shutil
+import threading
 from pprint import pformat
 import file_lock as fl
 
@@ -23,6 +27,8 @@ from patt_archiver_pgbackrest import ArchiverPgbackrest
 import patt_patroni
 import patt_haproxy
 import patt_health
+import patt_dag
+import patt_trace
 
 logger = logging.getLogger('patt_cli')
 
@@ -72,6 +78,14 @@ class Config(object):
         self.disk_free_alert_threshold = []
         self.disk_free_alert_threshold_default_mb = 500
         self.disk_free_alert_threshold_default_pc = 5
+        self.ssh_max_workers = 16
+        self.ssh_exec_bundle = True
+        self.ssh_exec_cache = True
+        self.ssh_exec_cache_max_kb = 65536
+        self.task_max_workers = 4
+        self.facts_cache_ttl = 0
+        self.trace = None
+        self.converge = False
 
     def from_argparse_cli(self, args):
         for a in args._get_kwargs():
@@ -97,6 +111,24 @@ class Config(object):
             except:
                 raise
 
+"""
+desired state digest of a run: the config (without the run tuning options),
+the content of the files it reference and the patt tree
+"""
+def converge_digest (cfg, files=[]):
+    volatile = ['log_file', 'loglevel', 'lock_dir', 'yaml_dump', 'trace', 'converge', 'task_max_workers',
+                'ssh_max_workers', 'ssh_exec_bundle', 'ssh_exec_cache', 'ssh_exec_cache_max_kb', 'facts_cache_ttl']
+    conf = {k: v for k, v in cfg.__dict__.items() if k not in volatile}
+    h = hashlib.sha256()
+    h.update (json.dumps (conf, sort_keys=True, default=str).encode())
+    values = [v for v in conf.values() if isinstance(v, str)]
+    values += [i for v in conf.values() if isinstance(v, list) for i in v if isinstance(i, str)]
+    for f in sorted (set ([v for v in values + files if v and os.path.isfile (v)])):
+        h.update (f.encode())
+        h.update (patt.file_sha256 (f).encode())
+    h.update (patt.tree_sha256 ().encode())
+    return h.hexdigest()
+
 def progress_bar (current, total, pre="Progress", post="Complete", decimals = 1, length = 100, fill = '█'):
     percent = ("{0:." + str(decimals) + "f}").format(100 * (current / float(total)))
     filledLength = int(length * current // total)
@@ -105,6 +137,64 @@ def progress_bar (current, total, pre="Progress", post="Complete", decimals = 1,
     if current == total:
         print()
 
+"""
+live progress display: the pipeline progress bar followed by
+the last line output by the remote scripts on each host.
+fallback to the plain progress bar when stdout is not a tty.
+"""
+class HostProgress:
+    def __init__(self, out=sys.stdout, refresh=0.2):
+        self.out = out
+        self.tty = out.isatty()
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.current = 0
+        self.total = 1
+        self.drawn = 0
+        self.last_draw = 0
+
+    def line(self, hostname, stream, line):
+        line = line.strip()
+        if not line: return
+        with self.lock:
+            self.hosts[hostname] = "{}{}".format('! ' if stream == 'stderr' else '', line)
+            if time.monotonic() - self.last_draw >= self.refresh:
+                self._draw()
+
+    def task(self, current, total, task=None):
+        with self.lock:
+            self.current = current
+            self.total = total
+            if self.tty:
+                self._draw()
+            else:
+                progress_bar (current, total)
+
+    def close(self):
+        with self.lock:
+            if self.tty and self.drawn:
+                self.hosts = {}
+                self._draw()
+
+    def _draw(self):
+        if not self.tty: return
+        self.last_draw = time.monotonic()
+        width = shutil.get_terminal_size().columns - 1
+        length = max(10, min(100, width - 30))
+        percent = 100 * (self.current / float(self.total))
+        filled = int(length * self.current // self.total)
+        lines = ["Progress |{}| {:.1f}% Complete".format('█' * filled + '-' * (length - filled), percent)]
+        for h in sorted(self.hosts):
+            lines.append("  {:<39} {}".format(h, self.hosts[h])[:width])
+        text = "\x1b[{}A".format(self.drawn) if self.drawn else ""
+        text += "".join(["\r\x1b[K{}\n".format(l) for l in lines])
+        # clear the lines left by a previous larger display
+        text += "\x1b[J"
+        self.out.write(text)
+        self.out.flush()
+        self.drawn = len(lines)
+
 if __name__ == "__main__":
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     cfg = Config()
@@ -114,6 +204,10 @@ if __name__ == "__main__":
     yml = subparsers.add_parser('yaml')
     yml.add_argument('-f','--yaml_config_file', help='config file', required=True)
     yml.add_argument('--aws_credentials', help='add file contain to each postgres peers', required=False)
+    yml.add_argument('--converge', help='skip the tasks already converged with the same config and scripts',
+                     action='store_true', required=False)
+    yml.add_argument('--trace', help='write the run spans to FILE (chrome trace, json lines if FILE end with .jsonl)',
+                     metavar='FILE', required=False)
 
     cli = subparsers.add_parser('cli')
     cli.add_argument('-n','--nodes', action='append', help='nodes name or address', required=True)
@@ -142,6 +236,20 @@ if __name__ == "__main__":
     cli.add_argument('--yaml_dump', help="dump the cli options in yaml format", action='store_true', required=False)
     cli.add_argument('--pg_master_exec', help="script list to exec on master as postgres, could be local or remote)", action='append', required=False, default=[])
     cli.add_argument('--lock_dir', help='lock directory', required=False, default="/dev/shm")
+    cli.add_argument('--ssh_max_workers', help='max number of nodes processed concurrently',
+                     type=int, required=False, default=16)
+    cli.add_argument('--ssh_exec_sftp', help='send scripts via sftp instead of a single exec bundle',
+                     action='store_false', dest='ssh_exec_bundle', default=True)
+    cli.add_argument('--task_max_workers', help='max number of pipeline tasks run concurrently',
+                     type=int, required=False, default=4)
+    cli.add_argument('--facts_cache_ttl', help='keep the host facts on disk for ttl seconds (0 disable)',
+                     type=int, required=False, default=0)
+    cli.add_argument('--trace', help='write the run spans to FILE (chrome trace, json lines if FILE end with .jsonl)',
+                     metavar='FILE', required=False)
+    cli.add_argument('--converge', help='skip the tasks already converged with the same config and scripts',
+                     action='store_true', required=False)
+    cli.add_argument('--ssh_exec_no_cache', help='do not use the remote script cache',
+                     action='store_false', dest='ssh_exec_cache', default=True)
 
     args = parser.parse_args()
     cluster_config=None
@@ -151,6 +259,8 @@ if __name__ == "__main__":
             cfg.to_yaml()
     elif args.interface == 'yaml':
         cfg.from_yaml_file (args.yaml_config_file)
+        if args.trace:
+            cfg.trace = args.trace
         cluster_config=args.yaml_config_file
     else:
         print ("""
@@ -203,6 +313,12 @@ if __name__ == "__main__":
         if cfg.ssh_login:
             ssh_login = cfg.ssh_login
 
+        patt.set_max_workers (cfg.ssh_max_workers)
+        patt.set_exec_bundle (cfg.ssh_exec_bundle)
+        patt.set_exec_cache (cfg.ssh_exec_cache, cfg.ssh_exec_cache_max_kb)
+        patt.set_facts_cache (cfg.facts_cache_ttl)
+        if cfg.trace:
+            patt_trace.enable ()
         nodes = patt.to_nodes (cfg.nodes, ssh_login, cfg.ssh_keyfile)
 
         assert cfg.dcs_type in ('etcd', 'etcd3', 'raft')
@@ -233,14 +349,12 @@ if __name__ == "__main__":
                            [patt.ipv6_nri_split(x['host'])[1] for x in
                             [c for c in cfg.archive_store if c['method'] == 'sh'] if 'host' in x]]
 
-        progress_bar (1, 14)
-        # Peer check
+        # Peer check (one fact gathering pass for all the peers)
+        patt.gather_facts (nodes + etcd_peers + raft_peers + postgres_peers + haproxy_peers + sftpd_peers)
         for p in [etcd_peers, raft_peers, postgres_peers, haproxy_peers, sftpd_peers]:
             if not p: continue
             for n in patt.check_priv(p):
-                assert (n.sudo == True)
-                patt.host_id(p)
-                patt.host_ip_aliases(p)
+                assert (n.sudo == True), "{} sudo check error {}".format(n.hostname, n.error)
         patt.check_dup_id ([p for p in etcd_peers])
         patt.check_dup_id ([p for p in raft_peers])
         patt.check_dup_id ([p for p in postgres_peers])
@@ -263,390 +377,482 @@ if __name__ == "__main__":
         if sftpd_peers:
             logger.info ("sftpd_peers  : {}".format([(n.hostname, n.id) for n in sftpd_peers]))
 
-        progress_bar (2, 14)
-
-        if cfg.add_repo and is_dcs_etcd:
-            add_repo_ok = patt_syst.add_repo (repo_url=cfg.add_repo, nodes=etcd_peers)
-            assert add_repo_ok, "add repo error"
-
-        postgres_clients = cfg.network_postgres_clients if cfg.network_postgres_clients else ["::0/0"]
-        monitoring_clients = cfg.network_monitoring_clients if cfg.network_monitoring_clients else ["::0/0"]
-        floating_ip = cfg.floating_ip if cfg.floating_ip else []
-        nftables_configure_ok = patt_syst.nftables_configure (
-            cluster_name=cfg.cluster_name,
-            template_src='./config/firewall.nft',
-            config_file_target='/etc/nftables/postgres_patroni.nft',
-            patroni_peers=postgres_peers,
-            etcd_peers=dcs_peers, # keep dsc ports open for all dcs in sets (raft and etcd)
-            raft_peers=dcs_peers, # could be restricted at the end of run if necessary
-            haproxy_peers=haproxy_peers,
-            postgres_clients=postgres_clients,
-            monitoring_clients=monitoring_clients,
-            floating_ip=floating_ip)
-        assert nftables_configure_ok, "nftables configure error"
+        def hosts(*peers):
+            return set([n.hostname for p in peers for n in p])
 
         sftpd_only_id = list(set([n.id for n in sftpd_peers]) - set([n.id for n in etcd_peers] +
                                                                     [n.id for n in raft_peers] +
                                                                     [n.id for n in postgres_peers] +
                                                                     [n.id for n in haproxy_peers]))
         sftpd_only=[n for n in sftpd_peers if n.id in sftpd_only_id]
-        if sftpd_only:
+
+        raft_only_id = list(set([n.id for n in raft_peers]) - set([n.id for n in postgres_peers]))
+        raft_only_peers=[n for n in raft_peers if n.id in raft_only_id]
+
+        # archiving/backup
+        if cfg.archiver == 'walg':
+            # wal-g archiving
+            archiver = ArchiverWalg()
+        elif cfg.archiver == 'pgbackrest':
+            archiver = ArchiverPgbackrest()
+        else:
+            archiver = Archiver()
+
+        """
+        deployment pipeline
+        each task declare the state it reads (inputs) and produces (outputs)
+        and the hosts it touches, tasks on disjoint hosts run concurrently.
+        """
+        progress = HostProgress()
+        patt.set_exec_line_hook (progress.line)
+
+        """
+        converged check: each task digest (run digest + task + hosts) is stored on
+        its hosts once done, a task is skipped when all its hosts hold the same
+        digest and all the tasks it depends on were skipped.
+        tasks without host are always run.
+        """
+        remote_state = {}
+        state_nodes = {}
+        if cfg.converge or getattr(args, 'converge', False):
+            for n in nodes + etcd_peers + raft_peers + postgres_peers + haproxy_peers + sftpd_peers:
+                state_nodes.setdefault (n.hostname, n)
+            run_digest = converge_digest (cfg, [f for f in [cluster_config, getattr(args, 'aws_credentials', None)] if f])
+            remote_state = patt.state_get (list(state_nodes.values()), cfg.cluster_name)
+
+        def task_digest (t):
+            return hashlib.sha256 ("{} {} {}".format(run_digest, t.name, sorted(t.hosts)).encode()).hexdigest()
+
+        def task_converged (t):
+            return bool(t.hosts) and all (
+                [remote_state.get (h, {}).get (t.name) == task_digest (t) for h in t.hosts])
+
+        def task_record (t):
+            fn = t.fn
+            def run (state):
+                hosts = [state_nodes[h] for h in sorted(t.hosts)]
+                patt.state_set (hosts, cfg.cluster_name, t.name, '')
+                r = fn (state)
+                patt.state_set (hosts, cfg.cluster_name, t.name, task_digest (t))
+                return r
+            t.fn = run
+
+        dag = patt_dag.Dag(max_workers=cfg.task_max_workers, on_done=progress.task,
+                           skip=task_converged if state_nodes else None)
+
+        if cfg.add_repo and is_dcs_etcd:
+            def add_repo(state):
+                add_repo_ok = patt_syst.add_repo (repo_url=cfg.add_repo, nodes=etcd_peers)
+                assert add_repo_ok, "add repo error"
+            dag.add ('add_repo', add_repo, outputs=['repo'], hosts=hosts(etcd_peers))
+
+        def nftables(state):
+            postgres_clients = cfg.network_postgres_clients if cfg.network_postgres_clients else ["::0/0"]
+            monitoring_clients = cfg.network_monitoring_clients if cfg.network_monitoring_clients else ["::0/0"]
+            floating_ip = cfg.floating_ip if cfg.floating_ip else []
             nftables_configure_ok = patt_syst.nftables_configure (
                 cluster_name=cfg.cluster_name,
                 template_src='./config/firewall.nft',
                 config_file_target='/etc/nftables/postgres_patroni.nft',
-                sftpd_peers=sftpd_only)
+                patroni_peers=postgres_peers,
+                etcd_peers=dcs_peers, # keep dsc ports open for all dcs in sets (raft and etcd)
+                raft_peers=dcs_peers, # could be restricted at the end of run if necessary
+                haproxy_peers=haproxy_peers,
+                postgres_clients=postgres_clients,
+                monitoring_clients=monitoring_clients,
+                floating_ip=floating_ip)
             assert nftables_configure_ok, "nftables configure error"
 
-        progress_bar (3, 14)
+            if sftpd_only:
+                nftables_configure_ok = patt_syst.nftables_configure (
+                    cluster_name=cfg.cluster_name,
+                    template_src='./config/firewall.nft',
+                    config_file_target='/etc/nftables/postgres_patroni.nft',
+                    sftpd_peers=sftpd_only)
+                assert nftables_configure_ok, "nftables configure error"
+        dag.add ('nftables', nftables, outputs=['firewall'],
+                 hosts=hosts(postgres_peers, dcs_peers, haproxy_peers, sftpd_only))
 
         if is_dcs_etcd and cfg.vol_size_etcd:
-            vol_etcd_ok = patt_syst.disk_init (
-                etcd_peers, mnt="/var/lib/etcd", vol_size=cfg.vol_size_etcd, user=None, mode='711')
-            assert vol_etcd_ok, "vol etcd error"
+            def vol_etcd(state):
+                vol_etcd_ok = patt_syst.disk_init (
+                    etcd_peers, mnt="/var/lib/etcd", vol_size=cfg.vol_size_etcd, user=None, mode='711')
+                assert vol_etcd_ok, "vol etcd error"
+            dag.add ('vol_etcd', vol_etcd, outputs=['vol_etcd'], hosts=hosts(etcd_peers))
 
         if is_dcs_raft and cfg.vol_size_raft:
-            vol_raft_ok = patt_syst.disk_init (
-                raft_peers, mnt=raft_mnt_dir, vol_size=cfg.vol_size_raft, user=None, mode='711')
-            assert vol_raft_ok, "vol raft error"
+            def vol_raft(state):
+                vol_raft_ok = patt_syst.disk_init (
+                    raft_peers, mnt=raft_mnt_dir, vol_size=cfg.vol_size_raft, user=None, mode='711')
+                assert vol_raft_ok, "vol raft error"
+            dag.add ('vol_raft', vol_raft, outputs=['vol_raft'], hosts=hosts(raft_peers))
 
         if postgres_peers and cfg.vol_size_pgsql:
-            vol_pgsql_ok = patt_syst.disk_init (
-                postgres_peers, user='postgres', vol_size=cfg.vol_size_pgsql, mode='711')
-            assert vol_pgsql_ok, "vol pgsql error"
+            def vol_pgsql(state):
+                vol_pgsql_ok = patt_syst.disk_init (
+                    postgres_peers, user='postgres', vol_size=cfg.vol_size_pgsql, mode='711')
+                assert vol_pgsql_ok, "vol pgsql error"
+            dag.add ('vol_pgsql', vol_pgsql, outputs=['vol_pgsql'], hosts=hosts(postgres_peers))
 
         if postgres_peers and cfg.vol_size_pgsql_temp:
-            vol_pgsql_temp_ok = patt_syst.disk_init (
-                postgres_peers, mnt='/var/cache/postgres_temp', vol_size=cfg.vol_size_pgsql_temp,
-                user='postgres', mode='750')
-            assert vol_pgsql_temp_ok, "vol pgsql temp error"
+            def vol_pgsql_temp(state):
+                vol_pgsql_temp_ok = patt_syst.disk_init (
+                    postgres_peers, mnt='/var/cache/postgres_temp', vol_size=cfg.vol_size_pgsql_temp,
+                    user='postgres', mode='750')
+                assert vol_pgsql_temp_ok, "vol pgsql temp error"
+            dag.add ('vol_pgsql_temp', vol_pgsql_temp, outputs=['vol_pgsql_temp'],
+                     after=['vol_pgsql'], hosts=hosts(postgres_peers))
 
         if postgres_peers and cfg.vol_size_pgsql_safe:
-            vol_pgsql_safe_ok = patt_syst.disk_init (
-                postgres_peers, mnt='/var/lib/pg_safe', vol_size=cfg.vol_size_pgsql_safe,
-                user='postgres', mode='700')
-            assert vol_pgsql_safe_ok, "vol pgsql safe error"
-        # may be used temporarily or for good to store pg dump
+            # may be used temporarily or for good to store pg dump
+            def vol_pgsql_safe(state):
+                vol_pgsql_safe_ok = patt_syst.disk_init (
+                    postgres_peers, mnt='/var/lib/pg_safe', vol_size=cfg.vol_size_pgsql_safe,
+                    user='postgres', mode='700')
+                assert vol_pgsql_safe_ok, "vol pgsql safe error"
+            dag.add ('vol_pgsql_safe', vol_pgsql_safe, outputs=['vol_pgsql_safe'],
+                     after=['vol_pgsql'], hosts=hosts(postgres_peers))
 
         if sftpd_peers and cfg.vol_size_walg:
-            vol_walg_ok = patt_syst.disk_init (
-                sftpd_peers, mnt="/var/lib/walg", vol_size=cfg.vol_size_walg)
-            assert vol_walg_ok, "vol walg error"
-        if sftpd_peers and cfg.vol_size_pgbackrest:
-            vol_pgbackrest_ok = patt_syst.disk_init (
-                sftpd_peers, mnt="/var/lib/pgbackrest", vol_size=cfg.vol_size_pgbackrest)
-            assert vol_pgbackrest_ok, "vol pgbackrest error"
+            def vol_walg(state):
+                vol_walg_ok = patt_syst.disk_init (
+                    sftpd_peers, mnt="/var/lib/walg", vol_size=cfg.vol_size_walg)
+                assert vol_walg_ok, "vol walg error"
+            dag.add ('vol_walg', vol_walg, outputs=['vol_walg'], hosts=hosts(sftpd_peers))
 
-        progress_bar (4, 14)
+        if sftpd_peers and cfg.vol_size_pgbackrest:
+            def vol_pgbackrest(state):
+                vol_pgbackrest_ok = patt_syst.disk_init (
+                    sftpd_peers, mnt="/var/lib/pgbackrest", vol_size=cfg.vol_size_pgbackrest)
+                assert vol_pgbackrest_ok, "vol pgbackrest error"
+            dag.add ('vol_pgbackrest', vol_pgbackrest, outputs=['vol_pgbackrest'], hosts=hosts(sftpd_peers))
 
         if is_dcs_etcd:
-            etcd_template = cfg.etcd_template_file if cfg.etcd_template_file else "config/etcd.conf.tmpl"
-            etcd_report = patt_etcd.etcd_init(cfg.cluster_name, etcd_peers, etcd_template=etcd_template)
-
-        progress_bar (5, 14)
-
-        tuned_postgresql_ok = patt_syst.tuned_postgresql (postgres_peers)
-        assert tuned_postgresql_ok, "tuned postgresql error"
-
-        progress_bar (5, 14)
-
-        patt_postgres.postgres_init(cfg.postgres_release, postgres_peers)
-
-        progress_bar (5, 14)
-
-        patt_postgres.postgres_ssl_cert_init(nodes=postgres_peers)
-
-        progress_bar (5, 14)
-
-        patt_postgres.postgres_ssl_cert(cfg.cluster_name, nodes=postgres_peers)
-
-        cert_users = [i['name'] for i in cfg.create_role if 'name' in i]
-        patt_postgres.postgres_ssl_user_cert(cfg.cluster_name, user_names=cert_users)
-
-        progress_bar (6, 14)
-
-        patt_patroni.floating_ip_init(nodes=postgres_peers, ip_takeover_version=cfg.ip_takeover_version)
-
-        progress_bar (7, 14)
-
-        patt_patroni.floating_ip_build(nodes=postgres_peers, ip_takeover_version=cfg.ip_takeover_version)
-
-        progress_bar (8, 14)
-
-        # archiving/backup
-        if cfg.archiver == 'walg':
-            # wal-g archiving
-            archiver = ArchiverWalg()
-        elif cfg.archiver == 'pgbackrest':
-            archiver = ArchiverPgbackrest()
-        else:
-            archiver = Archiver()
+            def etcd_init(state):
+                etcd_template = cfg.etcd_template_file if cfg.etcd_template_file else "config/etcd.conf.tmpl"
+                etcd_report = patt_etcd.etcd_init(cfg.cluster_name, etcd_peers, etcd_template=etcd_template)
+                return {'etcd_report': etcd_report}
+            dag.add ('etcd_init', etcd_init, inputs=['repo', 'firewall', 'vol_etcd'],
+                     outputs=['etcd_report'], hosts=hosts(etcd_peers))
+
+        def tuned_postgresql(state):
+            tuned_postgresql_ok = patt_syst.tuned_postgresql (postgres_peers)
+            assert tuned_postgresql_ok, "tuned postgresql error"
+        dag.add ('tuned_postgresql', tuned_postgresql, outputs=['tuned'], hosts=hosts(postgres_peers))
+
+        def postgres_init(state):
+            patt_postgres.postgres_init(cfg.postgres_release, postgres_peers)
+        dag.add ('postgres_init', postgres_init, inputs=['vol_pgsql', 'vol_pgsql_temp', 'vol_pgsql_safe'],
+                 outputs=['postgres'], hosts=hosts(postgres_peers))
+
+        def postgres_ssl_cert_init(state):
+            patt_postgres.postgres_ssl_cert_init(nodes=postgres_peers)
+        dag.add ('postgres_ssl_cert_init', postgres_ssl_cert_init, inputs=['postgres'],
+                 outputs=['ssl_init'], hosts=hosts(postgres_peers))
+
+        def postgres_ssl_cert(state):
+            patt_postgres.postgres_ssl_cert(cfg.cluster_name, nodes=postgres_peers)
+        dag.add ('postgres_ssl_cert', postgres_ssl_cert, inputs=['ssl_init'],
+                 outputs=['ssl_cert'], hosts=hosts(postgres_peers))
+
+        def postgres_ssl_user_cert(state):
+            cert_users = [i['name'] for i in cfg.create_role if 'name' in i]
+            patt_postgres.postgres_ssl_user_cert(cfg.cluster_name, user_names=cert_users)
+        dag.add ('postgres_ssl_user_cert', postgres_ssl_user_cert, inputs=['ssl_cert'],
+                 outputs=['ssl_user_cert'])
+
+        def floating_ip_init(state):
+            patt_patroni.floating_ip_init(nodes=postgres_peers, ip_takeover_version=cfg.ip_takeover_version)
+        dag.add ('floating_ip_init', floating_ip_init, outputs=['ip_takeover_init'],
+                 hosts=hosts(postgres_peers))
+
+        def floating_ip_build(state):
+            patt_patroni.floating_ip_build(nodes=postgres_peers, ip_takeover_version=cfg.ip_takeover_version)
+        dag.add ('floating_ip_build', floating_ip_build, inputs=['ip_takeover_init'],
+                 outputs=['ip_takeover'], hosts=hosts(postgres_peers))
 
         if cfg.archive_store and postgres_peers:
-            archiver_version=cfg.walg_release if cfg.archiver == 'walg' else None
-            archiver_url=cfg.walg_url if cfg.archiver == 'walg' else None
-            archiver_sha256=cfg.walg_sha256 if cfg.archiver == 'walg' else None
-
-            init_ok = archiver.package_init(version=archiver_version,
-                                            url=archiver_url,
-                                            sha256=archiver_sha256,
-                                            nodes=postgres_peers)
-            assert init_ok, "archiver package init error"
-
-            # if args.aws_credentials:
-            aws_credentials_ok = archiver.aws_credentials(
-                nodes=postgres_peers,
-                aws_credentials=args.aws_credentials,
-                error_on_file_not_found=False)
-            assert aws_credentials_ok, "s3 aws credentials error"
-
-            # s3 store definition
-            s3_config_ok = archiver.s3_config(postgres_version=cfg.postgres_release,
-                                              cluster_name=cfg.cluster_name,
-                                              nodes=postgres_peers,
-                                              archive_store=cfg.archive_store)
-            assert s3_config_ok, "s3 config error"
-
-            # sh store definition
-            sh_config_ok = archiver.sh_config(postgres_version=cfg.postgres_release,
-                                              cluster_name=cfg.cluster_name,
-                                              nodes=postgres_peers,
-                                              archive_store=cfg.archive_store)
-            assert sh_config_ok, "sh config error"
-
-
-            s3_create_bucket_ok = archiver.s3_create_bucket(nodes=postgres_peers,
-                                                            archive_store=cfg.archive_store)
-            assert s3_create_bucket_ok, "create bucket error"
-
-            # systemd backup service setup
-            backup_service_setup_ok = archiver.backup_service_setup(
-                postgres_version=cfg.postgres_release,
-                nodes=postgres_peers)
-            assert backup_service_setup_ok, "backup service setup error"
+            def archiver_setup(state):
+                archiver_version=cfg.walg_release if cfg.archiver == 'walg' else None
+                archiver_url=cfg.walg_url if cfg.archiver == 'walg' else None
+                archiver_sha256=cfg.walg_sha256 if cfg.archiver == 'walg' else None
+
+                init_ok = archiver.package_init(version=archiver_version,
+                                                url=archiver_url,
+                                                sha256=archiver_sha256,
+                                                nodes=postgres_peers)
+                assert init_ok, "archiver package init error"
+
+                # if args.aws_credentials:
+                aws_credentials_ok = archiver.aws_credentials(
+                    nodes=postgres_peers,
+                    aws_credentials=args.aws_credentials,
+                    error_on_file_not_found=False)
+                assert aws_credentials_ok, "s3 aws credentials error"
+
+                # s3 store definition
+                s3_config_ok = archiver.s3_config(postgres_version=cfg.postgres_release,
+                                                  cluster_name=cfg.cluster_name,
+                                                  nodes=postgres_peers,
+                                                  archive_store=cfg.archive_store)
+                assert s3_config_ok, "s3 config error"
+
+                # sh store definition
+                sh_config_ok = archiver.sh_config(postgres_version=cfg.postgres_release,
+                                                  cluster_name=cfg.cluster_name,
+                                                  nodes=postgres_peers,
+                                                  archive_store=cfg.archive_store)
+                assert sh_config_ok, "sh config error"
+
+                s3_create_bucket_ok = archiver.s3_create_bucket(nodes=postgres_peers,
+                                                                archive_store=cfg.archive_store)
+                assert s3_create_bucket_ok, "create bucket error"
+
+                # systemd backup service setup
+                backup_service_setup_ok = archiver.backup_service_setup(
+                    postgres_version=cfg.postgres_release,
+                    nodes=postgres_peers)
+                assert backup_service_setup_ok, "backup service setup error"
+            dag.add ('archiver_setup', archiver_setup, inputs=['postgres'],
+                     outputs=['archiver'], hosts=hosts(postgres_peers))
 
             if sftpd_peers:
-                init_ok = archiver.ssh_archiving_init(nodes=sftpd_peers)
-                sftpd_archiving = archiver.archiver_peers_service(archive_store=cfg.archive_store,
-                                                                  archive_peers=sftpd_peers)
-                for n in sftpd_archiving:
-                    add_ok=None
-                    retry_max=10
-                    retry_count=0
-                    for i in range(retry_max):
-                        try:
-                            retry_count += 1
-                            add_ok = archiver.archiving_add(cluster_name=cfg.cluster_name,
-                                                            nodes=[n[0]],
-                                                            port=n[1].port)
-                            assert add_ok
-                        except AssertionError as e:
-                            time.sleep(1)
-                            continue
-                        else:
-                            break
-                        assert add_ok, "archiver archiving {} add error after {} retry".format(
-                            n.hostname, retry_count)
-
-                archiver_keys = archiver.ssh_keygen(cluster_name=cfg.cluster_name, nodes=postgres_peers)
-                assert all(x == True for x in [bool(n) for n in archiver_keys]), "archiver public key error"
-                assert len(archiver_keys) == len (postgres_peers), "archiver public key error"
-
-                for n in sftpd_archiving:
-                    archiver_authorize_keys_ok = archiver.authorize_keys(cfg.cluster_name,
-                                                                         nodes=[n[0]],
-                                                                         keys=archiver_keys)
-                    assert archiver_authorize_keys_ok, "error archiver authorize keys"
-
-                for n in sftpd_archiving:
-                    known_hosts_ok = archiver.ssh_known_hosts(
-                        cluster_name=cfg.cluster_name,
-                        nodes=postgres_peers,
-                        archiving_server=n[1].hostname,
-                        archiving_server_port=n[1].port)
-                    assert known_hosts_ok, "error validating known_hosts file"
-
-        progress_bar (8, 14)
+                def ssh_archiving(state):
+                    init_ok = archiver.ssh_archiving_init(nodes=sftpd_peers)
+                    sftpd_archiving = archiver.archiver_peers_service(archive_store=cfg.archive_store,
+                                                                      archive_peers=sftpd_peers)
+                    for n in sftpd_archiving:
+                        add_ok = patt.ExecPolicy(retries=9, backoff=1.0, backoff_max=1.0).call(
+                            archiver.archiving_add, cluster_name=cfg.cluster_name, nodes=[n[0]], port=n[1].port)
+                        assert add_ok, "archiver archiving {} add error".format(n[0].hostname)
+
+                    archiver_keys = archiver.ssh_keygen(cluster_name=cfg.cluster_name, nodes=postgres_peers)
+                    assert all(x == True for x in [bool(n) for n in archiver_keys]), "archiver public key error"
+                    assert len(archiver_keys) == len (postgres_peers), "archiver public key error"
+
+                    for n in sftpd_archiving:
+                        archiver_authorize_keys_ok = archiver.authorize_keys(cfg.cluster_name,
+                                                                             nodes=[n[0]],
+                                                                             keys=archiver_keys)
+                        assert archiver_authorize_keys_ok, "error archiver authorize keys"
+
+                    for n in sftpd_archiving:
+                        known_hosts_ok = archiver.ssh_known_hosts(
+                            cluster_name=cfg.cluster_name,
+                            nodes=postgres_peers,
+                            archiving_server=n[1].hostname,
+                            archiving_server_port=n[1].port)
+                        assert known_hosts_ok, "error validating known_hosts file"
+                dag.add ('ssh_archiving', ssh_archiving,
+                         inputs=['archiver', 'firewall', 'vol_walg', 'vol_pgbackrest'],
+                         outputs=['ssh_archiving'], hosts=hosts(postgres_peers, sftpd_peers))
 
         if cfg.floating_ip:
-            patt_patroni.floating_ip_enable(nodes=postgres_peers, floating_ips=cfg.floating_ip)
-
-            progress_bar (9, 14)
-
-        patt_patroni.patroni_init(postgres_version=cfg.postgres_release,
-                                  patroni_version=cfg.patroni_release,
-                                  nodes=postgres_peers, dcs=cfg.dcs_type)
-
-        progress_bar (10, 14)
+            def floating_ip_enable(state):
+                patt_patroni.floating_ip_enable(nodes=postgres_peers, floating_ips=cfg.floating_ip)
+            dag.add ('floating_ip_enable', floating_ip_enable, inputs=['ip_takeover'],
+                     outputs=['floating_ip'], hosts=hosts(postgres_peers))
+
+        def patroni_init(state):
+            patt_patroni.patroni_init(postgres_version=cfg.postgres_release,
+                                      patroni_version=cfg.patroni_release,
+                                      nodes=postgres_peers, dcs=cfg.dcs_type)
+        dag.add ('patroni_init', patroni_init, inputs=['postgres'], outputs=['patroni'],
+                 hosts=hosts(postgres_peers))
 
         if cfg.patroni_template_file:
 
-            cluster_info = patt_patroni.get_cluster_info(nodes=postgres_peers)
-            host=''
-            if 'members' in cluster_info:
-                for m in cluster_info['members']:
-                    if 'role' in m and ( m['role'] == 'leader' or m['role'] == 'sync_standby'):
-                        host = m['host']
-                        if m['state'] == 'running': break
-            p = [x for x in postgres_peers if x.hostname == host or host in x.ip_aliases]
-
-            pass_dict = {}
-            if p:
-                pass_dict = patt_patroni.get_sys_users (p)
-            else:
-                for u in ['replication', 'superuser', 'rewind']:
-                    s = ''.join(secrets.choice(string.ascii_letters + string.digits) for i in range(64))
-                    pass_dict[u] = s
-
-            enable_pg_temp = True if cfg.vol_size_pgsql_temp else False
-
-            try:
-                disable_auto_failover_ok = patt_patroni.disable_auto_failover (
-                    cfg.postgres_release, postgres_peers)
-                assert disable_auto_failover_ok, "disable auto failover error"
-            except AssertionError as e:
-                logger.warning (e)
-
-            raft_only_id = list(set([n.id for n in raft_peers]) - set([n.id for n in postgres_peers]))
-            raft_only_peers=[n for n in raft_peers if n.id in raft_only_id]
             if is_dcs_raft and raft_only_peers:
-                # init
-                patroni_raft_init_ok = patt_patroni.patroni_raft_init (
-                    patroni_version=cfg.patroni_release, nodes=raft_only_peers, raft_data_dir=raft_data_dir)
-                assert patroni_raft_init_ok, "patroni raft init error"
-                # config
-                patroni_raft_configure_ok = patt_patroni.patroni_raft_configure (
-                    nodes=raft_only_peers)
-                assert patroni_raft_configure_ok, "patroni raft configure error"
-                # raft.yaml
-                patroni_raft_controller_configure_ok = patt_patroni.patroni_raft_controller_configure (
+                def raft_controller(state):
+                    # init
+                    patroni_raft_init_ok = patt_patroni.patroni_raft_init (
+                        patroni_version=cfg.patroni_release, nodes=raft_only_peers, raft_data_dir=raft_data_dir)
+                    assert patroni_raft_init_ok, "patroni raft init error"
+                    # config
+                    patroni_raft_configure_ok = patt_patroni.patroni_raft_configure (
+                        nodes=raft_only_peers)
+                    assert patroni_raft_configure_ok, "patroni raft configure error"
+                    # raft.yaml
+                    patroni_raft_controller_configure_ok = patt_patroni.patroni_raft_controller_configure (
+                        cluster_name=cfg.cluster_name,
+                        nodes=raft_only_peers,
+                        raft_peers=raft_peers,
+                        config_file_target='raft.yaml',
+                        user='raft',
+                        raft_data_dir=raft_data_dir)
+                    assert patroni_raft_controller_configure_ok, "patroni raft controller configure error"
+                    # enable
+                    patroni_raft_enable_ok = patt_patroni.patroni_raft_enable (nodes=raft_only_peers)
+                    assert patroni_raft_enable_ok, "patroni raft enable error"
+                dag.add ('raft_controller', raft_controller, inputs=['firewall', 'vol_raft'],
+                         outputs=['raft_controller'], hosts=hosts(raft_only_peers))
+
+            def patroni_configure(state):
+                cluster_info = patt_patroni.get_cluster_info(nodes=postgres_peers)
+                host=''
+                if 'members' in cluster_info:
+                    for m in cluster_info['members']:
+                        if 'role' in m and ( m['role'] == 'leader' or m['role'] == 'sync_standby'):
+                            host = m['host']
+                            if m['state'] == 'running': break
+                p = [x for x in postgres_peers if x.hostname == host or host in x.ip_aliases]
+
+                pass_dict = {}
+                if p:
+                    pass_dict = patt_patroni.get_sys_users (p)
+                else:
+                    for u in ['replication', 'superuser', 'rewind']:
+                        s = ''.join(secrets.choice(string.ascii_letters + string.digits) for i in range(64))
+                        pass_dict[u] = s
+
+                enable_pg_temp = True if cfg.vol_size_pgsql_temp else False
+
+                try:
+                    disable_auto_failover_ok = patt_patroni.disable_auto_failover (
+                        cfg.postgres_release, postgres_peers)
+                    assert disable_auto_failover_ok, "disable auto failover error"
+                except AssertionError as e:
+                    logger.warning (e)
+
+                if is_dcs_raft:
+                    patroni_pg_node_raft_configure_ok = patt_patroni.patroni_pg_node_raft_configure (
+                        nodes=postgres_peers, raft_data_dir=raft_data_dir)
+                    assert patroni_pg_node_raft_configure_ok, "patroni pg node raft configure error"
+
+                # FIXME:
+                # it may be required to re-run patroni_configure after temp_tablespace creation on bootstrap
+                patroni_configure_ok=patt_patroni.patroni_configure(
+                    postgres_version=cfg.postgres_release,
                     cluster_name=cfg.cluster_name,
-                    nodes=raft_only_peers,
+                    template_src=cfg.patroni_template_file,
+                    nodes=postgres_peers,
+                    etcd_peers=etcd_peers,
                     raft_peers=raft_peers,
-                    config_file_target='raft.yaml',
-                    user='raft',
-                    raft_data_dir=raft_data_dir)
-                assert patroni_raft_controller_configure_ok, "patroni raft controller configure error"
-                # enable
-                patroni_raft_enable_ok = patt_patroni.patroni_raft_enable (nodes=raft_only_peers)
-                assert patroni_raft_enable_ok, "patroni raft enable error"
-            if is_dcs_raft:
-                patroni_pg_node_raft_configure_ok = patt_patroni.patroni_pg_node_raft_configure (
-                    nodes=postgres_peers, raft_data_dir=raft_data_dir)
-                assert patroni_pg_node_raft_configure_ok, "patroni pg node raft configure error"
-
-            # FIXME:
-            # it may be required to re-run patroni_configure after temp_tablespace creation on bootstrap
-            patroni_configure_ok=patt_patroni.patroni_configure(
-                postgres_version=cfg.postgres_release,
-                cluster_name=cfg.cluster_name,
-                template_src=cfg.patroni_template_file,
-                nodes=postgres_peers,
-                etcd_peers=etcd_peers,
-                raft_peers=raft_peers,
-                raft_data_dir=raft_data_dir,
-                dcs_type=cfg.dcs_type,
-                config_file_target='patroni.yaml',
-                user='postgres',
-                sysuser_pass=pass_dict,
-                postgres_parameters=cfg.postgres_parameters,
-                pg_hba_list=patt_patroni.cert_pg_hba_list(
-                    db_user=cfg.create_database, key_db='name', key_user='owner'),
-                enable_pg_temp=enable_pg_temp
-            )
-            assert patroni_configure_ok, "patroni configure error"
-
-            progress_bar (11, 14)
-
-            # disable_auto_failover_ok = patt_patroni.disable_auto_failover (
-            #     cfg.postgres_release, postgres_peers)
-            # assert disable_auto_failover_ok, "disable auto failover error"
-
-            patroni_report = patt_patroni.patroni_enable(cfg.postgres_release, cfg.patroni_release,
-                                                         postgres_peers)
-
-            enable_auto_failover_ok = patt_patroni.enable_auto_failover (
-                cfg.postgres_release, postgres_peers)
-            assert enable_auto_failover_ok, "enable auto failover error"
-
-            progress_bar (12, 14)
+                    raft_data_dir=raft_data_dir,
+                    dcs_type=cfg.dcs_type,
+                    config_file_target='patroni.yaml',
+                    user='postgres',
+                    sysuser_pass=pass_dict,
+                    postgres_parameters=cfg.postgres_parameters,
+                    pg_hba_list=patt_patroni.cert_pg_hba_list(
+                        db_user=cfg.create_database, key_db='name', key_user='owner'),
+                    enable_pg_temp=enable_pg_temp
+                )
+                assert patroni_configure_ok, "patroni configure error"
+            dag.add ('patroni_configure', patroni_configure,
+                     inputs=['patroni', 'etcd_report', 'raft_controller', 'ssl_cert', 'vol_raft'],
+                     outputs=['patroni_config'], hosts=hosts(postgres_peers))
+
+            def patroni_enable(state):
+                patroni_report = patt_patroni.patroni_enable(cfg.postgres_release, cfg.patroni_release,
+                                                             postgres_peers)
+
+                enable_auto_failover_ok = patt_patroni.enable_auto_failover (
+                    cfg.postgres_release, postgres_peers)
+                assert enable_auto_failover_ok, "enable auto failover error"
+            dag.add ('patroni_enable', patroni_enable,
+                     inputs=['patroni_config', 'ip_takeover', 'floating_ip', 'firewall', 'archiver'],
+                     outputs=['patroni_enabled'], hosts=hosts(postgres_peers))
 
             if cfg.haproxy_template_file:
-                patt_haproxy.haproxy_configure(cluster_name=cfg.cluster_name,
-                                               template_src=cfg.haproxy_template_file,
-                                               nodes=haproxy_peers,
-                                               postgres_nodes=postgres_peers,
-                                               config_file_target='/etc/haproxy/haproxy.cfg')
-                progress_bar (13, 14)
-
-            progress_bar (14, 14)
+                def haproxy_configure(state):
+                    patt_haproxy.haproxy_configure(cluster_name=cfg.cluster_name,
+                                                   template_src=cfg.haproxy_template_file,
+                                                   nodes=haproxy_peers,
+                                                   postgres_nodes=postgres_peers,
+                                                   config_file_target='/etc/haproxy/haproxy.cfg')
+                dag.add ('haproxy_configure', haproxy_configure, inputs=['firewall'],
+                         outputs=['haproxy'], hosts=hosts(haproxy_peers))
 
             if postgres_peers:
-                pg_is_ready = patt_postgres.postgres_wait_ready (postgres_peers=postgres_peers,
-                                                                 postgres_version=cfg.postgres_release,
-                                                                 timeout=200)
-                assert pg_is_ready, "no postgres node available"
-
-                postgres_leader=None
-                for i in range(30):
-                    try:
-                        postgres_leader = patt_patroni.get_leader (postgres_peers)
-                        if not postgres_leader: continue
-                        assert isinstance(postgres_leader[0], patt.Node)
-                    except AssertionError as e:
-                        time.sleep(11)
-                        continue
-                    else:
-                        break
-                assert isinstance(postgres_leader[0], patt.Node), "no postgres leader available"
-
-                if cfg.create_role:
-                    for i in cfg.create_role:
-                        role_options = i['options'] if 'options' in i else []
-                        patt_postgres.postgres_create_role(postgres_leader, i['name'], role_options)
-
-                if cfg.create_database:
-                    for i in cfg.create_database:
-                        patt_postgres.postgres_create_database(postgres_leader, i['name'], i['owner'])
-
-                if cfg.vol_size_pgsql_temp:
-                    patt_postgres.postgres_create_tablespace(
-                        postgres_leader,
-                        tablespace_name='pgsql_temp',
-                        # hardcoded value (cf: patt_patroni.py)
-                        location_path='/var/cache/postgres_temp',
-                        role_name='PUBLIC',
-                        template_file="./config/pg_create_tablespace.tmpl");
-
-                if cfg.pg_master_exec:
-                    for s in cfg.pg_master_exec:
-                        patt_postgres.postgres_exec(postgres_leader, s)
-
-                patt_postgres.postgres_gc_cron(nodes=postgres_peers,
-                                               vaccum_full_df_percent=cfg.gc_cron_df_pc,
-                                               target=cfg.gc_cron_target,
-                                               postgres_version=cfg.postgres_release)
-
-                if cfg.archive_store and postgres_peers:
-                    backup_service_command_ok = archiver.backup_service_command(
-                        nodes=postgres_peers,
-                        command='enable',
-                        postgres_version=cfg.postgres_release)
-                    assert backup_service_command_ok, "enable backup_service_command error"
+                def postgres_gc_cron(state):
+                    patt_postgres.postgres_gc_cron(nodes=postgres_peers,
+                                                   vaccum_full_df_percent=cfg.gc_cron_df_pc,
+                                                   target=cfg.gc_cron_target,
+                                                   postgres_version=cfg.postgres_release)
+                dag.add ('postgres_gc_cron', postgres_gc_cron, inputs=['postgres'],
+                         outputs=['gc_cron'], hosts=hosts(postgres_peers))
+
+                def postgres_leader_setup(state):
+                    pg_is_ready = patt_postgres.postgres_wait_ready (postgres_peers=postgres_peers,
+                                                                     postgres_version=cfg.postgres_release,
+                                                                     timeout=200)
+                    assert pg_is_ready, "no postgres node available"
+
+                    postgres_leader = patt.ExecPolicy(timeout=330, retries=30, backoff=1.0, backoff_max=11.0).call(
+                        patt_patroni.get_leader, postgres_peers,
+                        ok=lambda p: bool(p) and isinstance(p[0], patt.Node))
+                    assert postgres_leader and isinstance(postgres_leader[0], patt.Node), "no postgres leader available"
+
+                    if cfg.create_role:
+                        for i in cfg.create_role:
+                            role_options = i['options'] if 'options' in i else []
+                            patt_postgres.postgres_create_role(postgres_leader, i['name'], role_options)
+
+                    if cfg.create_database:
+                        for i in cfg.create_database:
+                            patt_postgres.postgres_create_database(postgres_leader, i['name'], i['owner'])
+
+                    if cfg.vol_size_pgsql_temp:
+                        patt_postgres.postgres_create_tablespace(
+                            postgres_leader,
+                            tablespace_name='pgsql_temp',
+                            # hardcoded value (cf: patt_patroni.py)
+                            location_path='/var/cache/postgres_temp',
+                            role_name='PUBLIC',
+                            template_file="./config/pg_create_tablespace.tmpl");
+
+                    if cfg.pg_master_exec:
+                        for s in cfg.pg_master_exec:
+                            patt_postgres.postgres_exec(postgres_leader, s)
+
+                    if cfg.archive_store and postgres_peers:
+                        backup_service_command_ok = archiver.backup_service_command(
+                            nodes=postgres_peers,
+                            command='enable',
+                            postgres_version=cfg.postgres_release)
+                        assert backup_service_command_ok, "enable backup_service_command error"
+                    return {'postgres_leader': postgres_leader}
+                dag.add ('postgres_leader_setup', postgres_leader_setup,
+                         inputs=['patroni_enabled', 'archiver', 'ssh_archiving', 'gc_cron'],
+                         outputs=['postgres_leader'], hosts=hosts(postgres_peers))
 
-        if is_dcs_etcd:
-            print ("\nEtcd Cluster\n{}".format(etcd_report))
-            logger.info ("Etcd Cluster {}".format(etcd_report))
+        if postgres_peers or sftpd_peers:
+            def health(state):
+                health_init = patt_health.health_init (postgres_peers + sftpd_peers)
+                assert health_init, "health init error"
+                health_configure = patt_health.health_configure (postgres_peers + sftpd_peers, cluster_config)
+                assert health_configure, "health configure error"
+                health_enable = patt_health.health_enable (postgres_peers + sftpd_peers)
+                assert health_enable, "health enable error"
+            dag.add ('health', health,
+                     inputs=['firewall', 'vol_pgsql', 'vol_pgsql_temp', 'vol_pgsql_safe',
+                             'vol_walg', 'vol_pgbackrest', 'postgres_leader'],
+                     outputs=['health'], hosts=hosts(postgres_peers, sftpd_peers))
+
+        if state_nodes:
+            for t in dag.tasks.values():
+                if t.hosts: task_record (t)
+
+        state = {}
+        try:
+            state = dag.run ()
+        finally:
+            progress.close()
+            patt.set_exec_line_hook (None)
+            if cfg.trace:
+                patt_trace.export (cfg.trace)
+            print ("\n{}".format(dag.report()))
+            logger.info ("pipeline timing\n{}".format(dag.report()))
+
+        if is_dcs_etcd and 'etcd_report' in state:
+            print ("\nEtcd Cluster\n{}".format(state['etcd_report']))
+            logger.info ("Etcd Cluster {}".format(state['etcd_report']))
 
         if cfg.patroni_template_file:
             patroni_cluster_info = patt_patroni.get_cluster_info(postgres_peers)
             print ("\nPostgres Cluster\n{}".format(pformat(patroni_cluster_info)))
             logger.info ("Postgres Cluster\n{}".format(pformat(patroni_cluster_info)))
 
-        if postgres_peers or sftpd_peers:
-            health_init = patt_health.health_init (postgres_peers + sftpd_peers)
-            assert health_init, "health init error"
-            health_configure = patt_health.health_configure (postgres_peers + sftpd_peers, cluster_config)
-            assert health_configure, "health configure error"
-            health_enable = patt_health.health_enable (postgres_peers + sftpd_peers)
-            assert health_enable, "health enable error"
+        logger.info ("ssh pool stats: {}".format(patt.ssh_pool_stats()))
+        patt.shutdown()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+import patt_trace
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('patt_dag')
+
+class DagError(Exception):
+    pass
+
+"""
+a named unit of work in the deployment pipeline
+
+fn:      callable(state) returning a dict merged into the shared state (or None)
+inputs:  state keys read by fn, the task wait for the tasks producing them
+outputs: state keys produced by fn
+after:   extra task names to wait for (ordering without data)
+hosts:   hostnames touched, two tasks sharing a host never run concurrently
+"""
+class Task(object):
+    def __init__(self, name, fn, inputs=[], outputs=[], after=[], hosts=[]):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.hosts = set(hosts)
+        self.deps = set()
+        self.start = None
+        self.stop = None
+        self.error = None
+        self.skipped = False
+
+    def duration(self):
+        if self.start is None or self.stop is None:
+            return 0.0
+        return self.stop - self.start
+
+"""
+run the tasks as soon as their dependencies are done and their hosts are free.
+inputs without any producer in the dag are considered available.
+the first task error stop the scheduling, the running tasks are waited for
+and the error is raised again.
+skip(task) return True when the task is already converged, it is then not run
+provided all its dependencies were skipped too.
+"""
+class Dag(object):
+    def __init__(self, max_workers=4, on_done=None, skip=None):
+        self.tasks = {}
+        self.order = []
+        self.max_workers = max_workers
+        self.on_done = on_done
+        self.skip = skip
+        self.t0 = None
+        self.t1 = None
+
+    def add(self, name, fn, inputs=[], outputs=[], after=[], hosts=[]):
+        if name in self.tasks:
+            raise DagError ("duplicate task {}".format(name))
+        t = Task(name, fn, inputs=inputs, outputs=outputs, after=after, hosts=hosts)
+        self.tasks[name] = t
+        self.order.append(name)
+        return t
+
+    def _resolve(self):
+        producer = {}
+        for n in self.order:
+            for o in self.tasks[n].outputs:
+                if o in producer:
+                    raise DagError ("{} produced by {} and {}".format(o, producer[o], n))
+                producer[o] = n
+        for n in self.order:
+            t = self.tasks[n]
+            t.deps = set([producer[i] for i in t.inputs if i in producer])
+            t.deps |= set([a for a in t.after if a in self.tasks])
+            t.deps.discard(n)
+        # cycle check (Kahn)
+        indeg = {n: len(self.tasks[n].deps) for n in self.order}
+        ready = [n for n in self.order if indeg[n] == 0]
+        seen = 0
+        while ready:
+            n = ready.pop()
+            seen += 1
+            for m in self.order:
+                if n in self.tasks[m].deps:
+                    indeg[m] -= 1
+                    if indeg[m] == 0:
+                        ready.append(m)
+        if seen != len(self.order):
+            raise DagError ("dependency cycle in {}".format(
+                [n for n in self.order if indeg[n] > 0]))
+
+    def _run_task(self, t, state):
+        t.start = time.monotonic()
+        token = patt_trace.set_step (t.name)
+        try:
+            logger.info ("task {} start".format(t.name))
+            with patt_trace.span (t.name, cat='task', hosts=len(t.hosts)):
+                r = t.fn(state)
+            return r if r else {}
+        finally:
+            patt_trace.reset_step (token)
+            t.stop = time.monotonic()
+            logger.info ("task {} done in {:.2f}s".format(t.name, t.duration()))
+
+    def run(self, state=None):
+        state = {} if state is None else state
+        self._resolve()
+        done = set()
+        running = {}
+        busy_hosts = set()
+        error = None
+        self.t0 = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='patt_dag') as pool:
+            while True:
+                scan = error is None
+                while scan:
+                    scan = False
+                    for n in self.order:
+                        t = self.tasks[n]
+                        if n in done or t in running.values(): continue
+                        if not t.deps <= done: continue
+                        if self.skip and all([self.tasks[d].skipped for d in t.deps]) and self.skip(t):
+                            logger.info ("task {} converged, skipped".format(t.name))
+                            t.skipped = True
+                            done.add(t.name)
+                            if self.on_done: self.on_done(len(done), len(self.order), t)
+                            scan = True
+                            continue
+                        if t.hosts & busy_hosts: continue
+                        if len(running) >= self.max_workers: break
+                        busy_hosts |= t.hosts
+                        running[pool.submit(self._run_task, t, state)] = t
+                if not running:
+                    break
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for f in finished:
+                    t = running.pop(f)
+                    busy_hosts -= t.hosts
+                    try:
+                        state.update(f.result())
+                    except BaseException as e:
+                        t.error = e
+                        logger.error ("task {} failed: {}".format(t.name, e))
+                        if error is None: error = e
+                    else:
+                        done.add(t.name)
+                        if self.on_done: self.on_done(len(done), len(self.order), t)
+        self.t1 = time.monotonic()
+        if error is not None:
+            raise error
+        return state
+
+    """
+    return the chain of tasks gating the end of the run:
+    from the last task done, walk back through the dependency done last
+    """
+    def critical_path(self):
+        ran = [t for t in self.tasks.values() if t.stop is not None and t.error is None]
+        if not ran: return []
+        t = max(ran, key=lambda x: x.stop)
+        path = [t]
+        while True:
+            deps = [self.tasks[d] for d in t.deps if self.tasks[d].stop is not None]
+            if not deps: break
+            t = max(deps, key=lambda x: x.stop)
+            path.append(t)
+        return list(reversed(path))
+
+    def report(self):
+        if self.t0 is None: return ""
+        total = (self.t1 if self.t1 else time.monotonic()) - self.t0
+        lines = ["{:<32} {:>9} {:>9} {:>9}".format("task", "start", "duration", "hosts")]
+        for t in sorted([t for t in self.tasks.values() if t.start is not None], key=lambda x: x.start):
+            lines.append("{:<32} {:>8.1f}s {:>8.1f}s {:>9}".format(
+                t.name, t.start - self.t0, t.duration(), len(t.hosts)))
+        skipped = [t.name for t in self.tasks.values() if t.skipped]
+        if skipped:
+            lines.append("converged (skipped): {}".format(", ".join(skipped)))
+        path = self.critical_path()
+        lines.append("critical path ({:.1f}s of {:.1f}s): {}".format(
+            sum([t.duration() for t in path]), total, " -> ".join([t.name for t in path])))
+        return "\n".join(lines)
@@ -74,11 +74,9 @@ def wca (rtt_matrix, cnt=4):
     return int(sum(result)/len(result)) + cnt
 
 def etcd_sort_by_version (nodes):
-    for i in range(10):
-        resp = patt.exec_script (nodes=nodes, src="./dscripts/d10.etcd.sh", args=['version'], sudo=True)
-        log_results (resp)
-        if all(x == False for x in [bool(n.error) for n in resp]): break
-        time.sleep(3.0)
+    resp = patt.exec_script (nodes=nodes, src="./dscripts/d10.etcd.sh", args=['version'], sudo=True,
+                             policy=patt.ExecPolicy(retries=9, backoff=3.0, backoff_max=3.0, idempotent=True))
+    log_results (resp)
     for r in resp:
         tmp = (r.hostname, r.out.strip())
         for idx, item in enumerate(nodes):
@@ -140,10 +138,9 @@ def etcd_init(cluster_name, nodes, etcd_template="config/etcd.conf.tmpl"):
         log_results (result)
 
         bad_members = get_members([init_node], cluster_name, 'bad')
-        for i in range(3):
-            good_members = get_members([init_node], cluster_name, 'ok')
-            if good_members: break
-            time.sleep(11) #  > than dscripts/d10.etcd.sh file locks wait
+        #  backoff > than dscripts/d10.etcd.sh file locks wait
+        good_members = patt.ExecPolicy(retries=2, backoff=11.0, backoff_max=11.0).call(
+            get_members, [init_node], cluster_name, 'ok')
 
         logger.info ("member ok {}".format (good_members))
         logger.info ("member ko {}".format (bad_members))
@@ -183,12 +180,11 @@ def etcd_init(cluster_name, nodes, etcd_template="config/etcd.conf.tmpl"):
         assert ctrl, "no usable controller node"
         # only the first control node is used to add member
 
-        for i in range(10):
-            result = patt.exec_script (nodes=[ctrl[0]], src="./dscripts/d10.etcd.sh",
-                                       args=['member_add'] + [cluster_name] + id_hosts, sudo=True)
-            log_results (result)
-            if all(x == False for x in [bool(n.error) for n in result]): break
-            time.sleep(3.0)
+        result = patt.exec_script (nodes=[ctrl[0]], src="./dscripts/d10.etcd.sh",
+                                   args=['member_add'] + [cluster_name] + id_hosts, sudo=True,
+                                   policy=patt.ExecPolicy(retries=9, backoff=3.0, backoff_max=3.0,
+                                                          idempotent=True))
+        log_results (result)
 
         result = patt.exec_script (nodes=members, src="./dscripts/d10.etcd.sh", payload=payload,
                                    args=['config'] + ['existing'] + [cluster_name] +
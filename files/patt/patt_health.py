@@ -51,6 +51,8 @@ def health_configure(nodes, cluster_config_path=None):
              'config/monitoring-httpd-00.conf.dnf', # 11
              'monitoring/xhtml.py',                 # 12
              cluster_config_path,                   # 13
+             'monitoring/df_cluster.wsgi',          # 14
+             'monitoring/metrics.wsgi',             # 15
              ]
 
     result = patt.exec_script (nodes=nodes, src="./dscripts/d50.health.sh", payload=payload,
@@ -66,7 +68,9 @@ def health_configure(nodes, cluster_config_path=None):
                                [os.path.basename(payload[7])] +
                                [os.path.basename(payload[8])] +
                                [os.path.basename(payload[9])] +
-                               [os.path.basename(payload[13])],
+                               [os.path.basename(payload[13])] +
+                               [os.path.basename(payload[14])] +
+                               [os.path.basename(payload[15])],
                                sudo=True)
     log_results (result)
     return all(x == False for x in [bool(n.error) for n in result])
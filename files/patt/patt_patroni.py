@@ -177,7 +177,7 @@ def get_sys_users (postgres_peers, patroni_config='/var/lib/pgsql/patroni.yaml')
     for n in p:
         try:
             result = patt.exec_script (nodes=[n], src="./dscripts/patroni_info.py", args=['-i', 'sys_user'],
-                                        sudo=True, log_call=False)
+                                        sudo=True, log_call=False, hide_stdout=True)
         except:
             continue
         else:
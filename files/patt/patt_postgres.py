@@ -46,7 +46,7 @@ def postgres_get_cert  (q, postgres_user='postgres', nodes=[]):
     for n in nodes:
         try:
             result = patt.exec_script (nodes=[n], src="dscripts/ssl_cert_postgres.py",
-                                        args=['-u', postgres_user, e], sudo=True)
+                                        args=['-u', postgres_user, e], sudo=True, hide_stdout=True)
         except:
             continue
         else:
@@ -80,39 +80,36 @@ def postgres_ssl_cert(cluster_name,
             self_ca_dir = self_home + '/' + '.patt/ca'
             Path(self_ca_dir).mkdir(parents=True, exist_ok=True, mode=0o700)
 
+    ca_node = sorted(nodes, key=lambda n: n.hostname)[0]
+
+    def get_or_create_ca (q):
+        try:
+            tmp = postgres_get_cert (q=q, postgres_user=postgres_user, nodes=ca_provider)
+            assert isinstance(tmp, (str, bytes))
+            return tmp
+        except:
+            # generate CA on first node and retry
+            result = patt.exec_script (nodes=[ca_node],
+                                       src="dscripts/ssl_cert_postgres.py",
+                                       payload=ssl_script,
+                                       args=['-c'] + [cluster_name] +
+                                       ['-s'] + [os.path.basename (ssl_script)] +
+                                       ['-u'] + [postgres_user] +
+                                       ['--ca_country_name', "'UK'"] +
+                                       ['--ca_state_or_province_name', "'United Kingdom'"] +
+                                       ['--ca_locality_name', "'Cambridge'"] +
+                                       ['--ca_organization_name', "'Patroni Postgres Cluster'"] +
+                                       ['--ca_common_name', "'CA {}'".format (cluster_name)] +
+                                       ['--ca_not_valid_after', "'3650'"] +
+                                       ['-p'] + [p.hostname for p in nodes] +
+                                       list ([" ".join(p.ip_aliases) for p in nodes]),
+                                       sudo=True)
+            log_results (result)
+            return postgres_get_cert (q=q, postgres_user=postgres_user, nodes=[ca_node])
+
     for i in ['root.key', 'root.crt']:
-        tmp = None
-        for k in range (5):
-            try:
-                tmp = postgres_get_cert (q=i, postgres_user=postgres_user, nodes=ca_provider)
-                assert isinstance(tmp, (str, bytes))
-            except:
-                # generate CA on first node and retry
-                result = patt.exec_script (nodes=[sorted(nodes, key=lambda n: n.hostname)[0]],
-                                           src="dscripts/ssl_cert_postgres.py",
-                                           payload=ssl_script,
-                                           args=['-c'] + [cluster_name] +
-                                           ['-s'] + [os.path.basename (ssl_script)] +
-                                           ['-u'] + [postgres_user] +
-                                           ['--ca_country_name', "'UK'"] +
-                                           ['--ca_state_or_province_name', "'United Kingdom'"] +
-                                           ['--ca_locality_name', "'Cambridge'"] +
-                                           ['--ca_organization_name', "'Patroni Postgres Cluster'"] +
-                                           ['--ca_common_name', "'CA {}'".format (cluster_name)] +
-                                           ['--ca_not_valid_after', "'3650'"] +
-                                           ['-p'] + [p.hostname for p in nodes] +
-                                           list ([" ".join(p.ip_aliases) for p in nodes]),
-                                           sudo=True)
-                log_results (result)
-                tmp = postgres_get_cert (q=i, postgres_user=postgres_user,
-                                         nodes=[sorted(nodes, key=lambda n: n.hostname)[0]])
-                if isinstance(tmp, (str, bytes)):
-                    break
-                else:
-                    time.sleep (3)
-                    continue
-            else:
-                break
+        tmp = patt.ExecPolicy(retries=4, backoff=3.0, backoff_max=3.0).call(
+            get_or_create_ca, i, ok=lambda t: isinstance(t, (str, bytes)))
 
         assert isinstance(tmp, (str, bytes))
 
@@ -130,7 +127,7 @@ def postgres_ssl_cert(cluster_name,
                 result = patt.exec_script (nodes=nodes, src="dscripts/ssl_cert_postgres.sh",
                                             payload=tmp_dir + '/' + i,
                                             args=['copy_ca', os.path.basename (tmp_dir + '/' + i), i],
-                                            sudo=True)
+                                            sudo=True, hide_stdout=True)
                 log_results (result, hide_stdout=True)
 
 
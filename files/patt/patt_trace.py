@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import contextvars
+import json
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger('patt_trace')
+
+"""
+run timing and tracing
+
+spans record a name, a category, the host, the pipeline step they belong to
+(the dag task name) and free args (script, bytes, status...).
+nothing is recorded unless enable() was called.
+export() write a Chrome trace (chrome://tracing, perfetto) or json lines
+when the file name end with .jsonl
+"""
+
+enabled = False
+_spans = []
+_lock = threading.Lock()
+_t0 = time.monotonic()
+_epoch0 = time.time()
+_step = contextvars.ContextVar('patt_trace_step', default=None)
+
+class Span(object):
+    def __init__(self, name, cat='patt', host=None, step=None, **args):
+        self.name = name
+        self.cat = cat
+        self.host = host
+        self.step = step
+        self.args = args
+        self.start = None
+        self.stop = None
+        self.tid = threading.get_ident()
+
+    def duration(self):
+        if self.start is None or self.stop is None:
+            return 0.0
+        return self.stop - self.start
+
+    def to_dict(self):
+        return {'name': self.name,
+                'cat': self.cat,
+                'host': self.host,
+                'step': self.step,
+                'start': round(_epoch0 + self.start - _t0, 6),
+                'duration': round(self.duration(), 6),
+                'args': self.args}
+
+def enable (flag=True):
+    global enabled, _t0, _epoch0
+    with _lock:
+        enabled = bool(flag)
+        _t0 = time.monotonic()
+        _epoch0 = time.time()
+        _spans.clear()
+
+"""
+set the current step for the calling context, spans created in the context
+(and in the threads started with wrap()) are tagged with it
+"""
+def set_step (name):
+    return _step.set (name)
+
+def reset_step (token):
+    _step.reset (token)
+
+def current_step ():
+    return _step.get()
+
+"""
+return fn bound to a copy of the current context so the step is kept
+when fn run in an executor thread
+"""
+def wrap (fn):
+    if not enabled:
+        return fn
+    ctx = contextvars.copy_context()
+    def run (*args, **kwargs):
+        return ctx.run (fn, *args, **kwargs)
+    return run
+
+"""
+record a span measured by the caller (time.monotonic values)
+"""
+def add (name, start, stop, cat='patt', host=None, **args):
+    if not enabled: return None
+    s = Span (name, cat=cat, host=host, step=current_step(), **args)
+    s.start = start
+    s.stop = stop
+    with _lock:
+        _spans.append (s)
+    return s
+
+"""
+time the block and record it as a span, args may be completed in the block:
+    with patt_trace.span('upload', host=n.hostname, script=src) as s:
+        s.args['bytes'] = len(data)
+"""
+class span(object):
+    def __init__(self, name, cat='patt', host=None, **args):
+        self.s = Span (name, cat=cat, host=host, step=current_step(), **args)
+
+    def __enter__(self):
+        self.s.start = time.monotonic()
+        return self.s
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.s.stop = time.monotonic()
+        if exc_type:
+            self.s.args['error'] = str(exc_value)
+        if enabled:
+            with _lock:
+                _spans.append (self.s)
+        return False
+
+def spans ():
+    with _lock:
+        return list(_spans)
+
+def _chrome (spans):
+    events = []
+    tids = {}
+    for s in spans:
+        # one timeline row per host (or thread when no host)
+        row = s.host if s.host else "thread {}".format(s.tid)
+        if row not in tids:
+            tids[row] = len(tids) + 1
+            events.append ({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tids[row],
+                            'args': {'name': row}})
+        args = dict(s.args)
+        if s.step: args['step'] = s.step
+        events.append ({'name': s.name,
+                        'cat': s.cat,
+                        'ph': 'X',
+                        'ts': int((s.start - _t0) * 1000000),
+                        'dur': int(s.duration() * 1000000),
+                        'pid': os.getpid(),
+                        'tid': tids[row],
+                        'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def export (filename):
+    result = spans ()
+    try:
+        with open (filename, 'w') as f:
+            if filename.endswith ('.jsonl'):
+                for s in sorted (result, key=lambda x: x.start):
+                    f.write (json.dumps (s.to_dict(), default=str) + '\n')
+            else:
+                json.dump (_chrome (result), f, default=str)
+        logger.info ("{} spans written to {}".format(len(result), filename))
+    except OSError as e:
+        logger.error ("trace export {}".format(str(e)))
@@ -15,13 +15,16 @@ with the following attribute
 
 import base64
 import getpass
+import io
 import os
+import selectors
 import socket
 import sys
 import traceback
 from paramiko.py3compat import input
 import logging
 import time
+import threading
 import paramiko
 
 try:
@@ -145,6 +148,16 @@ class ssh_client:
             sys.exit(1)
 
 
+    """
+    true if the underlying transport is connected and authenticated
+    """
+    def is_active(self):
+        try:
+            t = self.client.get_transport()
+            return t is not None and t.is_active() and t.is_authenticated()
+        except:
+            return False
+
     """
     return a new channel
     """
@@ -162,7 +175,8 @@ class ssh_client:
         return self.client._transport.open_sftp_client()
 
     def close(self):
-        self.client.close()
+        if self.client:
+            self.client.close()
 
     """
     open on interactive shell
@@ -174,42 +188,49 @@ class ssh_client:
         c.invoke_shell()
         interactive.interactive_shell(c)
 
+    """
+    start cmd on channel c and return an exec_stream,
+    data (bytes) is fed on stdin and stdin closed when not None
+    """
+    def _exec_start (self, c, cmd, data=None):
+        cmd = 'echo $$ && exec ' + cmd
+        c.exec_command(cmd)
+        if data is not None:
+            c.sendall(data)
+            c.shutdown_write()
+        return exec_stream(self.hostname, c)
+
+    """
+    start a command without waiting, the output is read with multiplex()
+    """
+    def exec_start (self, cmd, data=None):
+        return self._exec_start (self.new_channel(), cmd, data)
+
     """
     exec command
     """
     def exec (self, cmd, bufsize=-1):
-        cmd = 'echo $$ && exec ' + cmd
-        try:
-            c = self.new_channel()
-            c.exec_command(cmd)
-            r = ssh_client.CmdResp()
-            r.hostname = self.hostname
-            r.stdin = c.makefile_stdin("wb", bufsize)
-            r.stdout = c.makefile("r", bufsize)
-            r.stderr = c.makefile_stderr("r", bufsize)
-            r.pid = int(r.stdout.readline())
-            r.status = c.recv_exit_status()
-            return r
-        except:
-            raise
+        c = self.new_channel()
+        s = self._exec_start (c, cmd)
+        s.wait()
+        return s.result(c.makefile_stdin("wb", bufsize))
+
+    """
+    exec command feeding data (bytes) on its stdin,
+    stdin is closed once data is sent
+    """
+    def exec_stdin (self, cmd, data, bufsize=-1):
+        s = self._exec_start (self.new_channel(), cmd, data)
+        s.wait()
+        return s.result()
 
     """
     exec command on channel
     """
     def exec_channel (self, c,  cmd, bufsize=-1):
-        try:
-            cmd = 'echo $$ && exec ' + cmd
-            c.exec_command(cmd)
-            r = ssh_client.CmdResp()
-            r.hostname = self.hostname
-            r.stdin = c.makefile_stdin("wb", bufsize)
-            r.stdout = c.makefile("r", bufsize)
-            r.stderr = c.makefile_stderr("r", bufsize)
-            r.pid = int(r.stdout.readline())
-            r.status = c.recv_exit_status()
-            return r
-        except:
-            raise
+        s = self._exec_start (c, cmd)
+        s.wait()
+        return s.result(c.makefile_stdin("wb", bufsize))
 
     """
     send a single file using mktemp on target
@@ -224,15 +245,257 @@ class ssh_client:
             if r.status == 0:
                 tmp_dir = r.stdout.read().decode().strip()
                 sftp = self.new_sftp()
-                src = os.path.abspath (src)
-                file_name = os.path.basename (src)
-                dst = tmp_dir + '/' + file_name
-                sftp.put (src, dst)
-                if mode:
-                    sftp.chmod (dst, mode)
+                try:
+                    src = os.path.abspath (src)
+                    file_name = os.path.basename (src)
+                    dst = tmp_dir + '/' + file_name
+                    sftp.put (src, dst)
+                    if mode:
+                        sftp.chmod (dst, mode)
+                finally:
+                    sftp.close()
                 return dst
             else:
                 logger.error ("{}".format (r.stderr.read().decode()))
                 raise IOError
         except:
             raise
+
+
+"""
+exec_stream a started command read incrementally
+
+stdout and stderr are drained as they arrive (a chatty command can not fill
+the channel window and stall), split in lines and kept for the final result.
+the first stdout line is the remote pid ('echo $$' prefix).
+deadline (time.monotonic) bound the command run time, past it the channel
+is closed, timed_out set and status left to -1.
+"""
+class exec_stream:
+
+    def __init__(self, hostname, channel, deadline=None):
+        self.hostname = hostname
+        self.channel = channel
+        self.deadline = deadline
+        self.timed_out = False
+        self.done = False
+        self.start = time.monotonic()
+        self.stop = None
+        self.pid = -1
+        self.status = -1
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self._partial = {'stdout': b'', 'stderr': b''}
+
+    def _feed(self, name, data, flush=False):
+        buf = self._partial[name] + data
+        lines = buf.split(b'\n')
+        self._partial[name] = b'' if flush else lines.pop()
+        result = []
+        for l in lines:
+            if flush and not l: continue
+            if name == 'stdout' and self.pid == -1:
+                try:
+                    self.pid = int(l)
+                    continue
+                except ValueError:
+                    self.pid = 0
+            if name == 'stdout':
+                self.stdout += l + b'\n'
+            else:
+                self.stderr += l + b'\n'
+            result.append((name, l.decode(errors='replace')))
+        return result
+
+    """
+    read what is available and return the complete lines as [(stream, line)]
+    """
+    def read(self):
+        result = []
+        c = self.channel
+        while c.recv_ready():
+            result += self._feed('stdout', c.recv(32768))
+        while c.recv_stderr_ready():
+            result += self._feed('stderr', c.recv_stderr(32768))
+        return result
+
+    def exited(self):
+        return self.channel.exit_status_ready() or self.channel.closed
+
+    """
+    read the remaining output, flush the last incomplete lines and set status
+    """
+    def finish(self):
+        result = self.read()
+        if self.channel.exit_status_ready():
+            self.status = self.channel.recv_exit_status()
+        result += self.read()
+        result += self._feed('stdout', b'', flush=True)
+        result += self._feed('stderr', b'', flush=True)
+        self.close()
+        self.done = True
+        self.stop = time.monotonic()
+        return result
+
+    def close(self):
+        try:
+            self.channel.close()
+        except:
+            pass
+
+    """
+    wait for the command end, the output is only captured
+    """
+    def wait(self, timeout=None):
+        for l in multiplex([self], timeout=timeout):
+            pass
+
+    """
+    return the captured output as a CmdResp
+    """
+    def result(self, stdin=None):
+        r = ssh_client.CmdResp()
+        r.hostname = self.hostname
+        r.stdin = stdin if stdin else -1
+        r.stdout = io.BytesIO(bytes(self.stdout))
+        r.stderr = io.BytesIO(bytes(self.stderr))
+        r.pid = self.pid
+        r.status = self.status
+        return r
+
+"""
+multiplex the output of N exec_stream through a selector and yield
+(hostname, stream, line) as they arrive, stream is 'stdout' or 'stderr'.
+once done each exec_stream hold its status and captured output.
+the streams past their own deadline are closed and flagged timed_out,
+on_exit(stream) is called as soon as each stream is done.
+raise TimeoutError (and close the pending channels) if not done in time.
+"""
+def multiplex (streams, timeout=None, on_exit=None):
+    deadline = time.monotonic() + timeout if timeout else None
+    sel = selectors.DefaultSelector()
+    pending = set()
+    for s in streams:
+        sel.register(s.channel, selectors.EVENT_READ, s)
+        pending.add(s)
+    try:
+        while pending:
+            wait = 0.5
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    for s in pending:
+                        s.close()
+                    raise TimeoutError ("{} not done after {}s".format(
+                        [s.hostname for s in pending], timeout))
+            for key, mask in sel.select(wait):
+                s = key.data
+                for name, l in s.read():
+                    yield (s.hostname, name, l)
+            now = time.monotonic()
+            for s in [s for s in pending if s.deadline is not None and now > s.deadline]:
+                if not s.exited():
+                    s.timed_out = True
+                    s.close()
+            for s in [s for s in pending if s.exited()]:
+                sel.unregister(s.channel)
+                pending.discard(s)
+                for name, l in s.finish():
+                    yield (s.hostname, name, l)
+                if on_exit:
+                    on_exit(s)
+    finally:
+        sel.close()
+
+"""
+ssh_pool keep one authenticated ssh_client per (login, hostname, port, keyfile)
+for the life of the process.
+
+get() return a connected client, reusing the pooled one when its transport is
+still active or reconnecting transparently otherwise.
+on_connect(hostname, start, stop) is called after each new connection.
+Pooled clients must not be closed by the caller, use discard() or close_all().
+
+a pool inherited by a forked child is reset on first use in that child,
+the parent transports are left untouched.
+"""
+class ssh_pool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.clients = {}
+        self.key_locks = {}
+        self.connect_count = 0
+        self.reuse_count = 0
+        self.on_connect = None
+
+    def _fork_check(self):
+        if self.pid != os.getpid():
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+            self.clients = {}
+            self.key_locks = {}
+            self.connect_count = 0
+            self.reuse_count = 0
+
+    def _key_lock(self, key):
+        with self.lock:
+            self._fork_check()
+            if key not in self.key_locks:
+                self.key_locks[key] = threading.Lock()
+            return self.key_locks[key]
+
+    def get(self, hostname, login=None, port=22, keyfile=None, timeout=None):
+        key = (login, hostname, port, keyfile)
+        with self._key_lock(key):
+            clt = self.clients.get(key)
+            if clt and clt.is_active():
+                with self.lock:
+                    self.reuse_count += 1
+                return clt
+            if clt:
+                logger.info ("reconnect:{}@{} :{}".format(clt.username, clt.hostname, clt.port))
+                try:
+                    clt.close()
+                except:
+                    pass
+            start = time.monotonic()
+            clt = ssh_client (hostname, port=port, login=login, keyfile=keyfile)
+            clt.open(timeout=timeout)
+            if self.on_connect:
+                self.on_connect(hostname, start, time.monotonic())
+            if not clt.is_active():
+                raise IOError ("ssh connection failed: {}".format(hostname))
+            with self.lock:
+                self.connect_count += 1
+                self.clients[key] = clt
+            return clt
+
+    def discard(self, hostname, login=None, port=22, keyfile=None):
+        key = (login, hostname, port, keyfile)
+        with self._key_lock(key):
+            clt = self.clients.pop(key, None)
+            if clt:
+                clt.close()
+
+    def close_all(self):
+        with self.lock:
+            self._fork_check()
+            clients = list(self.clients.values())
+            self.clients = {}
+        for c in clients:
+            try:
+                c.close()
+            except:
+                pass
+
+    """
+    return a dict with the number of new connections and reused connections
+    """
+    def stats(self):
+        with self.lock:
+            self._fork_check()
+            return {'connect': self.connect_count,
+                    'reuse': self.reuse_count,
+                    'open': len([c for c in self.clients.values() if c.is_active()])}